@@ -1,4 +1,27 @@
+import os
 import setuptools
+from setuptools.command.build_py import build_py
+
+class build_py_with_extensions(build_py):
+    """
+    Compile the cppimport extensions into the build directory so that
+    installed copies load prebuilt shared objects instead of building on
+    first import. Set TECTOSAUR_SKIP_EXT_BUILD=1 to leave that to cppimport.
+    """
+    def run(self):
+        super().run()
+        if os.environ.get('TECTOSAUR_SKIP_EXT_BUILD', '0') != '0':
+            return
+        try:
+            # Importing tectosaur needs cppimport. Without it, leave the
+            # extensions to be built on first use.
+            from tectosaur.util.build_extensions import build_all
+            build_all(root = os.path.join(self.build_lib, 'tectosaur'))
+        except Exception as e:
+            self.warn(
+                'ahead of time build of the C++ extensions failed, they will '
+                'be built by cppimport on first use: ' + str(e)
+            )
 
 try:
    import pypandoc
@@ -9,8 +32,9 @@ except (IOError, ImportError):
 setuptools.setup(
     packages = setuptools.find_packages(),
 
-    install_requires = ['matplotlib', 'numpy', 'scipy', 'mako', 'cppimport', 'attrs', 'taskloaf>=18.12.08', 'okada_wrapper', 'psutil'],
+    install_requires = ['matplotlib', 'numpy', 'scipy', 'mako', 'cppimport<20', 'attrs', 'taskloaf>=18.12.08', 'okada_wrapper', 'psutil'],
     zip_safe = False,
+    cmdclass = dict(build_py = build_py_with_extensions),
     include_package_data = True,
 
     name = 'tectosaur',
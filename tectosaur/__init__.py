@@ -3,6 +3,7 @@ import ctypes
 cppimport.set_rtld_flags(ctypes.RTLD_GLOBAL)
 
 import os
+import importlib
 
 source_dir = os.path.dirname(os.path.realpath(__file__))
 data_dir = os.path.join(source_dir, 'data')
@@ -12,33 +13,60 @@ def get_data_filepath(filename):
 
 from tectosaur.util.logging import setup_root_logger
 logger = setup_root_logger(__name__)
-from tectosaur.util.timer import Timer
-
-from tectosaur.mesh.mesh_gen import make_rect
-from tectosaur.mesh.combined_mesh import CombinedMesh
-from tectosaur.mesh.modify import concat
-from tectosaur.mesh.refine import refine
-
-from tectosaur.ops.mass_op import MassOp
-from tectosaur.ops.sum_op import SumOp
-from tectosaur.ops.neg_op import NegOp, MultOp
-from tectosaur.ops.composite_op import CompositeOp
-from tectosaur.ops.sparse_integral_op import RegularizedSparseIntegralOp
-from tectosaur.ops.sparse_farfield_op import (
-    TriToTriDirectFarfieldOp,
-    FMMFarfieldOp)
-from tectosaur.ops.dense_integral_op import RegularizedDenseIntegralOp
-from tectosaur.interior import InteriorOp
-
-from tectosaur.constraints import Term, ConstraintEQ, build_constraint_matrix, \
-    simple_constraint_matrix
-from tectosaur.constraint_builders import (
-    free_edge_constraints,
-    simple_constraints,
-    find_free_edges,
-    free_edge_dofs,
-    build_composite_constraints,
-    jump_constraints,
-    check_continuity,
-    all_bc_constraints)
-from tectosaur.continuity import continuity_constraints, traction_admissibility_constraints
+
+# The public API is loaded on first access (PEP 562) so that "import
+# tectosaur" does not import the ops, build or load the C++ extensions, or
+# pull in the gpu backend until they are actually used.
+_lazy_attrs = dict()
+def _add_lazy(module_name, *names):
+    for name in names:
+        _lazy_attrs[name] = module_name
+
+_add_lazy('tectosaur.util.timer', 'Timer')
+
+_add_lazy('tectosaur.mesh.mesh_gen', 'make_rect')
+_add_lazy('tectosaur.mesh.combined_mesh', 'CombinedMesh')
+_add_lazy('tectosaur.mesh.modify', 'concat')
+_add_lazy('tectosaur.mesh.refine', 'refine')
+_add_lazy('tectosaur.mesh.mesh_context', 'MeshContext', 'get_mesh_context')
+
+_add_lazy('tectosaur.ops.mass_op', 'MassOp')
+_add_lazy('tectosaur.ops.sum_op', 'SumOp')
+_add_lazy('tectosaur.ops.neg_op', 'NegOp', 'MultOp')
+_add_lazy('tectosaur.ops.composite_op', 'CompositeOp')
+_add_lazy('tectosaur.ops.sparse_integral_op', 'RegularizedSparseIntegralOp')
+_add_lazy('tectosaur.ops.sparse_farfield_op',
+    'TriToTriDirectFarfieldOp',
+    'FMMFarfieldOp',
+    'KIFMMFarfieldOp')
+_add_lazy('tectosaur.ops.dense_integral_op', 'RegularizedDenseIntegralOp')
+_add_lazy('tectosaur.interior', 'InteriorOp')
+
+_add_lazy('tectosaur.constraints', 'Term', 'ConstraintEQ', 'build_constraint_matrix',
+    'simple_constraint_matrix')
+_add_lazy('tectosaur.constraint_builders',
+    'free_edge_constraints',
+    'simple_constraints',
+    'find_free_edges',
+    'free_edge_dofs',
+    'build_composite_constraints',
+    'jump_constraints',
+    'check_continuity',
+    'all_bc_constraints')
+_add_lazy('tectosaur.continuity',
+    'continuity_constraints', 'traction_admissibility_constraints')
+
+def __getattr__(name):
+    if name in _lazy_attrs:
+        value = getattr(importlib.import_module(_lazy_attrs[name]), name)
+        globals()[name] = value
+        return value
+    try:
+        return importlib.import_module(__name__ + '.' + name)
+    except ModuleNotFoundError as e:
+        if e.name != __name__ + '.' + name:
+            raise
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(_lazy_attrs.keys()))
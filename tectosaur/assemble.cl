@@ -3,6 +3,9 @@ from tectosaur.nearfield.pairs_integrator import pairs_func_name
 from tectosaur.kernels import elastic_kernels, kernels
 
 K = kernels[kernel_name]
+KC = None
+if correction_kernel_name is not None:
+    KC = kernels[correction_kernel_name]
 
 def dn(dim):
     return ['x', 'y', 'z'][dim]
@@ -46,6 +49,207 @@ void ${pairs_func_name(check0)}(GLOBAL_MEM Real* result,
 }
 </%def>
 
+<%def name="correction_pair(KC, check0, condition = 'true')">
+    // The far rule correction for the unrotated pair. Everything is declared
+    // in a block so that it can follow the nearfield integral in the same
+    // kernel.
+    Real correction[81];
+    for (int iresult = 0; iresult < 81; iresult++) {
+        correction[iresult] = 0;
+    }
+    if (${condition}) {
+        const int n_quad_pts = n_far_quad_pts;
+        GLOBAL_MEM Real* quad_pts = far_quad_pts;
+        GLOBAL_MEM Real* quad_wts = far_quad_wts;
+        const int obs_tri_rot_clicks = 0;
+        const int src_tri_rot_clicks = 0;
+        ${prim.decl_tri_info("obs", KC.needs_obsn, KC.surf_curl_obs)}
+        ${prim.decl_tri_info("src", KC.needs_srcn, KC.surf_curl_src)}
+        ${prim.tri_info("obs", "pts", "tris", KC.needs_obsn, KC.surf_curl_obs)}
+        ${prim.tri_info("src", "pts", "tris", KC.needs_srcn, KC.surf_curl_src)}
+        ${prim.integrate_pair(KC, check0)}
+        for (int iresult = 0; iresult < 81; iresult++) {
+            correction[iresult] = obs_jacobian * src_jacobian * result_temp[iresult];
+        }
+    }
+</%def>
+
+<%def name="single_pairs_corrected(K, KC, check0)">
+KERNEL
+void ${pairs_func_name(check0)}_corrected(GLOBAL_MEM Real* result,
+    GLOBAL_MEM Real* result_uncorrected,
+    int n_quad_pts, GLOBAL_MEM Real* quad_pts, GLOBAL_MEM Real* quad_wts,
+    int n_far_quad_pts, GLOBAL_MEM Real* far_quad_pts, GLOBAL_MEM Real* far_quad_wts,
+    GLOBAL_MEM Real* pts, GLOBAL_MEM int* tris, GLOBAL_MEM int* pairs_list, 
+    int start_idx, int end_idx, GLOBAL_MEM Real* params, int write_uncorrected)
+{
+    ${setup_pair()}
+
+    const int obs_tri_idx = pairs_list[pair_idx * 2];
+    const int src_tri_idx = pairs_list[pair_idx * 2 + 1];
+    const int obs_tri_rot_clicks = 0;
+    const int src_tri_rot_clicks = 0;
+    ${prim.decl_tri_info("obs", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
+    ${prim.tri_info("obs", "pts", "tris", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.tri_info("src", "pts", "tris", K.needs_srcn, K.surf_curl_src)}
+    ${prim.integrate_pair(K, check0)}
+    ${correction_pair(KC, check0)}
+
+    for (int iresult = 0; iresult < 81; iresult++) {
+        Real val = obs_jacobian * src_jacobian * result_temp[iresult];
+        result[i * 81 + iresult] = val - correction[iresult];
+        if (write_uncorrected) {
+            result_uncorrected[i * 81 + iresult] = val;
+        }
+    }
+}
+</%def>
+
+<%def name="single_pairs_adj_corrected(K, KC)">
+KERNEL
+void ${pairs_func_name(False)}_adj_corrected(GLOBAL_MEM Real* result,
+    GLOBAL_MEM Real* result_uncorrected,
+    int n_quad_pts, GLOBAL_MEM Real* quad_pts, GLOBAL_MEM Real* quad_wts,
+    int n_far_quad_pts, GLOBAL_MEM Real* far_quad_pts, GLOBAL_MEM Real* far_quad_wts,
+    GLOBAL_MEM Real* pts, GLOBAL_MEM int* tris, GLOBAL_MEM int* pairs_list, 
+    int start_idx, int end_idx, GLOBAL_MEM Real* params, int write_uncorrected)
+{
+    ${setup_pair()}
+
+    const int obs_tri_idx = pairs_list[pair_idx * 5];
+    const int src_tri_idx = pairs_list[pair_idx * 5 + 1];
+    const int obs_tri_rot_clicks = pairs_list[pair_idx * 5 + 2];
+    const int src_tri_rot_clicks = pairs_list[pair_idx * 5 + 3];
+    const bool src_tri_flip = pairs_list[pair_idx * 5 + 4];
+    ${prim.decl_tri_info("obs", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
+    ${prim.tri_info("obs", "pts", "tris", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.tri_info("src", "pts", "tris", K.needs_srcn, K.surf_curl_src, need_flip = True)}
+    ${prim.integrate_pair(K, True)}
+    ${correction_pair(KC, False)}
+    ${derotation()}
+
+    for (int b1 = 0; b1 < 3; b1++) {
+        for (int d1 = 0; d1 < 3; d1++) {
+            for (int b2 = 0; b2 < 3; b2++) {
+                for (int d2 = 0; d2 < 3; d2++) {
+                    int out_idx = b1 * 27 + d1 * 9 + b2 * 3 + d2;
+                    int in_idx = obs_derot[b1] * 27 + d1 * 9 + src_derot[b2] * 3 + d2;
+                    Real val = obs_jacobian * src_jacobian * result_temp[in_idx];
+                    result[i * 81 + out_idx] = val - correction[out_idx];
+                    if (write_uncorrected) {
+                        result_uncorrected[i * 81 + out_idx] = val;
+                    }
+                }
+            }
+        }
+    }
+}
+</%def>
+
+<%def name="matvec_out(out_idx, in_idx)">
+    // Multiply the block by the input 9-vector of this pair. The far rule
+    // correction is zero unless subtract_correction is set.
+    Real out[9];
+    for (int k = 0; k < 9; k++) {
+        out[k] = 0;
+    }
+    for (int b1 = 0; b1 < 3; b1++) {
+        for (int d1 = 0; d1 < 3; d1++) {
+            for (int b2 = 0; b2 < 3; b2++) {
+                for (int d2 = 0; d2 < 3; d2++) {
+                    int out_idx = ${out_idx};
+                    int in_idx = ${in_idx};
+                    Real val = obs_jacobian * src_jacobian * result_temp[in_idx];
+                    out[b1 * 3 + d1] += (val - correction[out_idx]) *
+                        input[i * 9 + b2 * 3 + d2];
+                }
+            }
+        }
+    }
+    for (int k = 0; k < 9; k++) {
+        result[i * 9 + k] = out[k];
+    }
+</%def>
+
+<%def name="single_pairs_matvec(K, KC, check0)">
+KERNEL
+void ${pairs_func_name(check0)}_matvec(GLOBAL_MEM Real* result,
+    GLOBAL_MEM Real* input,
+    int n_quad_pts, GLOBAL_MEM Real* quad_pts, GLOBAL_MEM Real* quad_wts,
+    int n_far_quad_pts, GLOBAL_MEM Real* far_quad_pts, GLOBAL_MEM Real* far_quad_wts,
+    GLOBAL_MEM Real* pts, GLOBAL_MEM int* tris, GLOBAL_MEM int* pairs_list, 
+    int start_idx, int end_idx, GLOBAL_MEM Real* params, int subtract_correction)
+{
+    ${setup_pair()}
+
+    const int obs_tri_idx = pairs_list[pair_idx * 2];
+    const int src_tri_idx = pairs_list[pair_idx * 2 + 1];
+    const int obs_tri_rot_clicks = 0;
+    const int src_tri_rot_clicks = 0;
+    ${prim.decl_tri_info("obs", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
+    ${prim.tri_info("obs", "pts", "tris", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.tri_info("src", "pts", "tris", K.needs_srcn, K.surf_curl_src)}
+    ${prim.integrate_pair(K, check0)}
+    ${correction_pair(KC, check0, "subtract_correction")}
+    ${matvec_out(
+        "b1 * 27 + d1 * 9 + b2 * 3 + d2", "b1 * 27 + d1 * 9 + b2 * 3 + d2"
+    )}
+}
+</%def>
+
+<%def name="single_pairs_adj_matvec(K, KC)">
+KERNEL
+void ${pairs_func_name(False)}_adj_matvec(GLOBAL_MEM Real* result,
+    GLOBAL_MEM Real* input,
+    int n_quad_pts, GLOBAL_MEM Real* quad_pts, GLOBAL_MEM Real* quad_wts,
+    int n_far_quad_pts, GLOBAL_MEM Real* far_quad_pts, GLOBAL_MEM Real* far_quad_wts,
+    GLOBAL_MEM Real* pts, GLOBAL_MEM int* tris, GLOBAL_MEM int* pairs_list, 
+    int start_idx, int end_idx, GLOBAL_MEM Real* params, int subtract_correction)
+{
+    ${setup_pair()}
+
+    const int obs_tri_idx = pairs_list[pair_idx * 5];
+    const int src_tri_idx = pairs_list[pair_idx * 5 + 1];
+    const int obs_tri_rot_clicks = pairs_list[pair_idx * 5 + 2];
+    const int src_tri_rot_clicks = pairs_list[pair_idx * 5 + 3];
+    const bool src_tri_flip = pairs_list[pair_idx * 5 + 4];
+    ${prim.decl_tri_info("obs", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
+    ${prim.tri_info("obs", "pts", "tris", K.needs_obsn, K.surf_curl_obs)}
+    ${prim.tri_info("src", "pts", "tris", K.needs_srcn, K.surf_curl_src, need_flip = True)}
+    ${prim.integrate_pair(K, True)}
+    ${correction_pair(KC, False, "subtract_correction")}
+    ${derotation()}
+    ${matvec_out(
+        "b1 * 27 + d1 * 9 + b2 * 3 + d2",
+        "obs_derot[b1] * 27 + d1 * 9 + src_derot[b2] * 3 + d2"
+    )}
+}
+</%def>
+
+<%def name="derotation()">
+    int obs_derot[3];
+    for (size_t i = 0; i < 3; i++) {
+        obs_derot[i] = positive_mod(-obs_tri_rot_clicks + i, 3);
+    }
+    int src_derot[3];
+    for (size_t i = 0; i < 3; i++) {
+        src_derot[i] = positive_mod(-src_tri_rot_clicks + i, 3);
+    }
+    // The flip is applied before the rotation in tri_info, so it has to be
+    // undone after the derotation.
+    if (src_tri_flip) { 
+        for (size_t i = 0; i < 3; i++) {
+            if (src_derot[i] < 2) {
+                src_derot[i] = 1 - src_derot[i];
+            }
+        }
+    } 
+</%def>
+
 <%def name="single_pairs_adj(K)">
 KERNEL
 void ${pairs_func_name(check0)}_adj(GLOBAL_MEM Real* result, 
@@ -74,19 +278,7 @@ void ${pairs_func_name(check0)}_adj(GLOBAL_MEM Real* result,
     //printf("src3: %f %f %f\n", src_tri[2][0], src_tri[2][1], src_tri[2][2]);
     //printf("obsjac: %f srcjac: %f \n", obs_jacobian, src_jacobian);
     
-    int obs_derot[3];
-    for (size_t i = 0; i < 3; i++) {
-        obs_derot[i] = positive_mod(-obs_tri_rot_clicks + i, 3);
-    }
-    int src_derot[3];
-    for (size_t i = 0; i < 3; i++) {
-        src_derot[i] = positive_mod(-src_tri_rot_clicks + i, 3);
-    }
-    if (src_tri_flip) { 
-        int temp = src_derot[0];
-        src_derot[0] = src_derot[1];
-        src_derot[1] = temp;
-    } 
+    ${derotation()}
     for (int b1 = 0; b1 < 3; b1++) {
         for (int d1 = 0; d1 < 3; d1++) {
             for (int b2 = 0; b2 < 3; b2++) {
@@ -189,6 +381,14 @@ ${prim.geometry_fncs()}
 ${single_pairs(K, check0 = True)}
 ${single_pairs(K, check0 = False)}
 ${single_pairs_adj(K)}
+% if KC is not None:
+    ${single_pairs_corrected(K, KC, check0 = True)}
+    ${single_pairs_corrected(K, KC, check0 = False)}
+    ${single_pairs_adj_corrected(K, KC)}
+    ${single_pairs_matvec(K, KC, check0 = True)}
+    ${single_pairs_matvec(K, KC, check0 = False)}
+    ${single_pairs_adj_matvec(K, KC)}
+% endif
 ${farfield_tris(K)}
 % if not K.surf_curl_obs:
     ${interior_pairs(K)}
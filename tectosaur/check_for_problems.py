@@ -1,9 +1,13 @@
 import numpy as np
 import tectosaur.mesh.find_near_adj as find_near_adj
+import tectosaur.nearfield.standardize as standardize
+import tectosaur.nearfield.edge_adj_setup as edge_adj_setup
+from tectosaur.nearfield.table_params import table_min_internal_angle, \
+    min_intersect_angle
 
-import cppimport.import_hook
-import tectosaur.util.tri_tri_intersect as tri_tri_intersect
-import tectosaur._check_for_problems as _check_for_problems
+from tectosaur.util.cpp import imp
+tri_tri_intersect = imp('tectosaur.util.tri_tri_intersect')
+_check_for_problems = imp('tectosaur._check_for_problems')
 
 def check_min_adj_angle(m, ea = None):
     pts, tris = m
@@ -18,7 +22,7 @@ def check_min_adj_angle(m, ea = None):
         phi = edge_adj_setup.calc_adjacent_phi(obs_tri, src_tri)
         if lower_lim <= phi <= upper_lim:
             continue
-        bad_pairs.append(pair)
+        bad_pairs.append(pair[:2])
     return np.array(bad_pairs, dtype = np.int64)
 
 def check_for_slivers(m):
@@ -36,11 +40,13 @@ def check_tris_tall_enough(m):
     pts, tris = m
     bad_tris = []
     for i, t in enumerate(tris):
-        t_list = pts[t].tolist()
-        split_pt = edge_adj_setup.get_split_pt(t_list);
-        xyhat = edge_adj_setup.xyhat_from_pt(split_pt, t_list)
-        if not edge_adj_setup.check_xyhat(xyhat):
-            bad_tris.append(i)
+        for clicks in range(3):
+            t_list = pts[np.roll(t, -clicks)].tolist()
+            split_pt = edge_adj_setup.get_split_pt(t_list)
+            xyhat = edge_adj_setup.xyhat_from_pt(split_pt, t_list)
+            if not edge_adj_setup.check_xyhat(xyhat):
+                bad_tris.append(i)
+                break
     return np.array(bad_tris, dtype = np.int64)
 
 def check_for_intersections_nearfield(pts, tris, nearfield_pairs):
@@ -91,7 +97,7 @@ def check_for_intersections_ea(pts, tris, ea):
                 continue
             dist = np.sqrt(np.sum((pts[tris[pair[1]]] - pts[tris[pair[0],d]]) ** 2, axis = 1))
             if np.any(dist == 0):
-                bad_pairs.append(pair)
+                bad_pairs.append(pair[:2])
     return bad_pairs
 
 import logging
@@ -4,8 +4,21 @@ import numpy as np
 from tectosaur.util.cpp import imp
 fast_constraints = imp('tectosaur.fast_constraints')
 
-for k in dir(fast_constraints):
-    locals()[k] = getattr(fast_constraints, k)
+# Term and ConstraintEQ are pybind11 classes, so they are re-exported as the
+# real objects rather than wrappers to keep isinstance and subclassing
+# working. The extension is loaded on the first access to one of these names
+# (PEP 562), not when this module is imported.
+_extension_names = [
+    'Term', 'ConstraintEQ', 'ConstructionConstraintEQ', 'IsolatedTermEQ',
+    'isolate_term_on_lhs', 'substitute', 'combine_terms', 'filter_zero_terms'
+]
+
+def __getattr__(name):
+    if name in _extension_names:
+        value = getattr(fast_constraints, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 def build_constraint_matrix(cs, n_total_dofs):
     rows, cols, vals, rhs_rows, rhs_cols, rhs_vals, rhs_in, n_unique_cs = \
@@ -33,4 +46,6 @@ def simple_constraint_matrix(cs, n_cols):
         rhs
     )
 
-
+__all__ = _extension_names + [
+    'fast_constraints', 'build_constraint_matrix', 'simple_constraint_matrix'
+]
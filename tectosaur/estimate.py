@@ -0,0 +1,258 @@
+import sys
+import time
+import numpy as np
+
+from tectosaur.mesh.mesh_context import get_mesh_context
+from tectosaur.kernels import kernels
+import tectosaur.nearfield.pairs_integrator as pairs_integrator
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A dry run of RegularizedSparseIntegralOp setup: the nearfield pair counts,
+# the memory the assembled nearfield and the FMM will need and, with a
+# throughput calibration, how long the nearfield assembly will take. Only the
+# nearfield search and the FMM plan (tree construction and traversal) are run.
+# Both are kept in the mesh's MeshContext, returned as est['mesh_context'], so
+# a build that follows the estimate reuses them while that is held on to.
+
+categories = ['coincident', 'edge_adj', 'vert_adj', 'nearfield']
+
+def pair_counts(ctx, obs_subset, src_subset, near_threshold):
+    nearfield_pairs, _, va, _, ea, _ = ctx.pair_categories(
+        obs_subset, src_subset, near_threshold
+    )
+    co_tris = np.intersect1d(obs_subset, src_subset)
+    pairs = dict(
+        coincident = np.array([co_tris, co_tris]).T.copy(),
+        edge_adj = ea, vert_adj = va, nearfield = nearfield_pairs
+    )
+    return {k: v.shape[0] for k, v in pairs.items()}, pairs
+
+def nearfield_memory(counts, n_obs, float_type, lean, pairs):
+    # The host memory of the assembled nearfield matrices and pair lists,
+    # and an upper bound on the device memory used during assembly.
+    n_blocks = sum(counts.values())
+    itemsize = np.dtype(float_type).itemsize
+    n_mats = 1 if lean else 2
+    block_bytes = 81 * itemsize
+    mats = n_mats * (n_blocks * (block_bytes + 8) + (n_obs + 1) * 8)
+    category_pairs = n_blocks * 2 * 8
+    pair_lists = sum(p.nbytes for p in pairs.values())
+
+    n_outputs = 1 if lean else 2
+    max_pairs = max(counts.values(), default = 0)
+    chunk = min(max_pairs, pairs_integrator.max_chunk_size)
+    device = (
+        pairs_integrator.n_streams * chunk * n_outputs * block_bytes
+        + max_pairs * 5 * 4
+    )
+    return dict(
+        host_matrices = mats,
+        host_pairs = category_pairs + pair_lists,
+        host_total = mats + category_pairs + pair_lists,
+        host_matrix_free = pair_lists,
+        device_assembly = device
+    )
+
+def fmm_estimate(ctx, obs_subset, src_subset, K_name, float_type,
+        mac, pts_per_cell, order, treecode = True):
+    L_scale = np.max(ctx.pts)
+    plan = ctx.fmm_plan(obs_subset, src_subset, L_scale, mac, pts_per_cell, treecode)
+
+    # Expansions are counted as (order + 1) ** 2 terms, as in report_interactions.
+    n_terms = (order + 1) ** 2
+    counts = dict()
+    n_list_entries = 0
+    for op_name in ['p2m', 'p2l', 'm2l', 'p2p', 'm2p', 'l2p', 'm2m', 'l2l']:
+        counts[op_name] = plan.count_interactions(op_name, n_terms)
+        op = getattr(plan.interactions, op_name)
+        for level_op in (op if type(op) is list else [op]):
+            n_list_entries += (
+                len(level_op.obs_n_idxs) + len(level_op.obs_src_starts)
+                + len(level_op.src_n_idxs)
+            )
+
+    itemsize = np.dtype(float_type).itemsize
+    multipoles = n_terms * kernels[K_name].multipole_dim * 2 * plan.src_n_nodes
+    if not treecode:
+        multipoles += n_terms * kernels[K_name].multipole_dim * 2 * plan.obs_n_nodes
+    device = (
+        multipoles * itemsize + n_list_entries * 4
+        + (obs_subset.shape[0] + src_subset.shape[0]) * 9 * (itemsize + 4)
+    )
+    n_direct = obs_subset.shape[0] * src_subset.shape[0]
+    return dict(
+        obs_tree_nodes = plan.obs_n_nodes, src_tree_nodes = plan.src_n_nodes,
+        obs_tree_height = int(plan.arrays['obs_max_height']),
+        src_tree_height = int(plan.arrays['src_max_height']),
+        interactions = counts,
+        compression = sum(counts.values()) / max(n_direct, 1),
+        device = device
+    )
+
+def calibrate_throughput(pts, tris, pairs, K_near_name, K_far_name, params,
+        float_type, nq, lean = False, nearfield_tol = None, n_sample = 2000):
+    """
+    Pairs per second for each category, from integrating (after a warm up
+    run) the first n_sample pairs of each with the fused corrected kernels,
+    congruent pair deduplication and nearfield_tol binning that
+    RegularizedNearfieldIntegralOp uses. nq is (nq_coincident, nq_edge_adj,
+    nq_vert_adjacent, nq_far, nq_near). The deduplication hit rate of the
+    sample can differ from the one of the whole mesh.
+    """
+    nq_coincident, nq_edge_adj, nq_vert_adjacent, nq_far, nq_near = nq
+    pairs_int = pairs_integrator.PairsIntegrator(
+        K_near_name, params, float_type, nq_far, nq_near, pts, tris,
+        correction_kernel = K_far_name
+    )
+    fused = dict(corrected = True, keep_uncorrected = not lean)
+    calls = dict(
+        coincident = lambda p: pairs_int.coincident(nq_coincident, p, **fused),
+        edge_adj = lambda p: pairs_int.edge_adj(nq_edge_adj, p, **fused),
+        vert_adj = lambda p: pairs_int.vert_adj(nq_vert_adjacent, p, **fused),
+        nearfield = lambda p: pairs_int.nearfield(p, tol = nearfield_tol, **fused)
+    )
+    throughput = dict()
+    for name in categories:
+        sample = pairs[name][:n_sample]
+        if sample.shape[0] == 0:
+            continue
+        calls[name](sample[:1])
+        start = time.time()
+        calls[name](sample)
+        throughput[name] = sample.shape[0] / max(time.time() - start, 1e-9)
+    return throughput
+
+def estimate(pts, tris, obs_subset = None, src_subset = None,
+        near_threshold = 2.5, float_type = np.float32, lean = False,
+        K_name = 'elasticRH3', params = (1.0, 0.25), fmm = None,
+        throughput = None, calibrate_nq = None, K_far_name = None,
+        nearfield_tol = None):
+    """
+    A dry run estimate for building a RegularizedSparseIntegralOp on
+    (pts, tris). K_name is the nearfield kernel and K_far_name the farfield
+    kernel (K_name by default). fmm is an optional dict with the mac,
+    pts_per_cell and order of an FMMFarfieldOp, and optionally its treecode
+    flag. throughput maps categories to pairs per second. With calibrate_nq
+    (see calibrate_throughput), it is measured instead.
+    """
+    if K_far_name is None:
+        K_far_name = K_name
+    if obs_subset is None:
+        obs_subset = np.arange(tris.shape[0])
+    if src_subset is None:
+        src_subset = np.arange(tris.shape[0])
+
+    out = dict()
+    out['mesh_context'] = ctx = get_mesh_context(pts, tris)
+    start = time.time()
+    out['counts'], pairs = pair_counts(ctx, obs_subset, src_subset, near_threshold)
+    out['search_time'] = time.time() - start
+    out['memory'] = nearfield_memory(
+        out['counts'], obs_subset.shape[0], float_type, lean, pairs
+    )
+    if fmm is not None:
+        out['fmm'] = fmm_estimate(
+            ctx, obs_subset, src_subset, K_far_name, float_type,
+            fmm['mac'], fmm['pts_per_cell'], fmm['order'],
+            fmm.get('treecode', True)
+        )
+    if calibrate_nq is not None:
+        throughput = calibrate_throughput(
+            pts, tris, pairs, K_name, K_far_name, list(params), float_type,
+            calibrate_nq, lean, nearfield_tol
+        )
+    if throughput is not None:
+        out['throughput'] = throughput
+        out['assembly_time'] = {
+            k: out['counts'][k] / throughput[k]
+            for k in categories if k in throughput
+        }
+    return out
+
+def report(est):
+    lines = ['nearfield search: {:.2f}s'.format(est['search_time'])]
+    for k in categories:
+        line = '{}: {} pairs'.format(k, est['counts'][k])
+        if k in est.get('assembly_time', dict()):
+            line += ', {:.0f} pairs/s, projected {:.1f}s'.format(
+                est['throughput'][k], est['assembly_time'][k]
+            )
+        lines.append(line)
+    if 'assembly_time' in est:
+        lines.append('projected nearfield assembly: {:.1f}s'.format(
+            sum(est['assembly_time'].values())
+        ))
+    mem = est['memory']
+    lines.append(
+        'nearfield host memory: {:.1f} MB ({:.1f} MB matrices, {:.1f} MB pairs), '
+        '{:.1f} MB matrix free'.format(
+            mem['host_total'] / 1e6, mem['host_matrices'] / 1e6,
+            mem['host_pairs'] / 1e6, mem['host_matrix_free'] / 1e6
+        )
+    )
+    lines.append('nearfield device memory: at most {:.1f} MB'.format(
+        mem['device_assembly'] / 1e6
+    ))
+    if 'fmm' in est:
+        f = est['fmm']
+        lines.append('fmm trees: {} obs nodes (height {}), {} src nodes (height {})'.format(
+            f['obs_tree_nodes'], f['obs_tree_height'],
+            f['src_tree_nodes'], f['src_tree_height']
+        ))
+        lines.append('fmm compression factor: {:.3g}'.format(f['compression']))
+        for k, v in f['interactions'].items():
+            lines.append('fmm {} interactions: {:e}'.format(k, v))
+        lines.append('fmm device memory: {:.1f} MB'.format(f['device'] / 1e6))
+    return '\n'.join(lines)
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog = 'python -m tectosaur.estimate',
+        description = 'Estimate the nearfield pair counts, memory use and '
+            'assembly time of an integral operator before building it.'
+    )
+    parser.add_argument('mesh',
+        help = '.npz file with pts and tris arrays, and optionally obs_subset '
+            'and src_subset')
+    parser.add_argument('--near-threshold', type = float, default = 2.5)
+    parser.add_argument('--float-type', choices = ['float32', 'float64'],
+        default = 'float32')
+    parser.add_argument('--lean', action = 'store_true')
+    parser.add_argument('--kernel', default = 'elasticRH3')
+    parser.add_argument('--far-kernel', default = None,
+        help = 'the farfield kernel (default: the same as --kernel)')
+    parser.add_argument('--nearfield-tol', type = float, default = None)
+    parser.add_argument('--params', type = float, nargs = '+', default = [1.0, 0.25])
+    parser.add_argument('--fmm', type = float, nargs = 3, default = None,
+        metavar = ('MAC', 'PTS_PER_CELL', 'ORDER'))
+    parser.add_argument('--full-fmm', action = 'store_true',
+        help = 'estimate the full FMM instead of the treecode')
+    parser.add_argument('--calibrate', type = int, nargs = 5, default = None,
+        metavar = ('NQ_COINCIDENT', 'NQ_EDGE_ADJ', 'NQ_VERT_ADJ', 'NQ_FAR', 'NQ_NEAR'),
+        help = 'measure the assembly throughput with these quadrature orders')
+    opts = parser.parse_args(args)
+
+    data = np.load(opts.mesh)
+    fmm = None
+    if opts.fmm is not None:
+        fmm = dict(
+            mac = opts.fmm[0], pts_per_cell = int(opts.fmm[1]), order = int(opts.fmm[2]),
+            treecode = not opts.full_fmm
+        )
+    est = estimate(
+        data['pts'], data['tris'],
+        obs_subset = data['obs_subset'] if 'obs_subset' in data else None,
+        src_subset = data['src_subset'] if 'src_subset' in data else None,
+        near_threshold = opts.near_threshold,
+        float_type = getattr(np, opts.float_type), lean = opts.lean,
+        K_name = opts.kernel, params = opts.params, fmm = fmm,
+        calibrate_nq = opts.calibrate, K_far_name = opts.far_kernel,
+        nearfield_tol = opts.nearfield_tol
+    )
+    print(report(est))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -59,16 +59,25 @@ void farfield_pts${K.name}(
     int tile = 0;
     for (; j < n_src; j += ${block_size}, tile++) {
         LOCAL_BARRIER;
-        int idx = tile * ${block_size} + local_id;
-        if (idx < n_src) {
-            for (int k = 0; k < ${K.spatial_dim}; k++) {
-                % if K.needs_srcn:
-                sh_src_ns[local_id * ${K.spatial_dim} + k] = src_ns[idx * ${K.spatial_dim} + k];
-                % endif
-                sh_src_pts[local_id * ${K.spatial_dim} + k] = src_pts[idx * ${K.spatial_dim} + k];
-            }
-            for (int k = 0; k < ${K.tensor_dim}; k++) {
-                sh_input[local_id * ${K.tensor_dim} + k] = input[idx * ${K.tensor_dim} + k];
+        % if cpu_backend:
+        // The host backend runs a work group's items one after another, so
+        // each item loads the entire tile itself.
+        for (int load_id = 0; load_id < ${block_size}; load_id++) {
+        % else:
+        {
+            int load_id = local_id;
+        % endif
+            int idx = tile * ${block_size} + load_id;
+            if (idx < n_src) {
+                for (int k = 0; k < ${K.spatial_dim}; k++) {
+                    % if K.needs_srcn:
+                    sh_src_ns[load_id * ${K.spatial_dim} + k] = src_ns[idx * ${K.spatial_dim} + k];
+                    % endif
+                    sh_src_pts[load_id * ${K.spatial_dim} + k] = src_pts[idx * ${K.spatial_dim} + k];
+                }
+                for (int k = 0; k < ${K.tensor_dim}; k++) {
+                    sh_input[load_id * ${K.tensor_dim} + k] = input[idx * ${K.tensor_dim} + k];
+                }
             }
         }
         LOCAL_BARRIER;
@@ -42,9 +42,13 @@ class FMM:
         for a in ['s', 'p']:
             for b in ['s', 'p']:
                 name = a + '2' + b
-                self.gpu_ops[name] = getattr(self.cfg.gpu_module, name + '_' + self.cfg.K.name)
-        self.gpu_ops['c2e1'] = self.cfg.gpu_module.c2e_kernel1
-        self.gpu_ops['c2e2'] = self.cfg.gpu_module.c2e_kernel2
+                op_K = self.cfg.op_kernels[name]
+                self.gpu_ops[name] = getattr(
+                    self.cfg.gpu_modules[op_K.name], name + '_' + op_K.name
+                )
+        equiv_module = self.cfg.gpu_modules[self.cfg.op_kernels['s2s'].name]
+        self.gpu_ops['c2e1'] = equiv_module.c2e_kernel1
+        self.gpu_ops['c2e2'] = equiv_module.c2e_kernel2
 
     def setup_output_sizes(self):
         self.n_surf_tris = self.cfg.surf[1].shape[0]
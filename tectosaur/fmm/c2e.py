@@ -1,13 +1,38 @@
+import os
+import sys
+import time
 import attr
 import numpy as np
 from multiprocessing import Pool
 import cloudpickle
 
 import tectosaur.util.gpu as gpu
+import tectosaur.util.disk_cache as disk_cache
 from tectosaur.mesh.modify import concat
+from tectosaur.mesh.mesh_gen import make_sphere
 from tectosaur.ops.dense_integral_op import FarfieldTriMatrix
 from tectosaur.util.timer import Timer
 
+import logging
+logger = logging.getLogger(__name__)
+
+# The c2e operators only depend on the equivalent kernel and its parameters,
+# the sphere surface, the surface quadrature and the check and equivalent
+# radii. They are always computed in float64, so the float type of the FMM
+# doesn't matter. Each one is memoized in process and stored on disk in the
+# 'c2e' cache, so building an FMM skips the dense assembly and the SVD.
+# TECTOSAUR_C2E_CACHE=0 turns off the disk cache.
+
+format_version = 1
+c2e_memo = dict()
+c2e_cache = disk_cache.DiskCache(
+    'c2e',
+    max_bytes = float(os.environ.get('TECTOSAUR_C2E_CACHE_MB', 2000)) * 1e6,
+    max_age = float(os.environ.get('TECTOSAUR_C2E_CACHE_DAYS', 60)) * 86400
+)
+use_c2e_cache = os.environ.get('TECTOSAUR_C2E_CACHE', '1') != '0'
+c2e_names = ['UT', 'E', 'V']
+
 @attr.s
 class Ball:
     center = attr.ib()
@@ -30,11 +55,58 @@ def caller(data):
     return f()
 
 def build_c2e(tree, check_r, equiv_r, cfg):
+    return get_c2e(
+        cfg.op_kernels['s2s'].name, cfg.params, cfg.surf, cfg.surf_quad_order,
+        check_r, equiv_r
+    )
+
+def c2e_key(K_name, params, surf, surf_quad_order, check_r, equiv_r):
+    return disk_cache.hash_key(
+        format_version, K_name,
+        np.asarray(params, dtype = np.float64).tobytes(),
+        np.asarray(surf[0], dtype = np.float64).tobytes(),
+        np.asarray(surf[1], dtype = np.int64).tobytes(),
+        int(surf_quad_order), repr(float(check_r)), repr(float(equiv_r))
+    )
+
+def load_c2e(cache, key):
+    if not cache.contains(key, 'V.npy'):
+        return None
+    dir = cache.entry_dir(key)
+    try:
+        out = tuple(np.load(os.path.join(dir, n + '.npy')) for n in c2e_names)
+    except (OSError, ValueError) as e:
+        logger.warning('failed to load cached c2e ' + key + ': ' + str(e))
+        return None
+    cache.touch(key)
+    return out
+
+def save_c2e(cache, key, c2e):
+    def write(dir):
+        for n, arr in zip(c2e_names, c2e):
+            np.save(os.path.join(dir, n + '.npy'), arr)
+    cache.put_dir(key, write)
+
+def get_c2e(K_name, params, surf, surf_quad_order, check_r, equiv_r):
+    key = c2e_key(K_name, params, surf, surf_quad_order, check_r, equiv_r)
+    if key in c2e_memo:
+        return c2e_memo[key]
+    out = None
+    if use_c2e_cache:
+        out = load_c2e(c2e_cache, key)
+    if out is None:
+        out = compute_c2e(K_name, params, surf, surf_quad_order, check_r, equiv_r)
+        if use_c2e_cache:
+            save_c2e(c2e_cache, key, out)
+    c2e_memo[key] = out
+    return out
+
+def compute_c2e(K_name, params, surf, surf_quad_order, check_r, equiv_r):
     t = Timer()
 
-    assembler = FarfieldTriMatrix(cfg.K.name, cfg.params, 4, np.float64)
-    check_surf = inscribe_surf(Ball(center = (0,0,0), R = 1), check_r, cfg.surf)
-    equiv_surf = inscribe_surf(Ball(center = (0,0,0), R = 1), equiv_r, cfg.surf)
+    assembler = FarfieldTriMatrix(K_name, params, surf_quad_order, np.float64)
+    check_surf = inscribe_surf(Ball(center = (0,0,0), R = 1), check_r, surf)
+    equiv_surf = inscribe_surf(Ball(center = (0,0,0), R = 1), equiv_r, surf)
 
     new_pts, new_tris = concat(check_surf, equiv_surf)
     n_check_tris = check_surf[1].shape[0]
@@ -52,3 +124,70 @@ def build_c2e(tree, check_r, equiv_r, cfg):
     out = (U.T.copy(), eig.copy(), VT.T.copy())
     t.report('svd')
     return out
+
+def precompute(K_names, orders, params, inner_r, outer_rs, surf_quad_order):
+    """
+    Fill the c2e cache for the FMMs that make_config would build with these
+    kernels, sphere orders and radii. Both the upward (check at outer_r) and
+    downward (check at inner_r) operators are built. Returns a list of
+    (K_name, order, check_r, equiv_r, seconds, was_cached).
+    """
+    from tectosaur.fmm.cfg import get_op_kernels
+    equiv_K_names = []
+    for K_name in K_names:
+        equiv_K_name = get_op_kernels(K_name)['s2s'].name
+        if equiv_K_name not in equiv_K_names:
+            equiv_K_names.append(equiv_K_name)
+
+    if len(params) == 0:
+        params = [0.0]
+    out = []
+    for K_name in equiv_K_names:
+        for order in orders:
+            surf = make_sphere((0.0, 0.0, 0.0), 1.0, order)
+            for outer_r in outer_rs:
+                for check_r, equiv_r in [(outer_r, inner_r), (inner_r, outer_r)]:
+                    key = c2e_key(
+                        K_name, params, surf, surf_quad_order, check_r, equiv_r
+                    )
+                    was_cached = key in c2e_memo or c2e_cache.contains(key, 'V.npy')
+                    start = time.time()
+                    get_c2e(K_name, params, surf, surf_quad_order, check_r, equiv_r)
+                    out.append((
+                        K_name, order, check_r, equiv_r,
+                        time.time() - start, was_cached
+                    ))
+    return out
+
+def main(args):
+    import argparse
+    from tectosaur.fmm.cfg import equivalent_kernels
+    parser = argparse.ArgumentParser(
+        prog = 'python -m tectosaur.fmm.c2e',
+        description = 'Precompute the FMM check to equivalent operators into '
+            'the on-disk c2e cache.'
+    )
+    parser.add_argument('--kernels', nargs = '+', default = list(equivalent_kernels))
+    parser.add_argument('--orders', type = int, nargs = '+', default = [1, 2],
+        help = 'refinement orders of the sphere surfaces')
+    parser.add_argument('--params', type = float, nargs = '*', default = [1.0, 0.25])
+    parser.add_argument('--inner-r', type = float, default = 1.1)
+    parser.add_argument('--outer-r', type = float, nargs = '+', default = [3.0])
+    parser.add_argument('--surf-quad-order', type = int, default = 4)
+    opts = parser.parse_args(args)
+
+    if not use_c2e_cache:
+        print('TECTOSAUR_C2E_CACHE=0, nothing will be stored')
+    results = precompute(
+        opts.kernels, opts.orders, opts.params, opts.inner_r, opts.outer_r,
+        opts.surf_quad_order
+    )
+    for K_name, order, check_r, equiv_r, took, was_cached in results:
+        print('{} order {}, check r {}, equiv r {}: {} {:.2f}s'.format(
+            K_name, order, check_r, equiv_r,
+            'cached' if was_cached else 'computed', took
+        ))
+    print(disk_cache.report([c2e_cache]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
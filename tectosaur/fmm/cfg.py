@@ -20,7 +20,7 @@ def get_traversal_module(K):
     else:
         return get_dim_module(K.spatial_dim).octree
 
-def get_gpu_module(surf, quad, K, float_type, n_workers_per_block):
+def get_gpu_module(surf, quad, surf_quad, K, float_type, n_workers_per_block):
     args = dict(
         n_workers_per_block = n_workers_per_block,
         gpu_float_type = gpu.np_to_c_type(float_type),
@@ -28,6 +28,8 @@ def get_gpu_module(surf, quad, K, float_type, n_workers_per_block):
         surf_tris = surf[1],
         quad_pts = quad[0],
         quad_wts = quad[1],
+        surf_quad_pts = surf_quad[0],
+        surf_quad_wts = surf_quad[1],
         K = K
     )
     gpu_module = gpu.load_gpu(
@@ -36,17 +38,39 @@ def get_gpu_module(surf, quad, K, float_type, n_workers_per_block):
     )
     return gpu_module
 
+# The check and equivalent surfaces represent the far field of a source box
+# with elasticU3 densities. For the elastic kernels with a normal vector on the
+# source or observation side, the check surfaces see the sources through the
+# displacement kernel (U or T) and the targets see the equivalent densities
+# through the matching observation side kernel (U or A). Every other kernel uses
+# itself for all the operators.
+equivalent_kernels = dict(
+    elasticU3 = ('elasticU3', 'elasticU3', 'elasticU3'),
+    elasticT3 = ('elasticT3', 'elasticU3', 'elasticU3'),
+    elasticA3 = ('elasticU3', 'elasticU3', 'elasticA3'),
+    elasticH3 = ('elasticT3', 'elasticU3', 'elasticA3'),
+)
+
+def get_op_kernels(K_name):
+    check_K, equiv_K, eval_K = equivalent_kernels.get(K_name, (K_name,) * 3)
+    return dict(
+        p2p = kernels[K_name], p2s = kernels[check_K],
+        s2s = kernels[equiv_K], s2p = kernels[eval_K]
+    )
+
 @attr.s
 class FMMConfig:
     K = attr.ib()
     params = attr.ib()
     surf = attr.ib()
     quad = attr.ib()
+    surf_quad_order = attr.ib()
     outer_r = attr.ib()
     inner_r = attr.ib()
     alpha = attr.ib()
     float_type = attr.ib()
-    gpu_module = attr.ib()
+    op_kernels = attr.ib()
+    gpu_modules = attr.ib()
     traversal_module = attr.ib()
     n_workers_per_block = attr.ib()
     treecode = attr.ib()
@@ -54,26 +78,41 @@ class FMMConfig:
 
 def make_config(K_name, params, inner_r, outer_r, order, quad_order,
         float_type, alpha = 1e-5, n_workers_per_block = 256,
-        treecode = False, force_order = None):
+        treecode = False, force_order = None, surf_quad_order = 4):
+
+    # The host backend runs the work items of a block serially, so the local
+    # memory cooperation in tri_gpu_kernels.cl needs one worker per block.
+    if gpu.cpu_backend:
+        n_workers_per_block = 1
 
     K = kernels[K_name]
     quad = gauss4d_tri(quad_order, quad_order)
+    surf_quad = gauss4d_tri(surf_quad_order, surf_quad_order)
     surf = make_sphere((0.0, 0.0, 0.0), 1.0, order)
     order = surf[1].shape[0]
     if force_order is not None:
         order = force_order
     if len(params) == 0:
         params = [0.0]
+    op_kernels = get_op_kernels(K_name)
+    gpu_modules = {
+        op_K.name: get_gpu_module(
+            surf, quad, surf_quad, op_K, float_type, n_workers_per_block
+        )
+        for op_K in op_kernels.values()
+    }
     return FMMConfig(
         K = K,
         params = np.array(params),
         surf = surf,
         quad = quad,
+        surf_quad_order = surf_quad_order,
         outer_r = outer_r,
         inner_r = inner_r,
         alpha = alpha,
         float_type = float_type,
-        gpu_module = get_gpu_module(surf, quad, K, float_type, n_workers_per_block),
+        op_kernels = op_kernels,
+        gpu_modules = gpu_modules,
         traversal_module = get_traversal_module(K),
         n_workers_per_block = n_workers_per_block,
         treecode = treecode,
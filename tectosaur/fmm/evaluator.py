@@ -139,7 +139,7 @@ class FMMEvaluator:
             out_arr, self.c2e_scratch,
             np.int32(n_nodes), np.int32(n_c2e_rows),
             gd[name + '_obs_n_idxs'][level], gd[src_obs + '_n_R'],
-            np.float32(self.fmm.cfg.alpha),
+            self.fmm.cfg.float_type(self.fmm.cfg.alpha),
             gd[name + '_V'], gd[name + '_E'],
             grid = (n_node_blocks, n_c2e_row_blocks, 1),
             block = (block_size, block_size, 1)
@@ -15,6 +15,8 @@ CONSTANT Real surf_pts[${surf_pts.size}] = {${str(surf_pts.flatten().tolist())[1
 CONSTANT int surf_tris[${surf_tris.size}] = {${str(surf_tris.flatten().tolist())[1:-1]}};
 CONSTANT Real quad_pts[${quad_pts.size}] = {${str(quad_pts.flatten().tolist())[1:-1]}};
 CONSTANT Real quad_wts[${quad_wts.size}] = {${str(quad_wts.flatten().tolist())[1:-1]}};
+CONSTANT Real surf_quad_pts[${surf_quad_pts.size}] = {${str(surf_quad_pts.flatten().tolist())[1:-1]}};
+CONSTANT Real surf_quad_wts[${surf_quad_wts.size}] = {${str(surf_quad_wts.flatten().tolist())[1:-1]}};
 
 <%def name="func_def(op_name, obs_type, src_type)">
 KERNEL
@@ -162,7 +164,7 @@ for (int chunk_start = src_start_idx;
     LOCAL_BARRIER;
 </%def>
 
-<%def name="src_inner_loop(src_type, check_r2_zero)">
+<%def name="src_inner_loop(src_type, check_r2_zero, quad)">
 if (obs_tri_idx < obs_tri_max) {
     int chunk_j_max = min(${n_workers_per_block}, src_end_idx - chunk_start);
     for (int chunk_j = 0; chunk_j < chunk_j_max; chunk_j++) {
@@ -189,13 +191,13 @@ if (obs_tri_idx < obs_tri_max) {
             in[k] = sh_input[chunk_j][k];
         }
 
-        for (int iq = 0; iq < ${quad_wts.shape[0]}; iq++) {
+        for (int iq = 0; iq < ${context[quad + '_wts'].shape[0]}; iq++) {
             //TODO: this is shared with direct_tris.cl
-            Real obsxhat = quad_pts[iq * 4 + 0];
-            Real obsyhat = quad_pts[iq * 4 + 1];
-            Real srcxhat = quad_pts[iq * 4 + 2];
-            Real srcyhat = quad_pts[iq * 4 + 3];
-            Real quadw = quad_wts[iq];
+            Real obsxhat = ${quad}_pts[iq * 4 + 0];
+            Real obsyhat = ${quad}_pts[iq * 4 + 1];
+            Real srcxhat = ${quad}_pts[iq * 4 + 2];
+            Real srcyhat = ${quad}_pts[iq * 4 + 3];
+            Real quadw = ${quad}_wts[iq];
 
             % for which, ptname in [("obs", "x"), ("src", "y")]:
                 ${prim.basis(which)}
@@ -252,6 +254,9 @@ if (obs_tri_idx < obs_tri_max) {
 }
 </%def>
 
+// The direct interactions use the farfield quadrature (quad_pts). Interactions
+// with a check or equivalent surface use surf_quad_pts, which should match the
+// quadrature the c2e operators were built with.
 <%def name="fmm_op(op_name, obs_type, src_type, check_r2_zero)">
 ${func_def(op_name, obs_type, src_type)}
 {
@@ -265,7 +270,8 @@ ${func_def(op_name, obs_type, src_type)}
 
         ${obs_loop(obs_type)}
             ${start_outer_src_loop(src_type)}
-                ${src_inner_loop(src_type, check_r2_zero)}
+                ${src_inner_loop(src_type, check_r2_zero,
+                    "quad" if obs_type == "pts" and src_type == "pts" else "surf_quad")}
             ${finish_outer_src_loop()}
         ${sum_to_global(obs_type)}
 }
@@ -317,7 +323,7 @@ void c2e_kernel2(GLOBAL_MEM Real* out, GLOBAL_MEM Real* in,
     for (int j = 0; j < n_rows; j++) {
         Real Vv = V[row_idx * n_rows + j];
         Real Ev = E[j];
-        Real REv = pow(R, ${K.scale_type} + 4) * Ev;
+        Real REv = pow(R, ${-K.scale_type}) * Ev;
         Real invEv = REv / (REv * REv + alpha * alpha);
         sum2 += Vv * invEv * in[node_idx * n_rows + j];
     }
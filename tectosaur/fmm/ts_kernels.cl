@@ -4,6 +4,15 @@ def dn(dim):
 from tectosaur.kernels import kernels
 e = [[[int((i - j) * (j - k) * (k - i) / 2) for k in range(3)]
     for j in range(3)] for i in range(3)]
+
+# The (base, shifted, dim) moment triples where the shifted moment is the base
+# moment weighted by the source point's offset from the expansion center in
+# dimension dim. Moving an expansion from center c to c' adds
+# (c - c')[dim] * base to shifted.
+def shifted_moments(K):
+    if K.name == "elasticRH3":
+        return [(10 + j, 13 + d * 3 + j, d) for j in range(3) for d in range(3)]
+    return [(3, 4 + d, d) for d in range(3)]
 %>
 <%
     multipole_dim = K.multipole_dim
@@ -11,107 +20,111 @@ e = [[[int((i - j) * (j - k) * (k - i) / 2) for k in range(3)]
 ${cluda_preamble}
 
 <%def name="p2m_core(n, m, real, imag)">
+for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
     %if K.name == "elasticU3":
         % for dobs in range(3):
-            sumreal[${n}][${m}][${dobs}] += ${real} * invals[${dobs}];
-            sumimag[${n}][${m}][${dobs}] += ${imag} * invals[${dobs}];
+            sumreal[rhs][${n}][${m}][${dobs}] += ${real} * invals[rhs][${dobs}];
+            sumimag[rhs][${n}][${m}][${dobs}] += ${imag} * invals[rhs][${dobs}];
         % endfor
     % elif K.name == "elasticRT3":
         % for dobs in range(3):
             % for dsrc in range(3):
                 % for j in range(3):
-                    sumreal[${n}][${m}][${dobs}] += (
-                        ${e[dobs][dsrc][j]} * ${real} * src_surf_curl[${dsrc}][${j}]
+                    sumreal[rhs][${n}][${m}][${dobs}] += (
+                        ${e[dobs][dsrc][j]} * ${real} * src_surf_curl[rhs][${dsrc}][${j}]
                     );
-                    sumimag[${n}][${m}][${dobs}] += (
-                        ${e[dobs][dsrc][j]} * ${imag} * src_surf_curl[${dsrc}][${j}]
+                    sumimag[rhs][${n}][${m}][${dobs}] += (
+                        ${e[dobs][dsrc][j]} * ${imag} * src_surf_curl[rhs][${dsrc}][${j}]
                     );
                 % endfor
             % endfor
         % endfor
     % elif K.name == "elasticRA3":
         % for dsrc in range(3):
-            sumreal[${n}][${m}][${dsrc}] += ${real} * invals[${dsrc}];
-            sumimag[${n}][${m}][${dsrc}] += ${imag} * invals[${dsrc}];
+            sumreal[rhs][${n}][${m}][${dsrc}] += ${real} * invals[rhs][${dsrc}];
+            sumimag[rhs][${n}][${m}][${dsrc}] += ${imag} * invals[rhs][${dsrc}];
         % endfor
     % elif K.name == "elasticRH3":
         % for dsrc in range(3):
-            sumreal[${n}][${m}][0] += ${real} * src_surf_curl[${dsrc}][${dsrc}];
-            sumimag[${n}][${m}][0] += ${imag} * src_surf_curl[${dsrc}][${dsrc}];
+            sumreal[rhs][${n}][${m}][0] += ${real} * src_surf_curl[rhs][${dsrc}][${dsrc}];
+            sumimag[rhs][${n}][${m}][0] += ${imag} * src_surf_curl[rhs][${dsrc}][${dsrc}];
         % endfor
         % for dobs in range(3):
             % for j in range(3):
-                sumreal[${n}][${m}][1 + ${dobs * 3 + j}] += (
-                    ${real} * src_surf_curl[${dobs}][${j}]
+                sumreal[rhs][${n}][${m}][1 + ${dobs * 3 + j}] += (
+                    ${real} * src_surf_curl[rhs][${dobs}][${j}]
                 );
-                sumimag[${n}][${m}][1 + ${dobs * 3 + j}] += (
-                    ${imag} * src_surf_curl[${dobs}][${j}]
+                sumimag[rhs][${n}][${m}][1 + ${dobs * 3 + j}] += (
+                    ${imag} * src_surf_curl[rhs][${dobs}][${j}]
                 );
             % endfor
         % endfor
     % endif
+}
 </%def>
 
 <%def name="p2md_core(dsn, dsm, d_idx, real, imag)">
+for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
 {
     % if K.name == "elasticU3":
-        sumreal[${dsn}][${dsm}][3] += ${real} * invals[${d_idx}];
-        sumimag[${dsn}][${dsm}][3] += ${imag} * invals[${d_idx}];
+        sumreal[rhs][${dsn}][${dsm}][3] += ${real} * invals[rhs][${d_idx}];
+        sumimag[rhs][${dsn}][${dsm}][3] += ${imag} * invals[rhs][${d_idx}];
         % for dobs in range(3):
-            sumreal[${dsn}][${dsm}][4 + ${dobs}] += (
-                D${dn(dobs)} * ${real} * invals[${d_idx}]
+            sumreal[rhs][${dsn}][${dsm}][4 + ${dobs}] += (
+                D${dn(dobs)} * ${real} * invals[rhs][${d_idx}]
             );
-            sumimag[${dsn}][${dsm}][4 + ${dobs}] += (
-                D${dn(dobs)} * ${imag} * invals[${d_idx}]
+            sumimag[rhs][${dsn}][${dsm}][4 + ${dobs}] += (
+                D${dn(dobs)} * ${imag} * invals[rhs][${d_idx}]
             );
         % endfor
     % elif K.name == "elasticRT3":
         % for j in range(3):
             % for dsrc in range(3):
-                sumreal[${dsn}][${dsm}][3] += (
-                    ${e[j][d_idx][dsrc]} * ${real} * src_surf_curl[${dsrc}][${j}]
+                sumreal[rhs][${dsn}][${dsm}][3] += (
+                    ${e[j][d_idx][dsrc]} * ${real} * src_surf_curl[rhs][${dsrc}][${j}]
                 );
-                sumimag[${dsn}][${dsm}][3] += (
-                    ${e[j][d_idx][dsrc]} * ${imag} * src_surf_curl[${dsrc}][${j}]
+                sumimag[rhs][${dsn}][${dsm}][3] += (
+                    ${e[j][d_idx][dsrc]} * ${imag} * src_surf_curl[rhs][${dsrc}][${j}]
                 );
             % endfor
         % endfor
         % for dobs in range(3):
             % for j in range(3):
                 % for dsrc in range(3):
-                    sumreal[${dsn}][${dsm}][4 + ${dobs}] += (
+                    sumreal[rhs][${dsn}][${dsm}][4 + ${dobs}] += (
                         ${e[j][d_idx][dsrc]} * D${dn(dobs)} * ${real} 
-                        * src_surf_curl[${dsrc}][${j}]
+                        * src_surf_curl[rhs][${dsrc}][${j}]
                     );
-                    sumimag[${dsn}][${dsm}][4 + ${dobs}] += (
+                    sumimag[rhs][${dsn}][${dsm}][4 + ${dobs}] += (
                         ${e[j][d_idx][dsrc]} * D${dn(dobs)} * ${imag} 
-                        * src_surf_curl[${dsrc}][${j}]
+                        * src_surf_curl[rhs][${dsrc}][${j}]
                     );
                 % endfor
             % endfor
         % endfor
     % elif K.name == "elasticRA3":
-        sumreal[${dsn}][${dsm}][3] += ${real} * invals[${d_idx}];
-        sumimag[${dsn}][${dsm}][3] += ${imag} * invals[${d_idx}];
+        sumreal[rhs][${dsn}][${dsm}][3] += ${real} * invals[rhs][${d_idx}];
+        sumimag[rhs][${dsn}][${dsm}][3] += ${imag} * invals[rhs][${d_idx}];
         % for p in range(3):
-            sumreal[${dsn}][${dsm}][4 + ${p}] += (
-                D${dn(p)} * ${real} * invals[${d_idx}]
+            sumreal[rhs][${dsn}][${dsm}][4 + ${p}] += (
+                D${dn(p)} * ${real} * invals[rhs][${d_idx}]
             );
-            sumimag[${dsn}][${dsm}][4 + ${p}] += (
-                D${dn(p)} * ${imag} * invals[${d_idx}]
+            sumimag[rhs][${dsn}][${dsm}][4 + ${p}] += (
+                D${dn(p)} * ${imag} * invals[rhs][${d_idx}]
             );
         % endfor
     % elif K.name == "elasticRH3":
         % for j in range(3):
-            sumreal[${dsn}][${dsm}][10 + ${j}] += ${real} * src_surf_curl[${d_idx}][${j}];
-            sumimag[${dsn}][${dsm}][10 + ${j}] += ${imag} * src_surf_curl[${d_idx}][${j}];
+            sumreal[rhs][${dsn}][${dsm}][10 + ${j}] += ${real} * src_surf_curl[rhs][${d_idx}][${j}];
+            sumimag[rhs][${dsn}][${dsm}][10 + ${j}] += ${imag} * src_surf_curl[rhs][${d_idx}][${j}];
             % for dobs in range(3):
-                sumreal[${dsn}][${dsm}][13 + ${dobs * 3 + j}] += D${dn(dobs)} * ${real} * src_surf_curl[${d_idx}][${j}];
-                sumimag[${dsn}][${dsm}][13 + ${dobs * 3 + j}] += D${dn(dobs)} * ${imag} * src_surf_curl[${d_idx}][${j}];
+                sumreal[rhs][${dsn}][${dsm}][13 + ${dobs * 3 + j}] += D${dn(dobs)} * ${real} * src_surf_curl[rhs][${d_idx}][${j}];
+                sumimag[rhs][${dsn}][${dsm}][13 + ${dobs * 3 + j}] += D${dn(dobs)} * ${imag} * src_surf_curl[rhs][${d_idx}][${j}];
             % endfor
         % endfor
     % endif
 }
+}
 </%def>
 
 <%def name="m2m_core()">
@@ -119,13 +132,13 @@ ${cluda_preamble}
     %for d in range(7):
     {
         ${get_child_multipoles(d)}
-        sumreal[ni][mi][${d}] += realval;
-        sumimag[ni][mi][${d}] += imagval;
+        sumreal[rhs][ni][mi][${d}] += realval;
+        sumimag[rhs][ni][mi][${d}] += imagval;
         % if d == 3:
             % for d2 in range(3):
             {
-                sumreal[ni][mi][${4 + d2}] += D${dn(d2)} * realval;
-                sumimag[ni][mi][${4 + d2}] += D${dn(d2)} * imagval;
+                sumreal[rhs][ni][mi][${4 + d2}] += D${dn(d2)} * realval;
+                sumimag[rhs][ni][mi][${4 + d2}] += D${dn(d2)} * imagval;
             }
             % endfor
         % endif
@@ -135,25 +148,25 @@ ${cluda_preamble}
     % for d in range(10):
     {
         ${get_child_multipoles(d)}
-        sumreal[ni][mi][${d}] += realval;
-        sumimag[ni][mi][${d}] += imagval;
+        sumreal[rhs][ni][mi][${d}] += realval;
+        sumimag[rhs][ni][mi][${d}] += imagval;
     }
     % endfor
     % for j in range(3):
     {
         ${get_child_multipoles(10 + j)}
-        sumreal[ni][mi][${10 + j}] += realval;
-        sumimag[ni][mi][${10 + j}] += imagval;
+        sumreal[rhs][ni][mi][${10 + j}] += realval;
+        sumimag[rhs][ni][mi][${10 + j}] += imagval;
         % for dobs in range(3):
-            sumreal[ni][mi][${13 + dobs * 3 + j}] += D${dn(dobs)} * realval;
-            sumimag[ni][mi][${13 + dobs * 3 + j}] += D${dn(dobs)} * imagval;
+            sumreal[rhs][ni][mi][${13 + dobs * 3 + j}] += D${dn(dobs)} * realval;
+            sumimag[rhs][ni][mi][${13 + dobs * 3 + j}] += D${dn(dobs)} * imagval;
         % endfor
 
         % for dobs in range(3):
         {
             ${get_child_multipoles(13 + dobs * 3 + j)}
-            sumreal[ni][mi][${13 + dobs * 3 + j}] += realval;
-            sumimag[ni][mi][${13 + dobs * 3 + j}] += imagval;
+            sumreal[rhs][ni][mi][${13 + dobs * 3 + j}] += realval;
+            sumimag[rhs][ni][mi][${13 + dobs * 3 + j}] += imagval;
         }
         % endfor
     }
@@ -162,6 +175,7 @@ ${cluda_preamble}
 </%def>
 
 <%def name="m2p_core(n, real, imag)">
+for (int rhs = 0; rhs < ${n_rhs}; rhs++)
 {
     % if K.name == "elasticU3":
         Real mult = 1.0;
@@ -174,13 +188,12 @@ ${cluda_preamble}
             Real real_val = C * (${real});
             Real imag_val = C * (${imag});
             for (int d = 0; d < 3; d++) {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + d * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + d * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
-                sum[d] += Rr * real_val + Ri * imag_val;
+                sum[rhs][d] += Rr * real_val + Ri * imag_val;
             }
         }
 
@@ -189,24 +202,22 @@ ${cluda_preamble}
             Real real_val = C * (${real}); 
             Real imag_val = C * (${imag}); 
 
-            int idx = 
-                (${n}) * ${multipole_dim * 2 * (order + 1)} 
-                + mi * ${multipole_dim * 2} 
-                + 3 * 2;
+            int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + 3 * ${2 * n_rhs} + rhs * 2;
             Real Rr = sh_multipoles[idx];
             Real Ri = sh_multipoles[idx + 1];
             Real Aval = Rr * real_val + Ri * imag_val;
             % for d1 in range(3):
             {
-                int idx = 
-                    (${n}) * ${multipole_dim * 2 * (order + 1)} 
-                    + mi * ${multipole_dim * 2} 
-                    + (4 + ${d1}) * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + (4 + ${d1}) * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real Bval = Rr * real_val + Ri * imag_val;
 
-                sum[${d1}] += D${dn(d1)} * Aval - Bval;
+                sum[rhs][${d1}] += D${dn(d1)} * Aval - Bval;
             }
             % endfor
         }
@@ -221,13 +232,12 @@ ${cluda_preamble}
             Real real_val = C * (${real});
             Real imag_val = C * (${imag});
             for (int d = 0; d < 3; d++) {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + d * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + d * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
-                sum[d] += Rr * real_val + Ri * imag_val;
+                sum[rhs][d] += Rr * real_val + Ri * imag_val;
             }
         }
 
@@ -237,24 +247,22 @@ ${cluda_preamble}
             Real real_val = C * (${real}); 
             Real imag_val = C * (${imag}); 
 
-            int idx = 
-                (${n}) * ${multipole_dim * 2 * (order + 1)} 
-                + mi * ${multipole_dim * 2} 
-                + 3 * 2;
+            int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + 3 * ${2 * n_rhs} + rhs * 2;
             Real Rr = sh_multipoles[idx];
             Real Ri = sh_multipoles[idx + 1];
             Real Aval = Rr * real_val + Ri * imag_val;
             % for d1 in range(3):
             {
-                int idx = 
-                    (${n}) * ${multipole_dim * 2 * (order + 1)} 
-                    + mi * ${multipole_dim * 2} 
-                    + (4 + ${d1}) * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + (4 + ${d1}) * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real Bval = Rr * real_val + Ri * imag_val;
 
-                sum[${d1}] += D${dn(d1)} * Aval - Bval;
+                sum[rhs][${d1}] += D${dn(d1)} * Aval - Bval;
             }
             % endfor
         }
@@ -270,10 +278,9 @@ ${cluda_preamble}
             Real imag_val = C * (${imag});
             % for dsrc in range(3):
             {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + ${dsrc} * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + ${dsrc} * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real SR = Rr * real_val + Ri * imag_val;
@@ -285,7 +292,7 @@ ${cluda_preamble}
                                 * bobs_surf_curl[bobs][${j}] 
                                 * SR
                             );
-                            basissum[bobs][${dobs}] += term;
+                            basissum[rhs][bobs][${dobs}] += term;
                         }
                     % endfor
                 % endfor
@@ -298,26 +305,24 @@ ${cluda_preamble}
             Real real_val = C * (${real}); 
             Real imag_val = C * (${imag}); 
 
-            int idx = 
-                (${n}) * ${multipole_dim * 2 * (order + 1)} 
-                + mi * ${multipole_dim * 2} 
-                + 3 * 2;
+            int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + 3 * ${2 * n_rhs} + rhs * 2;
             Real Rr = sh_multipoles[idx];
             Real Ri = sh_multipoles[idx + 1];
             Real Aval = Rr * real_val + Ri * imag_val;
             % for p in range(3):
             {
-                int idx = 
-                    (${n}) * ${multipole_dim * 2 * (order + 1)} 
-                    + mi * ${multipole_dim * 2} 
-                    + (4 + ${p}) * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + (4 + ${p}) * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real Bval = Rr * real_val + Ri * imag_val;
                 % for dobs in range(3):
                 % for j in range(3):
                     for (int bobs = 0; bobs < 3; bobs++) {
-                        basissum[bobs][${dobs}] += (
+                        basissum[rhs][bobs][${dobs}] += (
                             ${e[j][p][dobs]} 
                             * (D${dn(p)} * Aval - Bval) 
                             * bobs_surf_curl[bobs][${j}]
@@ -338,16 +343,15 @@ ${cluda_preamble}
             Real real_val = C * (${real});
             Real imag_val = C * (${imag});
             {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + 0 * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + 0 * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real SR = CsRH1 * (Rr * real_val + Ri * imag_val);
                 % for dobs in range(3):
                     for (int bobs = 0; bobs < 3; bobs++) {
-                        basissum[bobs][${dobs}] += bobs_surf_curl[bobs][${dobs}] * SR;
+                        basissum[rhs][bobs][${dobs}] += bobs_surf_curl[bobs][${dobs}] * SR;
                     }
                 % endfor
             }
@@ -355,16 +359,15 @@ ${cluda_preamble}
             % for dobs in range(3):
             % for j in range(3):
             {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + (1 + ${dobs * 3 + j}) * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + (1 + ${dobs * 3 + j}) * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real SR = Rr * real_val + Ri * imag_val;
                 for (int bobs = 0; bobs < 3; bobs++) {
-                    basissum[bobs][${dobs}] -= 2 * bobs_surf_curl[bobs][${j}] * SR;
-                    basissum[bobs][${j}] += CsRH2 * bobs_surf_curl[bobs][${dobs}] * SR;
+                    basissum[rhs][bobs][${dobs}] -= 2 * bobs_surf_curl[bobs][${j}] * SR;
+                    basissum[rhs][bobs][${j}] += CsRH2 * bobs_surf_curl[bobs][${dobs}] * SR;
                 }
             }
             % endfor
@@ -372,16 +375,15 @@ ${cluda_preamble}
 
             % for j in range(3):
             {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + (10 + ${j}) * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + (10 + ${j}) * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real SR = Rr * real_val + Ri * imag_val;
                 % for dobs in range(3):
                 for (int bobs = 0; bobs < 3; bobs++) {
-                    basissum[bobs][${dobs}] -= 2 * D${dn(dobs)} * bobs_surf_curl[bobs][${j}] * SR;
+                    basissum[rhs][bobs][${dobs}] -= 2 * D${dn(dobs)} * bobs_surf_curl[bobs][${j}] * SR;
                 }
                 % endfor
             }
@@ -390,15 +392,14 @@ ${cluda_preamble}
             % for dobs in range(3):
             % for j in range(3):
             {
-                int idx =
-                    (${n}) * ${multipole_dim * 2 * (order + 1)}
-                    + mi * ${multipole_dim} * 2
-                    + (13 + ${dobs * 3 + j}) * 2;
+                int idx = (${n}) * ${multipole_dim * 2 * (order + 1) * n_rhs}
+                    + mi * ${multipole_dim * 2 * n_rhs}
+                    + (13 + ${dobs * 3 + j}) * ${2 * n_rhs} + rhs * 2;
                 Real Rr = sh_multipoles[idx];
                 Real Ri = sh_multipoles[idx + 1];
                 Real SR = Rr * real_val + Ri * imag_val;
                 for (int bobs = 0; bobs < 3; bobs++) {
-                    basissum[bobs][${dobs}] += 2 * bobs_surf_curl[bobs][${j}] * SR;
+                    basissum[rhs][bobs][${dobs}] += 2 * bobs_surf_curl[bobs][${j}] * SR;
                 }
             }
             % endfor
@@ -418,11 +419,12 @@ ${prim.geometry_fncs()}
 CONSTANT Real quad_pts[${quad_pts.size}] = {${str(quad_pts.flatten().tolist())[1:-1]}};
 CONSTANT Real quad_wts[${quad_wts.size}] = {${str(quad_wts.flatten().tolist())[1:-1]}};
 
-<%def name="multipole_idx(node_idx, n_idx, m_idx, d_idx)">
-    (${node_idx} * ${multipole_dim * 2 * (order + 1) * (order + 1)}
-    + ${n_idx} * ${multipole_dim * 2 * (order + 1)}
-    + ${m_idx} * ${multipole_dim * 2}
-    + ${d_idx} * 2)
+<%def name="multipole_idx(node_idx, n_idx, m_idx, d_idx, rhs_idx)">
+    (${node_idx} * ${multipole_dim * 2 * (order + 1) * (order + 1) * n_rhs}
+    + ${n_idx} * ${multipole_dim * 2 * (order + 1) * n_rhs}
+    + ${m_idx} * ${multipole_dim * 2 * n_rhs}
+    + ${d_idx} * ${2 * n_rhs}
+    + ${rhs_idx} * 2)
 </%def>
 
 KERNEL void p2p(
@@ -447,6 +449,9 @@ KERNEL void p2p(
         return;
     }
     const int block_idx = obs_tri_block_idxs[obs_tri_idx];
+    if (block_idx < 0) {
+        return;
+    }
     const int this_obs_n_idx = block_idx;
     const int this_obs_src_start = obs_src_starts[block_idx];
     const int this_obs_src_end = obs_src_starts[block_idx + 1];
@@ -457,9 +462,11 @@ KERNEL void p2p(
     ${prim.decl_tri_info("obs", K.needs_obsn, K.surf_curl_obs)}
     ${prim.tri_info("obs", "obs_pts", "obs_tris", K.needs_obsn, K.surf_curl_obs)}
 
-    Real sum[9];
-    for (int d = 0; d < 9; d++) {
-        sum[d] = 0.0;
+    Real sum_rhs[${n_rhs}][9];
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int d = 0; d < 9; d++) {
+            sum_rhs[rhs][d] = 0.0;
+        }
     }
 
     for (int src_block_idx = this_obs_src_start;
@@ -475,9 +482,11 @@ KERNEL void p2p(
             ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
             ${prim.tri_info("src", "src_pts", "src_tris", K.needs_srcn, K.surf_curl_src)}
 
-            Real in[9];
+            Real in_rhs[${n_rhs}][9];
             for (int k = 0; k < 9; k++) {
-                in[k] = inarr[src_tri_idx * 9 + k];
+                for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                    in_rhs[rhs][k] = inarr[(src_tri_idx * 9 + k) * ${n_rhs} + rhs];
+                }
             }
 
             for (int iq1 = 0; iq1 < ${quad_wts.shape[0]}; iq1++) {
@@ -507,27 +516,42 @@ KERNEL void p2p(
                     % endif
 
                     Real factor = obs_jacobian * src_jacobian * quadw;
-                    % for d in range(3):
-                        Real sum${dn(d)} = 0.0;
-                        Real in${dn(d)} = 0.0;
-                        for (int b_src = 0; b_src < 3; b_src++) {
-                            in${dn(d)} += in[b_src * 3 + ${d}] * srcb[b_src];
+                    // The geometry above is shared by all the right hand
+                    // sides. The kernel code reads in and adds to sum.
+                    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                        Real in[9];
+                        Real sum[9];
+                        for (int k = 0; k < 9; k++) {
+                            in[k] = in_rhs[rhs][k];
+                            sum[k] = sum_rhs[rhs][k];
                         }
-                    % endfor
+                        % for d in range(3):
+                            Real sum${dn(d)} = 0.0;
+                            Real in${dn(d)} = 0.0;
+                            for (int b_src = 0; b_src < 3; b_src++) {
+                                in${dn(d)} += in[b_src * 3 + ${d}] * srcb[b_src];
+                            }
+                        % endfor
 
-                    ${prim.call_vector_code(K)}
+                        ${prim.call_vector_code(K)}
 
-                    for (int b_obs = 0; b_obs < 3; b_obs++) {
-                        % for d_obs in range(3):
-                        sum[b_obs * 3 + ${d_obs}] += factor * obsb[b_obs] * sum${dn(d_obs)};
-                        % endfor
+                        for (int b_obs = 0; b_obs < 3; b_obs++) {
+                            % for d_obs in range(3):
+                            sum[b_obs * 3 + ${d_obs}] += factor * obsb[b_obs] * sum${dn(d_obs)};
+                            % endfor
+                        }
+                        for (int k = 0; k < 9; k++) {
+                            sum_rhs[rhs][k] = sum[k];
+                        }
                     }
                 }
             }
         }
     }
     for (int k = 0; k < 9; k++) {
-        out[obs_tri_idx * 9 + k] = sum[k];
+        for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+            out[(obs_tri_idx * 9 + k) * ${n_rhs} + rhs] = sum_rhs[rhs][k];
+        }
     }
 }
 
@@ -589,12 +613,14 @@ KERNEL void p2p(
 </%def>
 
 <%def name="finish_multipole_sum()">
-    for (int i = 0; i < ${order + 1}; i++) {
-        for (int j = 0; j < ${order + 1}; j++) {
-            for (int d = 0; d < ${multipole_dim}; d++) {
-                int idx = ${multipole_idx("this_obs_n_idx", "i", "j", "d")};
-                multipoles[idx] = sumreal[i][j][d];
-                multipoles[idx + 1] = sumimag[i][j][d];
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int i = 0; i < ${order + 1}; i++) {
+            for (int j = 0; j < ${order + 1}; j++) {
+                for (int d = 0; d < ${multipole_dim}; d++) {
+                    int idx = ${multipole_idx("this_obs_n_idx", "i", "j", "d", "rhs")};
+                    multipoles[idx] = sumreal[rhs][i][j][d];
+                    multipoles[idx + 1] = sumimag[rhs][i][j][d];
+                }
             }
         }
     }
@@ -622,14 +648,16 @@ KERNEL void p2m(
     Real xy = n_centers[this_obs_n_idx * 3 + 1];
     Real xz = n_centers[this_obs_n_idx * 3 + 2];
 
-    Real sumreal[${order + 1}][${order + 1}][${multipole_dim}];
-    Real sumimag[${order + 1}][${order + 1}][${multipole_dim}];
+    Real sumreal[${n_rhs}][${order + 1}][${order + 1}][${multipole_dim}];
+    Real sumimag[${n_rhs}][${order + 1}][${order + 1}][${multipole_dim}];
 
-    for (int i = 0; i < ${order + 1}; i++) {
-        for (int j = 0; j < ${order + 1}; j++) {
-            for (int d = 0; d < ${multipole_dim}; d++) {
-                sumreal[i][j][d] = 0.0;
-                sumimag[i][j][d] = 0.0;
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int i = 0; i < ${order + 1}; i++) {
+            for (int j = 0; j < ${order + 1}; j++) {
+                for (int d = 0; d < ${multipole_dim}; d++) {
+                    sumreal[rhs][i][j][d] = 0.0;
+                    sumimag[rhs][i][j][d] = 0.0;
+                }
             }
         }
     }
@@ -641,9 +669,11 @@ KERNEL void p2m(
         const int src_tri_rot_clicks = 0;
         ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
         ${prim.tri_info("src", "src_pts", "src_tris", K.needs_srcn, K.surf_curl_src)}
-        Real in[9];
+        Real in[${n_rhs}][9];
         for (int k = 0; k < 9; k++) {
-            in[k] = src_in[src_tri_idx * 9 + k];
+            for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                in[rhs][k] = src_in[(src_tri_idx * 9 + k) * ${n_rhs} + rhs];
+            }
         }
 
         for (int iq = 0; iq < ${quad_wts.shape[0]}; iq++) {
@@ -663,25 +693,29 @@ KERNEL void p2m(
             Real r2 = Dx * Dx + Dy * Dy + Dz * Dz;
 
             Real factor = src_jacobian * quadw;
-            Real invals[3];
-            for (int d = 0; d < 3; d++) {
-                invals[d] = 0.0;
-                for (int b_src = 0; b_src < 3; b_src++) {
-                    invals[d] += factor * in[b_src * 3 + d] * srcb[b_src];
+            Real invals[${n_rhs}][3];
+            for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                for (int d = 0; d < 3; d++) {
+                    invals[rhs][d] = 0.0;
+                    for (int b_src = 0; b_src < 3; b_src++) {
+                        invals[rhs][d] += factor * in[rhs][b_src * 3 + d] * srcb[b_src];
+                    }
                 }
             }
 
 
             % if K.surf_curl_src:
-                Real src_surf_curl[3][3];
-                for (int d = 0; d < 3; d++) {
-                    for (int Ij = 0; Ij < 3; Ij++) {
-                        src_surf_curl[d][Ij] = 0.0;
-                        for (int b_src = 0; b_src < 3; b_src++) {
-                            src_surf_curl[d][Ij] += 
-                                factor * 
-                                bsrc_surf_curl[b_src][Ij]
-                                * in[b_src * 3 + d];
+                Real src_surf_curl[${n_rhs}][3][3];
+                for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                    for (int d = 0; d < 3; d++) {
+                        for (int Ij = 0; Ij < 3; Ij++) {
+                            src_surf_curl[rhs][d][Ij] = 0.0;
+                            for (int b_src = 0; b_src < 3; b_src++) {
+                                src_surf_curl[rhs][d][Ij] += 
+                                    factor * 
+                                    bsrc_surf_curl[b_src][Ij]
+                                    * in[rhs][b_src * 3 + d];
+                            }
                         }
                     }
                 }
@@ -719,8 +753,8 @@ KERNEL void p2m(
 }
 
 <%def name="get_child_multipoles(d)">
-    Real child_real = multipoles[start_idx + ${d} * 2 + 0];
-    Real child_imag = multipoles[start_idx + ${d} * 2 + 1];
+    Real child_real = multipoles[start_idx + ${d} * ${2 * n_rhs} + rhs * 2 + 0];
+    Real child_imag = multipoles[start_idx + ${d} * ${2 * n_rhs} + rhs * 2 + 1];
     if (mi_diff < 0 && mi_diff % 2 == 0) {
         child_imag *= -1;
     } else if (mi_diff < 0 && mi_diff % 2 != 0) {
@@ -749,10 +783,10 @@ for (int ni = (${nip}); ni <= ${order}; ni++) {
 
             int mi_diff = mi - full_mip;
             int pos_mi_diff = abs(mi_diff);
-            int start_idx = this_src_n_idx * ${multipole_dim * 2 * (order + 1) * (order + 1)}
-                + (ni_diff) * ${multipole_dim * 2 * (order + 1)}
-                + (pos_mi_diff) * ${multipole_dim * 2};
-            {
+            int start_idx = ${multipole_idx(
+                "this_src_n_idx", "(ni_diff)", "(pos_mi_diff)", "0", "0"
+            )};
+            for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
                 ${m2m_core()}
             }
         }
@@ -782,14 +816,16 @@ KERNEL void m2m(
     Real xz = n_centers[this_obs_n_idx * 3 + 2];
 
     //TODO: Could Kahan summation be helpful?
-    Real sumreal[${order + 1}][${order + 1}][${multipole_dim}];
-    Real sumimag[${order + 1}][${order + 1}][${multipole_dim}];
-
-    for (int i = 0; i < ${order + 1}; i++) {
-        for (int j = 0; j < ${order + 1}; j++) {
-            for (int d = 0; d < ${multipole_dim}; d++) {
-                sumreal[i][j][d] = 0.0;
-                sumimag[i][j][d] = 0.0;
+    Real sumreal[${n_rhs}][${order + 1}][${order + 1}][${multipole_dim}];
+    Real sumimag[${n_rhs}][${order + 1}][${order + 1}][${multipole_dim}];
+
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int i = 0; i < ${order + 1}; i++) {
+            for (int j = 0; j < ${order + 1}; j++) {
+                for (int d = 0; d < ${multipole_dim}; d++) {
+                    sumreal[rhs][i][j][d] = 0.0;
+                    sumimag[rhs][i][j][d] = 0.0;
+                }
             }
         }
     }
@@ -841,9 +877,272 @@ KERNEL void m2m(
 }
 
 
-KERNEL void m2p_U(
-    GLOBAL_MEM Real* out,
+<%def name="zero_expansion_sum()">
+    Real sumreal[${n_rhs}][${order + 1}][${order + 1}][${multipole_dim}];
+    Real sumimag[${n_rhs}][${order + 1}][${order + 1}][${multipole_dim}];
+
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int i = 0; i < ${order + 1}; i++) {
+            for (int j = 0; j < ${order + 1}; j++) {
+                for (int d = 0; d < ${multipole_dim}; d++) {
+                    sumreal[rhs][i][j][d] = 0.0;
+                    sumimag[rhs][i][j][d] = 0.0;
+                }
+            }
+        }
+    }
+</%def>
+
+<%def name="add_expansion_sum(expansions)">
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int i = 0; i < ${order + 1}; i++) {
+            for (int j = 0; j < ${order + 1}; j++) {
+                for (int d = 0; d < ${multipole_dim}; d++) {
+                    int idx = ${multipole_idx("this_obs_n_idx", "i", "j", "d", "rhs")};
+                    ${expansions}[idx] += sumreal[rhs][i][j][d];
+                    ${expansions}[idx + 1] += sumimag[rhs][i][j][d];
+                }
+            }
+        }
+    }
+</%def>
+
+<%def name="neg_m(m, real, imag)">
+    // X_n^{-m} = (-1)^m conj(X_n^m)
+    if (${m} < 0 && ${m} % 2 == 0) {
+        ${imag} *= -1;
+    } else if (${m} < 0 && ${m} % 2 != 0) {
+        ${real} *= -1;
+    }
+</%def>
+
+<%def name="load_shifted_expansion(expansions, n_idx)">
+    // Loads term (nip, mip) of the expansion about (yx, yy, yz) and moves
+    // the center dependent moments to the center (xx, xy, xz).
+    int pos_mip = abs(mip);
+    int start_idx = ${multipole_idx(n_idx, "nip", "pos_mip", "0", "0")};
+    Real Er[${n_rhs}][${multipole_dim}];
+    Real Ei[${n_rhs}][${multipole_dim}];
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int d = 0; d < ${multipole_dim}; d++) {
+            Er[rhs][d] = ${expansions}[start_idx + d * ${2 * n_rhs} + rhs * 2];
+            Ei[rhs][d] = ${expansions}[start_idx + d * ${2 * n_rhs} + rhs * 2 + 1];
+            ${neg_m("mip", "Er[rhs][d]", "Ei[rhs][d]")}
+        }
+        % for base, shifted, d in shifted_moments(K):
+            Er[rhs][${shifted}] -= D${dn(d)} * Er[rhs][${base}];
+            Ei[rhs][${shifted}] -= D${dn(d)} * Ei[rhs][${base}];
+        % endfor
+    }
+</%def>
+
+<%def name="expansion_terms(n_max, real_arr, imag_arr, singular)">
+    // The m >= 0 terms of ${"S" if singular else "R"}(D) up to degree ${n_max}.
+    {
+        Real r2 = Dx * Dx + Dy * Dy + Dz * Dz;
+        % if singular:
+            Real invr2 = 1.0 / r2;
+            Real Xsr = sqrt(invr2);
+        % else:
+            Real Xsr = 1.0;
+        % endif
+        Real Xsi = 0.0;
+        for (int mi = 0; mi < ${n_max + 1}; mi++) {
+            ${real_arr}[mi][mi] = Xsr;
+            ${imag_arr}[mi][mi] = Xsi;
+
+            Real Xm2r = 0.0;
+            Real Xm2i = 0.0;
+            Real Xm1r = Xsr;
+            Real Xm1i = Xsi;
+            for (int ni = mi; ni < ${n_max}; ni++) {
+                Real t1f = (2 * ni + 1) * Dz;
+                % if singular:
+                    Real t2f = ni * ni - mi * mi;
+                    Real Xvr = invr2 * (t1f * Xm1r - t2f * Xm2r);
+                    Real Xvi = invr2 * (t1f * Xm1i - t2f * Xm2i);
+                % else:
+                    Real factor = 1.0 / ((ni + 1) * (ni + 1) - mi * mi);
+                    Real Xvr = factor * (t1f * Xm1r - r2 * Xm2r);
+                    Real Xvi = factor * (t1f * Xm1i - r2 * Xm2i);
+                % endif
+                ${real_arr}[ni + 1][mi] = Xvr;
+                ${imag_arr}[ni + 1][mi] = Xvi;
+
+                Xm2r = Xm1r;
+                Xm2i = Xm1i;
+                Xm1r = Xvr;
+                Xm1i = Xvi;
+            }
+            Real Xsrold = Xsr;
+            Real Xsiold = Xsi;
+            % if singular:
+                Real F = (2 * mi + 1) * invr2;
+            % else:
+                Real F = 1.0 / (2 * (mi + 1));
+            % endif
+            Xsr = F * (Dx * Xsrold - Dy * Xsiold);
+            Xsi = F * (Dx * Xsiold + Dy * Xsrold);
+        }
+    }
+</%def>
+
+// The multipole to local translation:
+// L_n^m = (-1)^n sum_{n',m'} conj(S_{n+n'}^{m+m'}(x - y)) M_{n'}^{m'}
+// where x is the local center and y is the multipole center. The m2l
+// interaction lists are passed for m2l. Since every source cell has a
+// multipole expansion, the p2l lists are also handled here.
+KERNEL void m2l(
+    GLOBAL_MEM Real* locals,
     GLOBAL_MEM Real* multipoles,
+    int n_blocks,
+    GLOBAL_MEM int* obs_n_idxs,
+    GLOBAL_MEM int* obs_src_starts,
+    GLOBAL_MEM int* src_n_idxs,
+    GLOBAL_MEM Real* obs_n_centers,
+    GLOBAL_MEM Real* src_n_centers)
+{
+    const int global_idx = get_global_id(0); 
+    const int block_idx = global_idx;
+    if (block_idx >= n_blocks) {
+        return;
+    }
+    const int this_obs_n_idx = obs_n_idxs[block_idx];
+    const int this_obs_src_start = obs_src_starts[block_idx];
+    const int this_obs_src_end = obs_src_starts[block_idx + 1];
+
+    Real xx = obs_n_centers[this_obs_n_idx * 3 + 0];
+    Real xy = obs_n_centers[this_obs_n_idx * 3 + 1];
+    Real xz = obs_n_centers[this_obs_n_idx * 3 + 2];
+
+    ${zero_expansion_sum()}
+
+    Real Sr[${2 * order + 1}][${2 * order + 1}];
+    Real Si[${2 * order + 1}][${2 * order + 1}];
+
+    for (int src_block_idx = this_obs_src_start;
+         src_block_idx < this_obs_src_end;
+         src_block_idx++) 
+    {
+        const int this_src_n_idx = src_n_idxs[src_block_idx];
+
+        Real yx = src_n_centers[this_src_n_idx * 3 + 0];
+        Real yy = src_n_centers[this_src_n_idx * 3 + 1];
+        Real yz = src_n_centers[this_src_n_idx * 3 + 2];
+
+        Real Dx = xx - yx;
+        Real Dy = xy - yy; 
+        Real Dz = xz - yz;
+
+        ${expansion_terms(2 * order, "Sr", "Si", True)}
+
+        for (int nip = 0; nip <= ${order}; nip++) {
+            for (int mip = -nip; mip <= nip; mip++) {
+                ${load_shifted_expansion("multipoles", "this_src_n_idx")}
+                for (int ni = 0; ni <= ${order}; ni++) {
+                    Real sign = (ni % 2 == 0) ? 1.0 : -1.0;
+                    for (int mi = 0; mi <= ni; mi++) {
+                        int Sn = ni + nip;
+                        int Sm = mi + mip;
+                        int pos_Sm = abs(Sm);
+                        if (pos_Sm > Sn) {
+                            continue;
+                        }
+                        Real Sreal = Sr[Sn][pos_Sm];
+                        Real Simag = Si[Sn][pos_Sm];
+                        ${neg_m("Sm", "Sreal", "Simag")}
+                        Sreal *= sign;
+                        Simag *= -sign;
+                        for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                            for (int d = 0; d < ${multipole_dim}; d++) {
+                                sumreal[rhs][ni][mi][d] += Sreal * Er[rhs][d] - Simag * Ei[rhs][d];
+                                sumimag[rhs][ni][mi][d] += Sreal * Ei[rhs][d] + Simag * Er[rhs][d];
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    ${add_expansion_sum("locals")}
+}
+
+// The local to local translation from a parent cell at x to a child at x':
+// L'_n^m = sum_{n',m'} R_{n'-n}^{m'-m}(x' - x) L_{n'}^{m'}
+KERNEL void l2l(
+    GLOBAL_MEM Real* locals,
+    int n_blocks,
+    GLOBAL_MEM int* obs_n_idxs,
+    GLOBAL_MEM int* obs_src_starts,
+    GLOBAL_MEM int* src_n_idxs,
+    GLOBAL_MEM Real* n_centers)
+{
+    const int global_idx = get_global_id(0); 
+    const int block_idx = global_idx;
+    if (block_idx >= n_blocks) {
+        return;
+    }
+    const int this_obs_n_idx = obs_n_idxs[block_idx];
+    const int this_obs_src_start = obs_src_starts[block_idx];
+    const int this_obs_src_end = obs_src_starts[block_idx + 1];
+
+    Real xx = n_centers[this_obs_n_idx * 3 + 0];
+    Real xy = n_centers[this_obs_n_idx * 3 + 1];
+    Real xz = n_centers[this_obs_n_idx * 3 + 2];
+
+    ${zero_expansion_sum()}
+
+    Real Rr[${order + 1}][${order + 1}];
+    Real Ri[${order + 1}][${order + 1}];
+
+    for (int src_block_idx = this_obs_src_start;
+         src_block_idx < this_obs_src_end;
+         src_block_idx++) 
+    {
+        const int this_src_n_idx = src_n_idxs[src_block_idx];
+
+        Real yx = n_centers[this_src_n_idx * 3 + 0];
+        Real yy = n_centers[this_src_n_idx * 3 + 1];
+        Real yz = n_centers[this_src_n_idx * 3 + 2];
+
+        Real Dx = xx - yx;
+        Real Dy = xy - yy; 
+        Real Dz = xz - yz;
+
+        ${expansion_terms(order, "Rr", "Ri", False)}
+
+        for (int nip = 0; nip <= ${order}; nip++) {
+            for (int mip = -nip; mip <= nip; mip++) {
+                ${load_shifted_expansion("locals", "this_src_n_idx")}
+                for (int ni = 0; ni <= nip; ni++) {
+                    for (int mi = 0; mi <= ni; mi++) {
+                        int Rn = nip - ni;
+                        int Rm = mip - mi;
+                        int pos_Rm = abs(Rm);
+                        if (pos_Rm > Rn) {
+                            continue;
+                        }
+                        Real Rreal = Rr[Rn][pos_Rm];
+                        Real Rimag = Ri[Rn][pos_Rm];
+                        ${neg_m("Rm", "Rreal", "Rimag")}
+                        for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                            for (int d = 0; d < ${multipole_dim}; d++) {
+                                sumreal[rhs][ni][mi][d] += Rreal * Er[rhs][d] - Rimag * Ei[rhs][d];
+                                sumimag[rhs][ni][mi][d] += Rreal * Ei[rhs][d] + Rimag * Er[rhs][d];
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    ${add_expansion_sum("locals")}
+}
+
+<%def name="expansion_to_pts(name, local)">
+KERNEL void ${name}(
+    GLOBAL_MEM Real* out,
+    GLOBAL_MEM Real* expansions,
     GLOBAL_MEM Real* params,
     int n_blocks,
     GLOBAL_MEM int* obs_n_idxs,
@@ -853,7 +1152,7 @@ KERNEL void m2p_U(
     GLOBAL_MEM int* obs_n_ends,
     GLOBAL_MEM Real* pts,
     GLOBAL_MEM int* tris,
-    GLOBAL_MEM Real* src_n_centers)
+    GLOBAL_MEM Real* exp_n_centers)
 {
     const int global_idx = get_group_id(0); 
     const int worker_idx = get_local_id(0);
@@ -865,7 +1164,7 @@ KERNEL void m2p_U(
     ${K.constants_code}
 
     <%
-        multipoles_per_cell = (order + 1) ** 2 * multipole_dim * 2
+        multipoles_per_cell = (order + 1) ** 2 * multipole_dim * 2 * n_rhs
     %>
     LOCAL_MEM Real sh_multipoles[${multipoles_per_cell}];
 
@@ -873,7 +1172,7 @@ KERNEL void m2p_U(
     int n_end = obs_n_ends[this_obs_n_idx];
     int n_tris = n_end - n_start;
     int n_outer_idxs = n_tris * ${quad_wts.shape[0]};
-    % if ocl_backend:
+    % if not cuda_backend:
         int outer_idx_loop_max = n_outer_idxs;
     % else:
         int outer_idx_loop_max = ceil(((float)n_outer_idxs) / ((float)${n_workers_per_block}));
@@ -886,12 +1185,14 @@ KERNEL void m2p_U(
         int iq = outer_idx % ${quad_wts.shape[0]};
         int obs_tri_idx = n_start + (outer_idx - iq) / ${quad_wts.shape[0]};
 
-        Real sum[3];
-        Real basissum[3][3];
-        for (int d1 = 0; d1 < 3; d1++) {
-            sum[d1] = 0.0;
-            for (int d2 = 0; d2 < 3; d2++) {
-                basissum[d1][d2] = 0.0;
+        Real sum[${n_rhs}][3];
+        Real basissum[${n_rhs}][3][3];
+        for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+            for (int d1 = 0; d1 < 3; d1++) {
+                sum[rhs][d1] = 0.0;
+                for (int d2 = 0; d2 < 3; d2++) {
+                    basissum[rhs][d1][d2] = 0.0;
+                }
             }
         }
 
@@ -931,7 +1232,7 @@ KERNEL void m2p_U(
                 multipole_idx += ${n_workers_per_block}) 
             {
                 int full_arr_idx = this_src_n_idx * ${multipoles_per_cell} + multipole_idx;
-                sh_multipoles[multipole_idx] = multipoles[full_arr_idx];
+                sh_multipoles[multipole_idx] = expansions[full_arr_idx];
             }
             LOCAL_BARRIER;
 
@@ -940,14 +1241,45 @@ KERNEL void m2p_U(
             }
 
             //TODO: is it worth preloading centers? probably not, not memory constrained
-            Real yx = src_n_centers[this_src_n_idx * 3 + 0];
-            Real yy = src_n_centers[this_src_n_idx * 3 + 1];
-            Real yz = src_n_centers[this_src_n_idx * 3 + 2];
+            Real yx = exp_n_centers[this_src_n_idx * 3 + 0];
+            Real yy = exp_n_centers[this_src_n_idx * 3 + 1];
+            Real yz = exp_n_centers[this_src_n_idx * 3 + 2];
 
             Real Dx = xx - yx;
             Real Dy = xy - yy; 
             Real Dz = xz - yz;
             Real r2 = Dx * Dx + Dy * Dy + Dz * Dz;
+
+            % if local:
+            // A local expansion sums L * R rather than M * conj(S), so the
+            // conjugate of R is passed to m2p_core.
+            Real Rsr = 1.0;
+            Real Rsi = 0.0;
+            for (int mi = 0; mi < ${order + 1}; mi++) {
+                ${m2p_core("mi", "Rsr", "-Rsi")}
+
+                Real Rm2r = 0.0;
+                Real Rm2i = 0.0;
+                Real Rm1r = Rsr;
+                Real Rm1i = Rsi;
+                for (int ni = mi; ni < ${order}; ni++) {
+                    Real factor = 1.0 / ((ni + 1) * (ni + 1) - mi * mi);
+                    Real t1f = (2 * ni + 1) * Dz;
+                    Real Rvr = factor * (t1f * Rm1r - r2 * Rm2r);
+                    Real Rvi = factor * (t1f * Rm1i - r2 * Rm2i);
+                    ${m2p_core("ni + 1", "Rvr", "-Rvi")}
+
+                    Rm2r = Rm1r;
+                    Rm2i = Rm1i;
+                    Rm1r = Rvr;
+                    Rm1i = Rvi;
+                }
+                Real Rsrold = Rsr;
+                Real Rsiold = Rsi;
+                Rsr = (Dx * Rsrold - Dy * Rsiold) / (2 * (mi + 1));
+                Rsi = (Dx * Rsiold + Dy * Rsrold) / (2 * (mi + 1));
+            }
+            % else:
             Real invr2 = 1.0 / r2;
 
             Real Ssr = sqrt(invr2);
@@ -977,27 +1309,34 @@ KERNEL void m2p_U(
                 Ssr = F * (Dx * Ssrold - Dy * Ssiold);
                 Ssi = F * (Dx * Ssiold + Dy * Ssrold);
             }
+            % endif
         }
 
-        for (int d1 = 0; d1 < 3; d1++) {
-            for (int d2 = 0; d2 < 3; d2++) {
-                basissum[d1][d2] += obsb[d1] * sum[d2];
+        for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+            for (int d1 = 0; d1 < 3; d1++) {
+                for (int d2 = 0; d2 < 3; d2++) {
+                    basissum[rhs][d1][d2] += obsb[d1] * sum[rhs][d2];
+                }
             }
         }
 
         if (outer_idx < n_outer_idxs) {
-            for (int d1 = 0; d1 < 3; d1++) {
-                for (int d2 = 0; d2 < 3; d2++) {
-                    % if ocl_backend:
-                        out[obs_tri_idx * 9 + d1 * 3 + d2] += basissum[d1][d2];
-                    % else:
-                        atomicAdd(
-                            &out[obs_tri_idx * 9 + d1 * 3 + d2],
-                            basissum[d1][d2]
-                        );
-                    % endif
+            for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                for (int d1 = 0; d1 < 3; d1++) {
+                    for (int d2 = 0; d2 < 3; d2++) {
+                        int out_idx = (obs_tri_idx * 9 + d1 * 3 + d2) * ${n_rhs} + rhs;
+                        % if not cuda_backend:
+                            out[out_idx] += basissum[rhs][d1][d2];
+                        % else:
+                            atomicAdd(&out[out_idx], basissum[rhs][d1][d2]);
+                        % endif
+                    }
                 }
             }
         }
     }
 }
+</%def>
+
+${expansion_to_pts("m2p_U", False)}
+${expansion_to_pts("l2p", True)}
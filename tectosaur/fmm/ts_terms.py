@@ -261,3 +261,44 @@ def Sderivs(n_max, y, d):
                 imag[i, n_max + j] = -Svi[i + 1, (n_max + 1) + j]
     return real, imag
 
+
+def m2l(n_max, Mreal, Mimag, y):
+    # Translates a multipole expansion to a local expansion about a center
+    # displaced by y from the multipole center:
+    # L_n^m = (-1)^n sum_{n',m'} conj(S_{n+n'}^{m+m'}(y)) M_{n'}^{m'}
+    Svr, Svi = S(2 * n_max, y)
+    Lreal = np.zeros((n_max + 1, 2 * n_max + 1))
+    Limag = np.zeros((n_max + 1, 2 * n_max + 1))
+    for i in range(n_max + 1):
+        for j in range(-i, i + 1):
+            for ip in range(n_max + 1):
+                for jp in range(-ip, ip + 1):
+                    if abs(j + jp) > i + ip:
+                        continue
+                    sr = Svr[i + ip, 2 * n_max + j + jp]
+                    si = -Svi[i + ip, 2 * n_max + j + jp]
+                    mr = Mreal[ip, n_max + jp]
+                    mi = Mimag[ip, n_max + jp]
+                    Lreal[i, n_max + j] += ((-1) ** i) * (sr * mr - si * mi)
+                    Limag[i, n_max + j] += ((-1) ** i) * (sr * mi + si * mr)
+    return Lreal, Limag
+
+def l2l(n_max, Lreal, Limag, y):
+    # Translates a local expansion to a center displaced by y:
+    # L'_n^m = sum_{n',m'} R_{n'-n}^{m'-m}(y) L_{n'}^{m'}
+    Rvr, Rvi = R(n_max, y)
+    outreal = np.zeros((n_max + 1, 2 * n_max + 1))
+    outimag = np.zeros((n_max + 1, 2 * n_max + 1))
+    for i in range(n_max + 1):
+        for j in range(-i, i + 1):
+            for ip in range(i, n_max + 1):
+                for jp in range(-ip, ip + 1):
+                    if abs(jp - j) > ip - i:
+                        continue
+                    rr = Rvr[ip - i, n_max + jp - j]
+                    ri = Rvi[ip - i, n_max + jp - j]
+                    lr = Lreal[ip, n_max + jp]
+                    li = Limag[ip, n_max + jp]
+                    outreal[i, n_max + j] += rr * lr - ri * li
+                    outimag[i, n_max + j] += rr * li + ri * lr
+    return outreal, outimag
@@ -8,50 +8,316 @@ import tectosaur.util.gpu as gpu
 from tectosaur.util.cpp import imp
 traversal_ext = imp("tectosaur.fmm.traversal_wrapper")
 
-traversal_module = traversal_ext.three.octree
+def traversal_module():
+    return traversal_ext.three.octree
 
 import logging
 logger = logging.getLogger(__name__)
 
-# TODO: If I ever want this to be full FMM instead of treecode, I need to:
-# -- implement the p2l and l2p operators, pretty much the same way I did the p2m/m2p
-#    go from one source tri to one obs tri
-# -- implement the m2l operator, go from one source tri to one obs tri
-# -- implement the l2l operator
+# By default, TSFMM is a treecode: the multipole expansions of source cells are
+# evaluated directly at the observation points (m2p). With treecode = False,
+# it is a full FMM: the multipoles are translated to local expansions of the
+# observation cells (m2l), passed down the observation tree (l2l) and
+# evaluated at the observation points of the leaves (l2p). The traversal
+# uses the same MAC for the observation and source cells then, since the m2l
+# error depends on both radii. The local expansions are stored in the same
+# layout as the multipoles.
 
 def make_tree(m, max_pts_per_cell):
     tri_pts = m[0][m[1]]
     centers = np.mean(tri_pts, axis = 1)
     pt_dist = tri_pts - centers[:,np.newaxis,:]
     Rs = np.max(np.linalg.norm(pt_dist, axis = 2), axis = 1)
-    tree = traversal_module.Tree.build(centers, Rs, max_pts_per_cell)
+    tree = traversal_module().Tree.build(centers, Rs, max_pts_per_cell)
     return tree
 
+# The FMM setup is split into a plan and a kernel binding. The plan holds
+# everything that only depends on the geometry: the trees, the interaction
+# lists, the tree-ordered triangles and their GPU buffers. It depends on the
+# meshes, mac, max_pts_per_cell and treecode, but not on the kernel, its
+# parameters or the expansion order, so TSFMM objects for H and T on the same
+# mesh can share one plan (see MeshContext.fmm_plan). A plan is plain numpy
+# arrays, so it can be saved with save and read back with load_plan.
+
+single_ops = ['p2p', 'p2m', 'p2l', 'm2p', 'm2l', 'l2p']
+level_ops = ['m2m', 'l2l']
+list_fields = ['obs_n_idxs', 'obs_src_starts', 'src_n_idxs']
+int_tree_fields = ['tris', 'n_start', 'n_end']
+float_tree_fields = ['pts', 'n_C']
+
+class InteractionList:
+    def __init__(self, obs_n_idxs, obs_src_starts, src_n_idxs):
+        self.obs_n_idxs = obs_n_idxs
+        self.obs_src_starts = obs_src_starts
+        self.src_n_idxs = src_n_idxs
+
+class PlanInteractions:
+    def __init__(self, arrays):
+        for name in single_ops:
+            setattr(self, name, InteractionList(
+                *[arrays[name + '_' + f] for f in list_fields]
+            ))
+        for name in level_ops:
+            setattr(self, name, [
+                InteractionList(*[arrays[name + str(i) + '_' + f] for f in list_fields])
+                for i in range(int(arrays['n_' + name]))
+            ])
+
+def make_plan(obs_m, src_m, mac, max_pts_per_cell, treecode = True,
+        obs_tree = None, src_tree = None):
+    """
+    The TSFMMPlan for the meshes obs_m and src_m. Prebuilt trees for obs_m and
+    src_m can be passed as obs_tree and src_tree.
+    """
+    if obs_tree is None:
+        obs_tree = make_tree(obs_m, max_pts_per_cell)
+    if src_tree is None:
+        src_tree = make_tree(src_m, max_pts_per_cell)
+
+    inner_r = 1.0 if treecode else mac
+    interactions = traversal_module().fmmmm_interactions(
+        obs_tree, src_tree, inner_r, mac, 0, treecode
+    )
+
+    arrays = dict()
+    for name, m, tree in [('obs', obs_m, obs_tree), ('src', src_m, src_tree)]:
+        orig_idxs = np.array(tree.orig_idxs)
+        nodes = tree.nodes
+        arrays[name + '_pts'] = np.array(m[0])
+        arrays[name + '_tris'] = np.array(m[1][orig_idxs])
+        arrays[name + '_orig_idxs'] = orig_idxs
+        arrays[name + '_n_C'] = np.array(tree.node_centers)
+        arrays[name + '_n_start'] = np.array([n.start for n in nodes])
+        arrays[name + '_n_end'] = np.array([n.end for n in nodes])
+        arrays[name + '_max_height'] = np.array(tree.max_height)
+
+    def add_op(name, op):
+        for f in list_fields:
+            arrays[name + '_' + f] = np.array(getattr(op, f), dtype = np.int32)
+    for name in single_ops:
+        add_op(name, getattr(interactions, name))
+    for name in level_ops:
+        ops = getattr(interactions, name)
+        arrays['n_' + name] = np.array(len(ops))
+        for i, op in enumerate(ops):
+            add_op(name + str(i), op)
+
+    return TSFMMPlan(arrays, mac, max_pts_per_cell, treecode)
+
+def load_plan(filename):
+    with np.load(filename) as data:
+        arrays = {k: data[k] for k in data.files}
+    cfg = [arrays.pop(k) for k in ['mac', 'max_pts_per_cell', 'treecode']]
+    return TSFMMPlan(
+        arrays, float(cfg[0]), int(cfg[1]), bool(cfg[2])
+    )
+
+class TSFMMPlan:
+    def __init__(self, arrays, mac, max_pts_per_cell, treecode):
+        self.arrays = arrays
+        for a in arrays.values():
+            a.setflags(write = False)
+        self.mac = mac
+        self.max_pts_per_cell = max_pts_per_cell
+        self.treecode = treecode
+        self.interactions = PlanInteractions(arrays)
+        self.n_obs_tris = arrays['obs_tris'].shape[0]
+        self.n_src_tris = arrays['src_tris'].shape[0]
+        self.obs_n_nodes = arrays['obs_n_C'].shape[0]
+        self.src_n_nodes = arrays['src_n_C'].shape[0]
+        self.obs_tri_block_idx = self.p2p_obs_tri_block_idx()
+        self.int_gpu_data = None
+        self.float_gpu_data = dict()
+        self.device_data = dict()
+
+    def save(self, filename):
+        np.savez(
+            filename, mac = self.mac, max_pts_per_cell = self.max_pts_per_cell,
+            treecode = self.treecode, **self.arrays
+        )
+
+    def obs_n_sizes(self):
+        return self.arrays['obs_n_end'] - self.arrays['obs_n_start']
+
+    def src_n_sizes(self):
+        return self.arrays['src_n_end'] - self.arrays['src_n_start']
+
+    def p2p_obs_tri_block_idx(self):
+        obs_tri_block_idx = -1 * np.ones(self.n_obs_tris, dtype = np.int64)
+        p2p_obs_n_idxs = self.interactions.p2p.obs_n_idxs
+        starts = self.arrays['obs_n_start']
+        ends = self.arrays['obs_n_end']
+        for block_idx in range(p2p_obs_n_idxs.shape[0]):
+            n_idx = p2p_obs_n_idxs[block_idx]
+            start = starts[n_idx]
+            end = ends[n_idx]
+            assert(np.all(obs_tri_block_idx[start:end] == -1))
+            obs_tri_block_idx[start:end] = block_idx
+        return obs_tri_block_idx
+
+    def count_interactions(self, op_name, n_surf):
+        # The same count as the C++ count_interactions: an expansion counts as
+        # n_surf points and a cell's triangles each count as one.
+        op = getattr(self.interactions, op_name)
+        level_ops = op if type(op) is list else [op]
+        obs_sizes = self.obs_n_sizes()
+        src_sizes = self.src_n_sizes()
+        n = 0
+        for level_op in level_ops:
+            starts = level_op.obs_src_starts
+            if level_op.obs_n_idxs.shape[0] == 0:
+                continue
+            obs_n_idxs = np.repeat(level_op.obs_n_idxs, np.diff(starts))
+            src_n_idxs = level_op.src_n_idxs[starts[0]:starts[-1]]
+            n_obs = np.full(src_n_idxs.shape[0], n_surf, dtype = np.int64)
+            n_src = np.full(src_n_idxs.shape[0], n_surf, dtype = np.int64)
+            if op_name[2] == 'p':
+                n_obs = obs_sizes[obs_n_idxs]
+            if op_name[0] == 'p':
+                n_src = src_sizes[src_n_idxs]
+            n += int(np.sum(n_obs * n_src))
+        return n
+
+    def gpu_data(self, float_type):
+        """
+        The GPU buffers of the plan, for float_type. The integer buffers are
+        shared by all float types.
+        """
+        if self.int_gpu_data is None:
+            gd = dict()
+            for name in ['obs', 'src']:
+                for f in int_tree_fields:
+                    gd[name + '_' + f] = gpu.to_gpu(self.arrays[name + '_' + f], np.int32)
+            for name in single_ops:
+                self.op_to_gpu(gd, name, getattr(self.interactions, name))
+            for name in level_ops:
+                for i, op in enumerate(getattr(self.interactions, name)):
+                    self.op_to_gpu(gd, name + str(i), op)
+            self.int_gpu_data = gd
+
+        key = np.dtype(float_type).str
+        if key not in self.float_gpu_data:
+            self.float_gpu_data[key] = {
+                name + '_' + f: gpu.to_gpu(self.arrays[name + '_' + f], float_type)
+                for name in ['obs', 'src'] for f in float_tree_fields
+            }
+
+        gd = dict(self.int_gpu_data)
+        gd.update(self.float_gpu_data[key])
+        return gd
+
+    def op_to_gpu(self, gd, name, op):
+        for f in list_fields:
+            gd[name + '_' + f] = gpu.to_gpu(getattr(op, f), np.int32)
+
+    def split_across_devices(self):
+        # The upward pass (p2m, m2m) runs on the first device. The p2p and m2p
+        # interactions are split by observation cell, so each device writes
+        # to its own output array and the results are summed on the host.
+        n_devices = gpu.n_devices()
+        if n_devices in self.device_data:
+            return self.device_data[n_devices]
+        obs_n_sizes = self.obs_n_sizes()
+
+        p2p = self.interactions.p2p
+        p2p_splits = gpu.split_work(
+            obs_n_sizes[p2p.obs_n_idxs] * np.diff(p2p.obs_src_starts), n_devices
+        )
+
+        m2p = self.interactions.m2p
+        m2p_obs_n_idxs = m2p.obs_n_idxs
+        m2p_starts = m2p.obs_src_starts
+        m2p_splits = gpu.split_work(
+            obs_n_sizes[m2p_obs_n_idxs] * np.diff(m2p_starts), n_devices
+        )
+
+        device_data = []
+        for (p2p_start, p2p_end), (m2p_start, m2p_end) in zip(p2p_splits, m2p_splits):
+            block_idx = self.obs_tri_block_idx.copy()
+            block_idx[(block_idx < p2p_start) | (block_idx >= p2p_end)] = -1
+            device_data.append(dict(
+                n_p2p = p2p_end - p2p_start,
+                p2p_obs_tri_block_idx = gpu.to_gpu(block_idx, np.int32),
+                n_m2p = m2p_end - m2p_start,
+                m2p_obs_n_idxs = gpu.to_gpu(
+                    m2p_obs_n_idxs[m2p_start:m2p_end], np.int32
+                ),
+                m2p_obs_src_starts = gpu.to_gpu(
+                    m2p_starts[m2p_start:(m2p_end + 1)], np.int32
+                )
+            ))
+        self.device_data[n_devices] = device_data
+        return device_data
+
 class TSFMM:
     def __init__(self, obs_m, src_m, **kwargs):
-        if gpu.ocl_backend:
+        if not gpu.cuda_backend:
             kwargs['n_workers_per_block'] = 1
 
+        # A TSFMMPlan can be passed as plan. Otherwise, one is made for obs_m
+        # and src_m, from the prebuilt trees obs_tree and src_tree if they
+        # are passed.
+        plan = kwargs.pop('plan', None)
+        obs_tree = kwargs.pop('obs_tree', None)
+        src_tree = kwargs.pop('src_tree', None)
         self.cfg = kwargs
+        if plan is None:
+            self.cfg.setdefault('treecode', True)
+            plan = make_plan(
+                obs_m, src_m, self.cfg['mac'], self.cfg['max_pts_per_cell'],
+                self.cfg['treecode'], obs_tree, src_tree
+            )
+        else:
+            for k in ['mac', 'max_pts_per_cell', 'treecode']:
+                if self.cfg.setdefault(k, getattr(plan, k)) != getattr(plan, k):
+                    raise ValueError(
+                        'TSFMM {} = {} differs from the plan\'s {}'.format(
+                            k, self.cfg[k], getattr(plan, k)
+                        )
+                    )
+        self.plan = plan
+        self.interactions = plan.interactions
         self.K = kernels[self.cfg['K_name']]
         self.obs_m = obs_m
         self.src_m = src_m
-        self.obs_tree = make_tree(self.obs_m, self.cfg['max_pts_per_cell'])
-        self.src_tree = make_tree(self.src_m, self.cfg['max_pts_per_cell'])
-        self.gpu_data = dict()
 
-        self.setup_interactions()
         self.setup_output_sizes()
+        self.gpu_data = plan.gpu_data(self.cfg['float_type'])
         self.params_to_gpu()
-        self.tree_to_gpu()
-        self.interactions_to_gpu()
-        self.load_gpu_module()
-        self.setup_arrays()
-
+        self.device_data = plan.split_across_devices()
+        self.setup_max_rhs()
+        self.rhs_setups = dict()
+        self.use_rhs(1)
+
+    def setup_max_rhs(self):
+        # dot also takes a block of right hand sides, v of shape (n, k). The
+        # kernels handle up to max_rhs of them at once. The inputs, outputs
+        # and expansions of all of them are stored together, so the tree
+        # traversal, the index loads and the translation coefficients of
+        # each interaction are shared. The m2p and l2p kernels keep the
+        # expansions of a cell for every right hand side in local memory, so
+        # max_rhs is also limited by the local memory the device has per
+        # block.
+        self.cfg.setdefault('max_rhs', 8)
+        itemsize = np.dtype(self.cfg['float_type']).itemsize
+        cell_bytes = self.n_multipoles // max(self.plan.src_n_nodes, 1) * itemsize
+        local_mem = gpu.device_memory()['local_mem']
+        self.max_rhs = max(1, min(self.cfg['max_rhs'], local_mem // cell_bytes))
+
+    def use_rhs(self, n_rhs):
+        # The module and arrays for n_rhs right hand sides, made the first
+        # time they're needed.
+        if n_rhs not in self.rhs_setups:
+            self.rhs_setups[n_rhs] = (
+                (self.load_gpu_module(n_rhs),) + self.setup_arrays(n_rhs)
+            )
+        self.n_rhs = n_rhs
+        (self.gpu_module, self.gpu_multipoles, self.gpu_locals,
+            self.gpu_outs, self.gpu_in) = self.rhs_setups[n_rhs]
 
-    def load_gpu_module(self):
+    def load_gpu_module(self, n_rhs):
         quad = gauss2d_tri(self.cfg['quad_order'])
-        self.gpu_module = gpu.load_gpu(
+        return gpu.load_gpu(
             'fmm/ts_kernels.cl',
             tmpl_args = dict(
                 order = self.cfg['order'],
@@ -59,16 +325,11 @@ class TSFMM:
                 quad_pts = quad[0],
                 quad_wts = quad[1],
                 n_workers_per_block = self.cfg['n_workers_per_block'],
-                K = self.K
+                K = self.K,
+                n_rhs = n_rhs
             )
         )
 
-    def setup_interactions(self):
-        self.interactions = traversal_module.fmmmm_interactions(
-            self.obs_tree, self.src_tree, 1.0, self.cfg['mac'],
-            0, True
-        )
-
     def setup_output_sizes(self):
         order = self.cfg['order']
         # n dim = [0, order],
@@ -76,86 +337,43 @@ class TSFMM:
         # multipole_dim moments,
         # 2 = real and imaginary parts
         multipole_dim = self.K.multipole_dim
-        self.n_multipoles = (order + 1) * (order + 1) * multipole_dim * 2 * self.src_tree.n_nodes
-        # self.n_locals = self.n_surf_dofs * self.obs_tree.n_nodes
-        self.n_input = self.src_m[1].shape[0] * 9
-        self.n_output = self.obs_m[1].shape[0] * 9
+        self.n_multipoles = (order + 1) * (order + 1) * multipole_dim * 2 * self.plan.src_n_nodes
+        self.n_locals = 0
+        if not self.cfg['treecode']:
+            self.n_locals = (order + 1) * (order + 1) * multipole_dim * 2 * self.plan.obs_n_nodes
+        self.n_input = self.plan.n_src_tris * 9
+        self.n_output = self.plan.n_obs_tris * 9
 
     def float_gpu(self, arr):
         return gpu.to_gpu(arr, self.cfg['float_type'])
 
-    def int_gpu(self, arr):
-        return gpu.to_gpu(arr, np.int32)
-
     def params_to_gpu(self):
         self.gpu_data['params'] = self.float_gpu(np.array(self.cfg['params']))
 
-    def tree_to_gpu(self):
-        gd = self.gpu_data
-
-        gd['obs_pts'] = self.float_gpu(self.obs_m[0])
-        gd['obs_tris'] = self.int_gpu(self.obs_m[1][self.obs_tree.orig_idxs])
-        gd['src_pts'] = self.float_gpu(self.src_m[0])
-        gd['src_tris'] = self.int_gpu(self.src_m[1][self.src_tree.orig_idxs])
-
-        self.obs_tree_nodes = self.obs_tree.nodes
-        self.src_tree_nodes = self.src_tree.nodes
-
-        for name, tree in [('src', self.src_tree), ('obs', self.obs_tree)]:
-            gd[name + '_n_C'] = self.float_gpu(tree.node_centers)
-            # gd[name + '_n_R'] = self.float_gpu(tree.node_Rs)
-
-        for name, tree in [('src', self.src_tree_nodes), ('obs', self.obs_tree_nodes)]:
-            gd[name + '_n_start'] = self.int_gpu(np.array([n.start for n in tree]))
-            gd[name + '_n_end'] = self.int_gpu(np.array([n.end for n in tree]))
-
-    def interactions_to_gpu(self):
-        op_names = ['p2p', 'p2m', 'p2l', 'm2p', 'm2m', 'm2l', 'l2p', 'l2l']
-        for name in op_names:
-            op = getattr(self.interactions, name)
-            if type(op) is list:
-                for i, op_level in enumerate(op):
-                    self.op_to_gpu(name + str(i), op_level)
-            else:
-                self.op_to_gpu(name, op)
-
-        self.p2p_obs_tri_block_idx()
-
-    def p2p_obs_tri_block_idx(self):
-        t = tct.Timer()
-        obs_tri_block_idx = -1 * np.ones(self.obs_m[1].shape[0], dtype = np.int)
-        p2p_obs_n_idxs = np.array(self.interactions.p2p.obs_n_idxs, copy = False)
-        for block_idx in range(p2p_obs_n_idxs.shape[0]):
-            n_idx = p2p_obs_n_idxs[block_idx]
-            start = self.obs_tree_nodes[n_idx].start
-            end = self.obs_tree_nodes[n_idx].end
-            assert(np.all(obs_tri_block_idx[start:end] == -1))
-            obs_tri_block_idx[start:end] = block_idx
-        self.obs_tri_block_idx = obs_tri_block_idx
-        self.gpu_data['p2p_obs_tri_block_idx'] = self.int_gpu(self.obs_tri_block_idx)
-
-    def op_to_gpu(self, name, op):
-        for data_name in ['obs_n_idxs', 'obs_src_starts', 'src_n_idxs']:
-            self.gpu_data[name + '_' + data_name] = self.int_gpu(
-                np.array(getattr(op, data_name), copy = False)
-            )
-
     def to_tree(self, input_orig):
-        orig_idxs = np.array(self.src_tree.orig_idxs)
-        input_orig = input_orig.reshape((-1,9))
+        orig_idxs = self.plan.arrays['src_orig_idxs']
+        input_orig = input_orig.reshape((-1, 9 * self.n_rhs))
         return input_orig[orig_idxs,:].flatten()
 
     def to_orig(self, output_tree):
-        orig_idxs = np.array(self.obs_tree.orig_idxs)
-        output_tree = output_tree.reshape((-1, 9))
+        orig_idxs = self.plan.arrays['obs_orig_idxs']
+        output_tree = output_tree.reshape((-1, 9 * self.n_rhs))
         output_orig = np.empty_like(output_tree)
         output_orig[orig_idxs,:] = output_tree
-        return output_orig.flatten()
-
-    def setup_arrays(self):
-        self.gpu_multipoles = gpu.empty_gpu(self.n_multipoles, self.cfg['float_type'])
-        self.gpu_out = gpu.empty_gpu(self.n_output, self.cfg['float_type'])
-        self.gpu_in = gpu.empty_gpu(self.n_input, self.cfg['float_type'])
+        return output_orig.reshape((-1, self.n_rhs))
+
+    def setup_arrays(self, n_rhs):
+        float_type = self.cfg['float_type']
+        gpu_multipoles = gpu.empty_gpu(self.n_multipoles * n_rhs, float_type)
+        gpu_locals = None
+        if not self.cfg['treecode']:
+            gpu_locals = gpu.empty_gpu(self.n_locals * n_rhs, float_type)
+        gpu_outs = [
+            gpu.empty_gpu(self.n_output * n_rhs, float_type)
+            for d in range(len(self.device_data))
+        ]
+        gpu_in = gpu.empty_gpu(self.n_input * n_rhs, float_type)
+        return gpu_multipoles, gpu_locals, gpu_outs, gpu_in
 
     def p2m(self):
         n_obs_n = self.gpu_data['p2m_obs_n_idxs'].shape[0]
@@ -190,18 +408,78 @@ class TSFMM:
             block = (block_size,1,1)
         )
 
-    def m2p(self):
-        n_obs_n = self.gpu_data['m2p_obs_n_idxs'].shape[0]
+    def m2l(self, op_name):
+        n_obs_n = self.gpu_data[op_name + '_obs_n_idxs'].shape[0]
+        if n_obs_n == 0:
+            return
+        block_size = self.cfg['n_workers_per_block']
+        n_blocks = int(np.ceil(n_obs_n / block_size))
+        self.gpu_module.m2l(
+            self.gpu_locals,
+            self.gpu_multipoles,
+            np.int32(n_obs_n),
+            self.gpu_data[op_name + '_obs_n_idxs'],
+            self.gpu_data[op_name + '_obs_src_starts'],
+            self.gpu_data[op_name + '_src_n_idxs'],
+            self.gpu_data['obs_n_C'],
+            self.gpu_data['src_n_C'],
+            grid = (n_blocks,1,1),
+            block = (block_size,1,1)
+        )
+
+    def l2l(self, level):
+        n_obs_n = self.gpu_data['l2l' + str(level) + '_obs_n_idxs'].shape[0]
+        if n_obs_n == 0:
+            return
+        block_size = self.cfg['n_workers_per_block']
+        n_blocks = int(np.ceil(n_obs_n / block_size))
+        self.gpu_module.l2l(
+            self.gpu_locals,
+            np.int32(n_obs_n),
+            self.gpu_data['l2l' + str(level) + '_obs_n_idxs'],
+            self.gpu_data['l2l' + str(level) + '_obs_src_starts'],
+            self.gpu_data['l2l' + str(level) + '_src_n_idxs'],
+            self.gpu_data['obs_n_C'],
+            grid = (n_blocks,1,1),
+            block = (block_size,1,1)
+        )
+
+    def l2p(self):
+        n_obs_n = self.gpu_data['l2p_obs_n_idxs'].shape[0]
+        if n_obs_n == 0:
+            return
+        block_size = self.cfg['n_workers_per_block']
+        self.gpu_module.l2p(
+            self.gpu_outs[0],
+            self.gpu_locals,
+            self.gpu_data['params'],
+            np.int32(n_obs_n),
+            self.gpu_data['l2p_obs_n_idxs'],
+            self.gpu_data['l2p_obs_src_starts'],
+            self.gpu_data['l2p_src_n_idxs'],
+            self.gpu_data['obs_n_start'],
+            self.gpu_data['obs_n_end'],
+            self.gpu_data['obs_pts'],
+            self.gpu_data['obs_tris'],
+            self.gpu_data['obs_n_C'],
+            grid = (n_obs_n,1,1),
+            block = (block_size,1,1),
+            stream = gpu.device_queue(0)
+        )
+
+    def m2p(self, device = 0):
+        dd = self.device_data[device]
+        n_obs_n = dd['n_m2p']
         if n_obs_n == 0:
             return
         block_size = self.cfg['n_workers_per_block']
         self.gpu_module.m2p_U(
-            self.gpu_out,
+            self.gpu_outs[device],
             self.gpu_multipoles,
             self.gpu_data['params'],
             np.int32(n_obs_n),
-            self.gpu_data['m2p_obs_n_idxs'],
-            self.gpu_data['m2p_obs_src_starts'],
+            dd['m2p_obs_n_idxs'],
+            dd['m2p_obs_src_starts'],
             self.gpu_data['m2p_src_n_idxs'],
             self.gpu_data['obs_n_start'],
             self.gpu_data['obs_n_end'],
@@ -209,21 +487,22 @@ class TSFMM:
             self.gpu_data['obs_tris'],
             self.gpu_data['src_n_C'],
             grid = (n_obs_n,1,1),
-            block = (block_size,1,1)
+            block = (block_size,1,1),
+            stream = gpu.device_queue(device)
         )
 
-    def p2p(self):
-        n_obs_n = self.gpu_data['p2p_obs_n_idxs'].shape[0]
-        if n_obs_n == 0:
+    def p2p(self, device = 0):
+        dd = self.device_data[device]
+        if dd['n_p2p'] == 0:
             return
-        n_obs_tris = self.obs_m[1].shape[0]
+        n_obs_tris = self.plan.n_obs_tris
         n_blocks = int(np.ceil(n_obs_tris / self.cfg['n_workers_per_block']))
         self.gpu_module.p2p(
-            self.gpu_out,
+            self.gpu_outs[device],
             self.gpu_in,
             np.int32(n_obs_tris),
             self.gpu_data['params'],
-            self.gpu_data['p2p_obs_tri_block_idx'],
+            dd['p2p_obs_tri_block_idx'],
             self.gpu_data['p2p_obs_src_starts'],
             self.gpu_data['p2p_src_n_idxs'],
             self.gpu_data['obs_n_start'],
@@ -235,47 +514,72 @@ class TSFMM:
             self.gpu_data['src_pts'],
             self.gpu_data['src_tris'],
             grid = (n_blocks, 1, 1),
-            block = (self.cfg['n_workers_per_block'], 1, 1)
+            block = (self.cfg['n_workers_per_block'], 1, 1),
+            stream = gpu.device_queue(device)
         )
 
-    def dot_helper(self, v):
-        self.gpu_in[:] = self.to_tree(v.astype(self.cfg['float_type']))
-        self.gpu_out.fill(0)
+    def dot_helper(self, V):
+        self.use_rhs(V.shape[1])
+        self.gpu_in[:] = self.to_tree(V)
+        for gpu_out in self.gpu_outs:
+            gpu_out.fill(0)
 
-        self.p2p()
         self.p2m()
         for i in range(1, len(self.interactions.m2m)):
             self.m2m(i)
-        self.m2p()
+        if not self.cfg['treecode']:
+            self.gpu_locals.fill(0)
+            self.m2l('m2l')
+            self.m2l('p2l')
+            for i in range(1, len(self.interactions.l2l)):
+                self.l2l(i)
+        gpu.synchronize()
+
+        # p2p overwrites the output of the observation triangles it handles,
+        # so it has to come before m2p and l2p.
+        for d in range(len(self.device_data)):
+            self.p2p(d)
+            self.m2p(d)
+        if not self.cfg['treecode']:
+            self.l2p()
+        if len(self.device_data) > 1:
+            gpu.synchronize()
+
+    def empty_output(self, v):
+        out = np.empty((self.n_output,) + v.shape[1:], dtype = self.cfg['float_type'])
+        return out, out.reshape((self.n_output, -1))
 
     def dot(self, v):
-        self.dot_helper(v)
-
-        return self.to_orig(self.gpu_out.get())
+        out, out_cols = self.empty_output(v)
+        chunks = gpu.rhs_chunks(v, self.max_rhs, self.cfg['float_type'])
+        for start, end, chunk in chunks:
+            self.dot_helper(chunk)
+            out_tree = self.gpu_outs[0].get()
+            for gpu_out in self.gpu_outs[1:]:
+                out_tree += gpu_out.get()
+            out_cols[:, start:end] = self.to_orig(out_tree)[:, :(end - start)]
+        return out
 
     async def async_dot(self, v):
         t = tct.Timer(output_fnc = logger.debug)
-        self.dot_helper(v)
-        t.report('launch fmm')
-        out_tree = await gpu.async_get(self.gpu_out)
-        t.report('get fmm result')
-        out = self.to_orig(out_tree)
-        t.report('to orig')
+        out, out_cols = self.empty_output(v)
+        chunks = gpu.rhs_chunks(v, self.max_rhs, self.cfg['float_type'])
+        for start, end, chunk in chunks:
+            self.dot_helper(chunk)
+            t.report('launch fmm')
+            out_tree = await gpu.async_get(self.gpu_outs[0])
+            for gpu_out in self.gpu_outs[1:]:
+                out_tree += await gpu.async_get(gpu_out)
+            t.report('get fmm result')
+            out_cols[:, start:end] = self.to_orig(out_tree)[:, :(end - start)]
+            t.report('to orig')
         return out
 
 def report_interactions(fmm_obj):
-    def count_interactions(op_name, op):
-        obs_surf = False if op_name[2] == 'p' else True
-        src_surf = False if op_name[0] == 'p' else True
-        return traversal_module.count_interactions(
-            op, fmm_obj.obs_tree, fmm_obj.src_tree,
-            obs_surf, src_surf, 1
-        )
+    n_obs_tris = fmm_obj.plan.n_obs_tris
+    n_src_tris = fmm_obj.plan.n_src_tris
 
-    n_obs_tris = fmm_obj.obs_m[1].shape[0]
-    n_src_tris = fmm_obj.src_m[1].shape[0]
-
-    p2p = count_interactions('p2p', fmm_obj.interactions.p2p)
+    p2p = fmm_obj.plan.count_interactions('p2p', 1)
     n_p2p = fmm_obj.interactions.p2p.src_n_idxs.shape[0]
     n_p2m = fmm_obj.interactions.p2m.src_n_idxs.shape[0]
     n_m2m = sum([
@@ -283,6 +587,14 @@ def report_interactions(fmm_obj):
         for i in range(len(fmm_obj.interactions.m2m))
     ])
     n_m2p = fmm_obj.interactions.m2p.src_n_idxs.shape[0]
+    n_m2l = (
+        fmm_obj.interactions.m2l.src_n_idxs.shape[0]
+        + fmm_obj.interactions.p2l.src_n_idxs.shape[0]
+    )
+    n_l2l = sum([
+        fmm_obj.interactions.l2l[i].src_n_idxs.shape[0]
+        for i in range(len(fmm_obj.interactions.l2l))
+    ])
     total = n_obs_tris * n_src_tris
     not_p2p = total - p2p
 
@@ -295,3 +607,5 @@ def report_interactions(fmm_obj):
     logger.info('# p2m:' + str(n_p2m))
     logger.info('# m2m:' + str(n_m2m))
     logger.info('# m2p:' + str(n_m2p))
+    logger.info('# m2l:' + str(n_m2l))
+    logger.info('# l2l:' + str(n_l2l))
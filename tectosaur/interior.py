@@ -167,7 +167,8 @@ class TriToPtDirectFarfieldOp:
                 block_size = self.block_size,
                 float_type = gpu.np_to_c_type(float_type),
                 quad_pts = self.q[0],
-                quad_wts = self.q[1]
+                quad_wts = self.q[1],
+                n_rhs = 1
             )
         )
         self.fnc = getattr(self.module, "farfield_tris_to_pts" + K_name)
@@ -39,9 +39,11 @@ void farfield_tris_to_tris${K.name}(
     ${prim.decl_tri_info("obs", K.needs_obsn, K.surf_curl_obs)}
     ${prim.tri_info("obs", "pts", "obs_tris", K.needs_obsn, K.surf_curl_obs)}
 
-    Real sum[${dofs_per_el}];
-    for (int k = 0; k < ${dofs_per_el}; k++) {
-        sum[k] = 0.0;
+    Real sum_rhs[${n_rhs}][${dofs_per_el}];
+    for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+        for (int k = 0; k < ${dofs_per_el}; k++) {
+            sum_rhs[rhs][k] = 0.0;
+        }
     }
 
     for (int j = 0; j < n_src; j++) {
@@ -50,9 +52,11 @@ void farfield_tris_to_tris${K.name}(
         ${prim.decl_tri_info("src", K.needs_srcn, K.surf_curl_src)}
         ${prim.tri_info("src", "pts", "src_tris", K.needs_srcn, K.surf_curl_src)}
 
-        Real in[${dofs_per_el}];
+        Real in_rhs[${n_rhs}][${dofs_per_el}];
         for (int k = 0; k < ${dofs_per_el}; k++) {
-            in[k] = input[src_tri_idx * ${dofs_per_el} + k];
+            for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                in_rhs[rhs][k] = input[(src_tri_idx * ${dofs_per_el} + k) * ${n_rhs} + rhs];
+            }
         }
 
         for (int iq1 = 0; iq1 < ${quad_wts.shape[0]}; iq1++) {
@@ -81,27 +85,42 @@ void farfield_tris_to_tris${K.name}(
                 }
 
                 Real factor = obs_jacobian * src_jacobian * quadw;
-                % for d in range(3):
-                    Real sum${dn(d)} = 0.0;
-                    Real in${dn(d)} = 0.0;
-                    for (int b_src = 0; b_src < 3; b_src++) {
-                        in${dn(d)} += in[b_src * 3 + ${d}] * srcb[b_src];
+                // The geometry above is shared by all the right hand sides.
+                // The kernel code reads in and adds to sum.
+                for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+                    Real in[${dofs_per_el}];
+                    Real sum[${dofs_per_el}];
+                    for (int k = 0; k < ${dofs_per_el}; k++) {
+                        in[k] = in_rhs[rhs][k];
+                        sum[k] = sum_rhs[rhs][k];
                     }
-                % endfor
+                    % for d in range(3):
+                        Real sum${dn(d)} = 0.0;
+                        Real in${dn(d)} = 0.0;
+                        for (int b_src = 0; b_src < 3; b_src++) {
+                            in${dn(d)} += in[b_src * 3 + ${d}] * srcb[b_src];
+                        }
+                    % endfor
 
-                ${prim.call_vector_code(K)}
+                    ${prim.call_vector_code(K)}
 
-                for (int b_obs = 0; b_obs < 3; b_obs++) {
-                    % for d_obs in range(3):
-                    sum[b_obs * 3 + ${d_obs}] += factor * obsb[b_obs] * sum${dn(d_obs)};
-                    % endfor
+                    for (int b_obs = 0; b_obs < 3; b_obs++) {
+                        % for d_obs in range(3):
+                        sum[b_obs * 3 + ${d_obs}] += factor * obsb[b_obs] * sum${dn(d_obs)};
+                        % endfor
+                    }
+                    for (int k = 0; k < ${dofs_per_el}; k++) {
+                        sum_rhs[rhs][k] = sum[k];
+                    }
                 }
             }
         }
     }
 
     for (int k = 0; k < ${dofs_per_el}; k++) {
-        result[obs_tri_idx * ${dofs_per_el} + k] = sum[k];
+        for (int rhs = 0; rhs < ${n_rhs}; rhs++) {
+            result[(obs_tri_idx * ${dofs_per_el} + k) * ${n_rhs} + rhs] = sum_rhs[rhs][k];
+        }
     }
 }
 </%def>
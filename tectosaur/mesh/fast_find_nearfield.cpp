@@ -9,7 +9,8 @@ cfg['dependencies'].extend([
 ])
 %>
 
-#include <atomic>
+#include <algorithm>
+#include <omp.h>
 
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
@@ -19,6 +20,30 @@ cfg['dependencies'].extend([
 
 namespace py = pybind11;
 
+template <size_t dim>
+bool nodes_close(const OctreeNode<dim>& obs_node,
+    const std::vector<double>& obs_expanded_r,
+    const OctreeNode<dim>& src_node,
+    const std::vector<double>& src_expanded_r,
+    double threshold)
+{
+    double r1 = obs_expanded_r[obs_node.idx];
+    double r2 = src_expanded_r[src_node.idx];
+    double limit = std::pow((r1 + r2) * threshold, 2);
+    return dist2(obs_node.bounds.center, src_node.bounds.center) <= limit;
+}
+
+template <size_t dim>
+bool split_src_node(const OctreeNode<dim>& obs_node,
+    const std::vector<double>& obs_expanded_r,
+    const OctreeNode<dim>& src_node,
+    const std::vector<double>& src_expanded_r)
+{
+    double r1 = obs_expanded_r[obs_node.idx];
+    double r2 = src_expanded_r[src_node.idx];
+    return ((r1 < r2) && !src_node.is_leaf) || obs_node.is_leaf;
+}
+
 template <size_t dim>
 void query_helper(std::vector<long>& out,
     const OctreeNode<dim>& obs_node, const Octree<dim>& obs_tree,
@@ -27,10 +52,7 @@ void query_helper(std::vector<long>& out,
     const std::vector<double>& src_expanded_r, double* src_radius_ptr,
     double threshold) 
 {
-    double r1 = obs_expanded_r[obs_node.idx];
-    double r2 = src_expanded_r[src_node.idx];
-    double limit = std::pow((r1 + r2) * threshold, 2);
-    if (dist2(obs_node.bounds.center, src_node.bounds.center) > limit) {
+    if (!nodes_close(obs_node, obs_expanded_r, src_node, src_expanded_r, threshold)) {
         return;
     }
     if (obs_node.is_leaf && src_node.is_leaf) {
@@ -49,8 +71,7 @@ void query_helper(std::vector<long>& out,
         }
         return;
     }
-    bool split2 = ((r1 < r2) && !src_node.is_leaf) || obs_node.is_leaf;
-    if (split2) {
+    if (split_src_node(obs_node, obs_expanded_r, src_node, src_expanded_r)) {
         for (size_t i = 0; i < OctreeNode<dim>::split; i++) {
             query_helper(
                 out, 
@@ -73,6 +94,20 @@ void query_helper(std::vector<long>& out,
     }
 }
 
+// Concatenates the chunks in order, copying in parallel.
+std::vector<long> concatenate(const std::vector<std::vector<long>>& chunks) {
+    std::vector<size_t> offsets(chunks.size() + 1, 0);
+    for (size_t i = 0; i < chunks.size(); i++) {
+        offsets[i + 1] = offsets[i] + chunks[i].size();
+    }
+    std::vector<long> out(offsets.back());
+#pragma omp parallel for schedule(dynamic)
+    for (size_t i = 0; i < chunks.size(); i++) {
+        std::copy(chunks[i].begin(), chunks[i].end(), out.begin() + offsets[i]);
+    }
+    return out;
+}
+
 //TODO: This is redundant now that octree/kdtree support ball radius
 template <size_t dim>
 std::vector<double> get_expanded_node_r(const Octree<dim>& tree, double* radius_ptr) {
@@ -93,6 +128,14 @@ std::vector<double> get_expanded_node_r(const Octree<dim>& tree, double* radius_
     return expanded_node_r;
 }
 
+template <size_t dim>
+struct NodePair {
+    const OctreeNode<dim>* obs;
+    const OctreeNode<dim>* src;
+};
+
+constexpr size_t traversal_tasks_per_thread = 32;
+
 template <size_t dim>
 std::vector<long> query_ball_points(
     const Octree<dim>& obs_tree, const std::vector<double>& obs_expanded_r,
@@ -101,50 +144,56 @@ std::vector<long> query_ball_points(
     std::array<double,dim>* src_pt_ptr, double* src_radius_ptr, size_t n_src,
     double threshold) 
 {
-
-    std::vector<long> out;
-    constexpr int parallelize_depth = 2;
-    std::atomic<int> n_pairs{0};
-#pragma omp parallel
-    {
-
-        std::vector<long> out_private;
-#pragma omp for
-        for (size_t i = 0; i < obs_tree.nodes.size(); i++) {
-            auto& obs_n = obs_tree.nodes[i];
-            if (obs_n.depth > parallelize_depth) {
+    // The top of the dual tree traversal is expanded one level at a time,
+    // keeping the order that the serial depth first traversal would visit
+    // the node pairs in, until there are enough node pairs to keep every
+    // thread busy. Each remaining node pair is traversed as a separate task
+    // with its own output buffer and the buffers are concatenated in task
+    // order. So, the output is identical for any number of threads.
+    std::vector<NodePair<dim>> tasks{{&obs_tree.root(), &src_tree.root()}};
+    size_t target_tasks = traversal_tasks_per_thread * omp_get_max_threads();
+    bool expanded = true;
+    while (expanded && tasks.size() < target_tasks) {
+        expanded = false;
+        std::vector<NodePair<dim>> next_tasks;
+        for (auto& t: tasks) {
+            if (!nodes_close(*t.obs, obs_expanded_r, *t.src, src_expanded_r, threshold)) {
                 continue;
             }
-            if (obs_n.depth != parallelize_depth && !obs_n.is_leaf) {
+            if (t.obs->is_leaf && t.src->is_leaf) {
+                next_tasks.push_back(t);
                 continue;
             }
-            query_helper(
-                out_private, 
-                obs_n, obs_tree, obs_expanded_r, obs_radius_ptr,
-                src_tree.root(), src_tree, src_expanded_r, src_radius_ptr,
-                threshold
-            );
-        }
-        size_t insertion_start_idx = n_pairs.fetch_add(out_private.size());
-#pragma omp barrier
-#pragma omp single
-        {
-            out.resize(n_pairs);
-        }
-
-        for (size_t i = 0; i < out_private.size(); i++) {
-            out[insertion_start_idx + i] = out_private[i];
+            expanded = true;
+            bool split_src = split_src_node(*t.obs, obs_expanded_r, *t.src, src_expanded_r);
+            for (size_t i = 0; i < OctreeNode<dim>::split; i++) {
+                if (split_src) {
+                    next_tasks.push_back({t.obs, &src_tree.nodes[t.src->children[i]]});
+                } else {
+                    next_tasks.push_back({&obs_tree.nodes[t.obs->children[i]], t.src});
+                }
+            }
         }
+        tasks = std::move(next_tasks);
     }
 
-    return out;
+    std::vector<std::vector<long>> task_out(tasks.size());
+#pragma omp parallel for schedule(dynamic)
+    for (size_t i = 0; i < tasks.size(); i++) {
+        query_helper(
+            task_out[i],
+            *tasks[i].obs, obs_tree, obs_expanded_r, obs_radius_ptr,
+            *tasks[i].src, src_tree, src_expanded_r, src_radius_ptr,
+            threshold
+        );
+    }
+    return concatenate(task_out);
 }
 
-std::array<std::vector<long>,3> split_adjacent_close(long* close_pairs,
-    size_t n_pairs, long* tris_A, long* tris_B)
+void split_adjacent_close_block(std::array<std::vector<long>,3>& out,
+    long* close_pairs, size_t start, size_t end, long* tris_A, long* tris_B)
 {
-    std::array<std::vector<long>,3> out;
-    for (size_t i = 0; i < n_pairs; i++) {
+    for (size_t i = start; i < end; i++) {
         auto idx1 = close_pairs[i * 2];
         auto idx2 = close_pairs[i * 2 + 1];
         std::pair<long,long> pair1 = {-1,-1};
@@ -178,6 +227,33 @@ std::array<std::vector<long>,3> split_adjacent_close(long* close_pairs,
             );
         }
     }
+}
+
+constexpr size_t split_block_size = 1 << 14;
+
+std::array<std::vector<long>,3> split_adjacent_close(long* close_pairs,
+    size_t n_pairs, long* tris_A, long* tris_B)
+{
+    // Fixed size blocks of pairs are split in parallel and the results are
+    // concatenated in block order, so the output keeps the input order.
+    size_t n_blocks = (n_pairs + split_block_size - 1) / split_block_size;
+    std::vector<std::array<std::vector<long>,3>> block_out(n_blocks);
+#pragma omp parallel for schedule(dynamic)
+    for (size_t b = 0; b < n_blocks; b++) {
+        split_adjacent_close_block(
+            block_out[b], close_pairs, b * split_block_size,
+            std::min(n_pairs, (b + 1) * split_block_size), tris_A, tris_B
+        );
+    }
+
+    std::array<std::vector<long>,3> out;
+    for (size_t k = 0; k < 3; k++) {
+        std::vector<std::vector<long>> chunks(n_blocks);
+        for (size_t b = 0; b < n_blocks; b++) {
+            chunks[b] = std::move(block_out[b][k]);
+        }
+        out[k] = concatenate(chunks);
+    }
     return out;
 }
 
@@ -287,6 +363,9 @@ PYBIND11_MODULE(fast_find_nearfield,m) {
             );
         });
 
+    m.def("get_max_threads", [] () { return omp_get_max_threads(); });
+    m.def("set_num_threads", [] (int n_threads) { omp_set_num_threads(n_threads); });
+
     m.def("split_vertex_nearfield",
         [] (NPArray<long> close_pairs, NPArrayD obs_pts, NPArrayD src_pts,
             NPArray<long> src_tris) 
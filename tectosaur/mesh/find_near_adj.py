@@ -4,11 +4,11 @@ from tectosaur.util.timer import Timer
 
 import tectosaur.util.profile
 
-from tectosaur.util.cpp import imp
+from tectosaur.util.cpp import imp, lazy_fnc
 fast_find_nearfield = imp('tectosaur.mesh.fast_find_nearfield')
 
-split_adjacent_close = fast_find_nearfield.split_adjacent_close
-split_vertex_nearfield = fast_find_nearfield.split_vertex_nearfield
+split_adjacent_close = lazy_fnc(fast_find_nearfield, 'split_adjacent_close')
+split_vertex_nearfield = lazy_fnc(fast_find_nearfield, 'split_vertex_nearfield')
 
 def get_tri_centroids_rs(pts, tris):
     tri_pts = pts[tris]
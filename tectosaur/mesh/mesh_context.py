@@ -0,0 +1,123 @@
+import weakref
+import numpy as np
+
+import tectosaur.util.disk_cache as disk_cache
+import tectosaur.mesh.find_near_adj as find_near_adj
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A MeshContext holds the kernel independent pieces of operator setup for one
+# mesh: the close or touching pairs, the nearfield pair categories (including
+# the edge adjacent rotations) and the FMM trees and plans. Each is computed
+# the first time it's asked for. The operators look up the context for their
+# mesh with get_mesh_context, so building H and T, or several operators on
+# subsets of the same mesh, only does this work once. The registry only holds
+# weak references: a context, and the device buffers of its FMM plans, lives
+# as long as some operator built from it (or the caller) holds on to it.
+
+contexts = weakref.WeakValueDictionary()
+
+def array_key(arr):
+    arr = np.ascontiguousarray(arr)
+    return disk_cache.hash_key(arr.dtype.str, arr.shape, arr.tobytes())
+
+def get_mesh_context(pts, tris):
+    """
+    The MeshContext for the mesh (pts, tris). Contexts are keyed by the mesh
+    contents and are shared while any reference to them is alive.
+    """
+    key = (array_key(pts), array_key(tris))
+    ctx = contexts.get(key, None)
+    if ctx is None:
+        ctx = MeshContext(pts, tris)
+        contexts[key] = ctx
+    return ctx
+
+def clear_mesh_contexts():
+    """
+    Stop sharing the existing contexts. Operators that hold a context keep
+    it, but later get_mesh_context calls start from a fresh one.
+    """
+    contexts.clear()
+
+def read_only(arrs):
+    for a in arrs:
+        a.setflags(write = False)
+    return arrs
+
+class MeshContext:
+    def __init__(self, pts, tris):
+        self.pts = np.array(pts)
+        self.tris = np.array(tris)
+        self.memo = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, key, f):
+        if key in self.memo:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.memo[key] = f()
+        return self.memo[key]
+
+    def close_or_touching(self, obs_subset, src_subset, threshold):
+        def compute():
+            return read_only([find_near_adj.find_close_or_touching(
+                self.pts, self.tris[obs_subset], self.pts, self.tris[src_subset],
+                threshold
+            )])[0]
+        key = ('close_or_touching', array_key(obs_subset), array_key(src_subset), threshold)
+        return self.cached(key, compute)
+
+    def pair_categories(self, obs_subset, src_subset, near_threshold):
+        """
+        The output of nearfield_op.find_pair_categories for this mesh.
+        """
+        from tectosaur.nearfield.nearfield_op import split_pair_categories
+        def compute():
+            close_or_touch_pairs = self.close_or_touching(
+                obs_subset, src_subset, near_threshold
+            )
+            return read_only(split_pair_categories(
+                self.tris, obs_subset, src_subset, close_or_touch_pairs
+            ))
+        key = (
+            'pair_categories', array_key(obs_subset), array_key(src_subset),
+            near_threshold
+        )
+        return self.cached(key, compute)
+
+    def fmm_tree(self, subset, scale, max_pts_per_cell):
+        """
+        The TSFMM tree of the triangles in subset, with the mesh scaled by
+        1 / scale.
+        """
+        from tectosaur.fmm.tsfmm import make_tree
+        key = ('fmm_tree', array_key(subset), scale, max_pts_per_cell)
+        return self.cached(key, lambda: make_tree(
+            (self.pts / scale, self.tris[subset]), max_pts_per_cell
+        ))
+
+    def fmm_plan(self, obs_subset, src_subset, scale, mac, max_pts_per_cell,
+            treecode):
+        """
+        The TSFMMPlan from the triangles in src_subset to those in obs_subset,
+        with the mesh scaled by 1 / scale.
+        """
+        from tectosaur.fmm.tsfmm import make_plan
+        def compute():
+            scaled_pts = self.pts / scale
+            return make_plan(
+                (scaled_pts, self.tris[obs_subset]),
+                (scaled_pts, self.tris[src_subset]),
+                mac, max_pts_per_cell, treecode,
+                obs_tree = self.fmm_tree(obs_subset, scale, max_pts_per_cell),
+                src_tree = self.fmm_tree(src_subset, scale, max_pts_per_cell)
+            )
+        key = (
+            'fmm_plan', array_key(obs_subset), array_key(src_subset), scale,
+            mac, max_pts_per_cell, treecode
+        )
+        return self.cached(key, compute)
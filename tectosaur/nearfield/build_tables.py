@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import numpy as np
+
+import tectosaur.nearfield.table_params as table_params
+from tectosaur.nearfield.table_lookup import table_filepath, table_metadata
+from tectosaur.nearfield.interpolate import cheb, to_interval
+from tectosaur.nearfield.pairs_integrator import PairsIntegrator
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Builds the coincident and edge adjacent lookup tables used by
+# table_lookup.py. Each table entry is (1 - nu) times the integrals over a
+# standard triangle or pair with G = 1, computed with the high order
+# quadrature from triangle_rules.py.
+
+def coincident_table_pts(n_x = table_params.coincident_n_x,
+        n_y = table_params.coincident_n_y):
+    xhat = cheb(-1, 1, n_x)
+    yhat = cheb(-1, 1, n_y)
+    x = to_interval(table_params.coincident_min_x, table_params.coincident_max_x, xhat)
+    ylo, yhi = table_params.coincident_y_range(x)
+    y = to_interval(ylo[:,np.newaxis], yhi[:,np.newaxis], yhat[np.newaxis,:])
+    return np.broadcast_to(x[:,np.newaxis], y.shape), y
+
+def build_coincident_table(kernel, nq = table_params.coincident_nq,
+        n_x = table_params.coincident_n_x, n_y = table_params.coincident_n_y):
+    x, y = coincident_table_pts(n_x, n_y)
+    n = x.size
+    pts = np.zeros((n, 3, 3))
+    pts[:,1,0] = 1.0
+    pts[:,2,0] = x.flatten()
+    pts[:,2,1] = y.flatten()
+    pts = pts.reshape((-1, 3))
+    tris = np.arange(3 * n).reshape((-1, 3))
+    pairs = np.array([np.arange(n), np.arange(n)]).T.copy()
+
+    out = np.empty((table_params.table_nus.shape[0], n_x, n_y, 81))
+    for i, nu in enumerate(table_params.table_nus):
+        pairs_int = PairsIntegrator(
+            kernel, [1.0, nu], np.float64, 1, 1, pts, tris, congruence = False
+        )
+        I = pairs_int.coincident(nq, pairs)
+        out[i] = (1 - nu) * I.reshape((n_x, n_y, 81))
+    return out
+
+def adjacent_table_pts(n_phi = table_params.adjacent_n_phi):
+    phi = to_interval(
+        table_params.adjacent_min_phi, table_params.adjacent_max_phi,
+        cheb(-1, 1, n_phi)
+    )
+    h = table_params.min_angle_isoceles_height
+    n = phi.shape[0]
+    pts = np.zeros((n, 2, 3, 3))
+    pts[:,0,1] = [1.0, 0.0, 0.0]
+    pts[:,0,2] = [0.5, h, 0.0]
+    pts[:,1,0] = [1.0, 0.0, 0.0]
+    pts[:,1,2,0] = 0.5
+    pts[:,1,2,1] = h * np.cos(phi)
+    pts[:,1,2,2] = h * np.sin(phi)
+    return phi, pts
+
+def build_adjacent_table(kernel, nq = table_params.adjacent_nq,
+        n_phi = table_params.adjacent_n_phi):
+    phi, pair_pts = adjacent_table_pts(n_phi)
+    pts = pair_pts.reshape((-1, 3))
+    tris = np.arange(pts.shape[0]).reshape((-1, 3))
+    pairs = np.zeros((n_phi, 5), dtype = np.int64)
+    pairs[:,0] = 2 * np.arange(n_phi)
+    pairs[:,1] = 2 * np.arange(n_phi) + 1
+
+    out = np.empty((table_params.table_nus.shape[0], n_phi, 81))
+    for i, nu in enumerate(table_params.table_nus):
+        pairs_int = PairsIntegrator(
+            kernel, [1.0, nu], np.float64, 1, 1, pts, tris, congruence = False
+        )
+        I = pairs_int.edge_adj(nq, pairs)
+        out[i] = (1 - nu) * I.reshape((n_phi, 81))
+    return out
+
+def build(kernel, data_dir = None):
+    start = time.time()
+    tables = table_metadata()
+    tables['coincident_nq'] = table_params.coincident_nq
+    tables['adjacent_nq'] = table_params.adjacent_nq
+    tables['coincident_values'] = build_coincident_table(kernel)
+    logger.info('{} coincident table ({:.1f}s)'.format(kernel, time.time() - start))
+    tables['adjacent_values'] = build_adjacent_table(kernel)
+    logger.info('{} adjacent table ({:.1f}s)'.format(kernel, time.time() - start))
+
+    filepath = table_filepath(kernel, data_dir)
+    os.makedirs(os.path.dirname(filepath), exist_ok = True)
+    np.savez(filepath, **tables)
+    return filepath
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog = 'python -m tectosaur.nearfield.build_tables',
+        description = 'Build the coincident and edge adjacent lookup tables.'
+    )
+    parser.add_argument('kernels', nargs = '*', default = table_params.table_kernels,
+        help = 'kernels to build tables for (default: all elastic kernels)')
+    parser.add_argument('--data-dir', default = None,
+        help = 'directory to write the tables to (default: tectosaur/data)')
+    opts = parser.parse_args(args)
+
+    for K in opts.kernels:
+        start = time.time()
+        filepath = build(K, opts.data_dir)
+        print('{:6.1f}s {}'.format(time.time() - start, filepath))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,123 @@
+import numpy as np
+
+from tectosaur.kernels import kernels, elastic_kernels, regularized_elastic_kernels
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Structured meshes (make_rect, refine) repeat the same few triangle shapes
+# many times over. A singular pair integral only depends on the shape of the
+# pair, so each pair is mapped to a canonical frame: the first obs vertex is
+# moved to the origin, the first obs edge is scaled to unit length and rotated
+# onto the x axis and the obs normal is rotated onto the z axis. Pairs with the
+# same canonical vertices (and the same rotation/flip columns of the pairs
+# list) are integrated once. For an isotropic tensor kernel, a pair related to
+# the representative by x -> s * M * x + t has
+#   I[a,i,b,j] = s ** (-scale_type) * M[i,p] * M[j,q] * I_rep[a,p,b,q]
+# For other kernels, only translated copies are merged.
+
+# Canonical coordinates are rounded to this resolution to form the keys.
+key_resolution = 2.0 ** -30
+
+def is_isotropic(kernel_name):
+    return (
+        kernel_name in elastic_kernels
+        or kernel_name in regularized_elastic_kernels
+    )
+
+def rotate_blocks(M, blocks):
+    """
+    Rotate the tensor components of (n, 3, 3, 3, 3) pair integrals:
+    out[a,i,b,j] = M[i,p] * M[j,q] * blocks[a,p,b,q]
+    """
+    return np.einsum('nip,nkq,napbq->naibk', M, M, blocks, optimize = True)
+
+def pair_frames(obs_tri_pts, rotate_and_scale):
+    """
+    For each obs triangle, the origin, scale and rotation of the canonical
+    frame. A point x maps to R.dot(x - origin) / scale.
+    """
+    n = obs_tri_pts.shape[0]
+    origin = obs_tri_pts[:,0,:]
+    if not rotate_and_scale:
+        return origin, np.ones(n), np.tile(np.eye(3), (n, 1, 1))
+    edge = obs_tri_pts[:,1,:] - obs_tri_pts[:,0,:]
+    scale = np.linalg.norm(edge, axis = 1)
+    e0 = edge / scale[:,np.newaxis]
+    normal = np.cross(edge, obs_tri_pts[:,2,:] - obs_tri_pts[:,0,:])
+    e2 = normal / np.linalg.norm(normal, axis = 1)[:,np.newaxis]
+    e1 = np.cross(e2, e0)
+    R = np.stack((e0, e1, e2), axis = 1)
+    return origin, scale, R
+
+class CongruenceGroups:
+    """
+    Groups the rows of a pairs list (obs tri, src tri, extra columns...) by
+    congruence. rep_idxs are the pairs that need to be integrated and
+    inverse maps each pair to its representative.
+    """
+    def __init__(self, kernel_name, pts, tris, pairs_list):
+        pairs_list = np.asarray(pairs_list).astype(np.int64)
+        self.n_pairs = pairs_list.shape[0]
+        K = kernels[kernel_name]
+        self.rotate_and_scale = is_isotropic(kernel_name)
+        self.scale_type = K.scale_type
+
+        obs_tri_pts = pts[tris[pairs_list[:,0]]].astype(np.float64)
+        src_tri_pts = pts[tris[pairs_list[:,1]]].astype(np.float64)
+        self.origin, self.scale, self.R = pair_frames(
+            obs_tri_pts, self.rotate_and_scale
+        )
+
+        all_pts = np.concatenate((obs_tri_pts, src_tri_pts), axis = 1)
+        canonical = np.einsum(
+            'nij,nvj->nvi', self.R, all_pts - self.origin[:,np.newaxis,:]
+        ) / self.scale[:,np.newaxis,np.newaxis]
+        keys = np.concatenate((
+            np.round(canonical.reshape((self.n_pairs, -1)) / key_resolution),
+            pairs_list[:,2:]
+        ), axis = 1).astype(np.int64)
+
+        _, self.rep_idxs, self.inverse = np.unique(
+            keys, axis = 0, return_index = True, return_inverse = True
+        )
+        self.inverse = self.inverse.reshape(-1)
+        self.n_unique = self.rep_idxs.shape[0]
+
+    def hit_rate(self):
+        if self.n_pairs == 0:
+            return 0.0
+        return 1.0 - self.n_unique / self.n_pairs
+
+    def stats(self):
+        return dict(
+            n_pairs = self.n_pairs, n_unique = self.n_unique,
+            hit_rate = self.hit_rate()
+        )
+
+    def scatter(self, rep_results, float_type, idxs = None):
+        """
+        Expand the (n_unique, 3, 3, 3, 3) results for the representatives
+        into results for every pair, or only for the pairs selected by idxs.
+        """
+        if idxs is None:
+            idxs = slice(None)
+        inverse = self.inverse[idxs]
+        rep_results = rep_results.astype(np.float64)
+        if not self.rotate_and_scale:
+            return rep_results[inverse].astype(float_type)
+        rep = self.rep_idxs[inverse]
+        # rotation from the representative's frame to each pair's frame
+        M = np.einsum('nji,njk->nik', self.R[idxs], self.R[rep])
+        factor = (self.scale[idxs] / self.scale[rep]) ** (-self.scale_type)
+        out = rotate_blocks(M, rep_results[inverse])
+        out *= factor[:,np.newaxis,np.newaxis,np.newaxis,np.newaxis]
+        return out.astype(float_type)
+
+def report(stats):
+    lines = []
+    for name, s in stats.items():
+        lines.append('{}: {} pairs, {} unique, hit rate {:.1f}%'.format(
+            name, s['n_pairs'], s['n_unique'], 100 * s['hit_rate']
+        ))
+    return '\n'.join(lines)
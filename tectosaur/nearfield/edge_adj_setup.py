@@ -0,0 +1,102 @@
+import numpy as np
+
+from tectosaur.nearfield.standardize import edge_frames
+from tectosaur.nearfield.table_params import min_angle_isoceles_height
+
+# An edge adjacent pair is oriented like the edge adjacent quadrature in
+# assemble.cl: the obs triangle is rotated to (A, B, C) and the src triangle
+# to (B, A, D), where A-B is the shared edge. src_flip marks a src triangle
+# that had to have its first two vertices swapped to get there. In the frame
+# of the obs triangle, with A at the origin, B at (1, 0, 0) and C in the xy
+# plane with y > 0, the src triangle is rotated by the angle phi around the x
+# axis. phi = pi is a flat pair and phi near 0 or 2 pi is folded shut.
+
+xyhat_eps = 1e-9
+
+def rotated_pair_labels(ea):
+    """
+    For each row of a resolved edge adjacent pairs list (obs tri, src tri,
+    obs clicks, src clicks, flip), the original vertex index of each of the
+    rotated (A, B, C) obs and (B, A, D) src vertices.
+    """
+    ea = np.asarray(ea).astype(np.int64)
+    rot = np.arange(3)[np.newaxis,:]
+    obs_labels = (rot + ea[:,2:3]) % 3
+    src_labels = (rot + ea[:,3:4]) % 3
+    flip = ea[:,4] != 0
+    src_labels[flip] = src_labels[flip][:,[1,0,2]]
+    return obs_labels, src_labels
+
+def rotated_pair_pts(pts, tris, ea):
+    """
+    The (A, B, C) obs and (B, A, D) src vertices of the rows of a resolved
+    edge adjacent pairs list.
+    """
+    ea = np.asarray(ea).astype(np.int64)
+    obs_labels, src_labels = rotated_pair_labels(ea)
+    rows = np.arange(ea.shape[0])[:,np.newaxis]
+    obs_tri_pts = pts[tris[ea[:,0]][rows, obs_labels]]
+    src_tri_pts = pts[tris[ea[:,1]][rows, src_labels]]
+    return obs_tri_pts, src_tri_pts
+
+def adjacent_phi(obs_tri_pts, src_tri_pts):
+    _, R = edge_frames(obs_tri_pts[:,0], obs_tri_pts[:,1], obs_tri_pts[:,2])
+    D_rel = np.einsum('nji,nj->ni', R, src_tri_pts[:,2] - obs_tri_pts[:,0])
+    return np.arctan2(D_rel[:,2], D_rel[:,1]) % (2 * np.pi)
+
+def split_pts(tri_pts):
+    """
+    The point at min_angle_isoceles_height times the length of the (0, 1)
+    edge above that edge's midpoint, in the plane of the triangle.
+    """
+    scale, R = edge_frames(tri_pts[:,0], tri_pts[:,1], tri_pts[:,2])
+    return (
+        (tri_pts[:,0] + tri_pts[:,1]) / 2.0
+        + (min_angle_isoceles_height * scale)[:,np.newaxis] * R[:,:,1]
+    )
+
+def xyhat_from_pts(pts, tri_pts):
+    """
+    Reference coordinates of pts inside the triangles tri_pts.
+    """
+    J = np.stack((tri_pts[:,1] - tri_pts[:,0], tri_pts[:,2] - tri_pts[:,0]), axis = 2)
+    rhs = pts - tri_pts[:,0]
+    JtJ = np.einsum('nji,njk->nik', J, J)
+    Jtb = np.einsum('nji,nj->ni', J, rhs)
+    return np.linalg.solve(JtJ, Jtb[:,:,np.newaxis])[:,:,0]
+
+def check_xyhats(xyhat):
+    return (
+        (xyhat[:,0] >= -xyhat_eps) & (xyhat[:,1] >= -xyhat_eps)
+        & (xyhat[:,0] + xyhat[:,1] <= 1 + xyhat_eps)
+    )
+
+def orient_adj_tris(pts, tris, tri_idx1, tri_idx2):
+    from tectosaur.nearfield.nearfield_op import resolve_ea_rotation
+    touching = [
+        (i, j) for i in range(3) for j in range(3)
+        if tris[tri_idx1][i] == tris[tri_idx2][j]
+    ]
+    assert(len(touching) == 2)
+    ea = np.array([[
+        tri_idx1, tri_idx2, touching[0][0], touching[0][1],
+        touching[1][0], touching[1][1]
+    ]])
+    row = resolve_ea_rotation(tris, ea)
+    obs_tri_pts, src_tri_pts = rotated_pair_pts(np.asarray(pts), tris, row)
+    return (
+        row[0,2], obs_tri_pts[0].tolist(), row[0,3], bool(row[0,4]),
+        src_tri_pts[0].tolist()
+    )
+
+def calc_adjacent_phi(obs_tri, src_tri):
+    return adjacent_phi(np.array([obs_tri]), np.array([src_tri]))[0]
+
+def get_split_pt(tri):
+    return split_pts(np.array([tri]))[0].tolist()
+
+def xyhat_from_pt(pt, tri):
+    return xyhat_from_pts(np.array([pt]), np.array([tri]))[0].tolist()
+
+def check_xyhat(xyhat):
+    return bool(check_xyhats(np.array([xyhat]))[0])
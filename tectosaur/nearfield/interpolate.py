@@ -0,0 +1,77 @@
+import numpy as np
+
+# Chebyshev points and barycentric weights for interpolating the lookup
+# tables. cheb/cheb_wts are Chebyshev points of the first kind, which never
+# include the end points, while cheblob/cheblob_wts are the Chebyshev-Lobatto
+# points, which do. Weights are scaled to a maximum of one; the barycentric
+# formula is invariant to a common factor.
+
+def to_interval(a, b, x):
+    return a + (b - a) * (x + 1.0) / 2.0
+
+def from_interval(a, b, x):
+    return 2.0 * (x - a) / (b - a) - 1.0
+
+def cheb(a, b, n):
+    j = np.arange(n)
+    return to_interval(a, b, np.cos((2 * j + 1) * np.pi / (2 * n)))
+
+def cheb_wts(a, b, n):
+    j = np.arange(n)
+    return (-1.0) ** j * np.sin((2 * j + 1) * np.pi / (2 * n))
+
+def cheblob(a, b, n):
+    if n == 1:
+        return to_interval(a, b, np.zeros(1))
+    j = np.arange(n)
+    return to_interval(a, b, np.cos(j * np.pi / (n - 1)))
+
+def cheblob_wts(a, b, n):
+    wts = (-1.0) ** np.arange(n)
+    wts[0] *= 0.5
+    wts[-1] *= 0.5
+    return wts
+
+def barycentric_factors(nodes, wts, xs):
+    """
+    For 1D nodes, the (n_xs, n_nodes) matrix L such that L.dot(f(nodes))
+    interpolates f at xs. An x that lands exactly on a node picks out that
+    node's value.
+    """
+    diff = xs[:,np.newaxis] - nodes[np.newaxis,:]
+    exact = diff == 0
+    with np.errstate(divide = 'ignore'):
+        L = wts[np.newaxis,:] / diff
+    hit = np.any(exact, axis = 1)
+    L[hit] = exact[hit]
+    return L / np.sum(L, axis = 1)[:,np.newaxis]
+
+def barycentric_evalnd(pts, wts, vals, xs, float_type, chunk_size = 2 ** 20):
+    """
+    Interpolate vals, given at the points of a tensor product grid with the
+    matching tensor product barycentric weights, to the points xs. pts is
+    (n_pts, dim), vals is (n_pts, n_out) and the result is (n_xs, n_out).
+    """
+    pts = np.asarray(pts, dtype = np.float64)
+    wts = np.asarray(wts, dtype = np.float64)
+    vals = np.asarray(vals, dtype = np.float64)
+    xs = np.asarray(xs, dtype = np.float64)
+    if vals.ndim == 1:
+        vals = vals[:,np.newaxis]
+    n_xs_per_chunk = max(chunk_size // (pts.shape[0] * pts.shape[1]), 1)
+    out = np.empty((xs.shape[0], vals.shape[1]), dtype = float_type)
+    for start in range(0, xs.shape[0], n_xs_per_chunk):
+        chunk = xs[start:(start + n_xs_per_chunk)]
+        diff = chunk[:,np.newaxis,:] - pts[np.newaxis,:,:]
+        # In each dimension where x lies exactly on a grid line, only the
+        # points on that line contribute. Since the weights are a tensor
+        # product, their factor for that dimension cancels.
+        exact = diff == 0
+        on_line = np.any(exact, axis = 1)
+        with np.errstate(divide = 'ignore'):
+            factors = np.where(on_line[:,np.newaxis,:], exact, 1.0 / diff)
+        kernel = wts[np.newaxis,:] * np.prod(factors, axis = 2)
+        out[start:(start + chunk.shape[0])] = (
+            kernel.dot(vals) / np.sum(kernel, axis = 1)[:,np.newaxis]
+        )
+    return out
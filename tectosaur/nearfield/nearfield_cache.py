@@ -0,0 +1,96 @@
+import os
+import json
+import numpy as np
+
+import tectosaur.util.disk_cache as disk_cache
+from tectosaur.util.sparse import BSRMatrix
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Assembled nearfield matrices are stored as one directory of .npy files per
+# operator and loaded back with np.load(mmap_mode = 'r'), so a cached operator
+# is available without copying its blocks into memory. Caching is opt-in:
+# pass cache = True (or a DiskCache) to RegularizedSparseIntegralOp or set
+# TECTOSAUR_NEARFIELD_CACHE=1.
+
+format_version = 3
+
+def default_cache():
+    return disk_cache.DiskCache(
+        'nearfield',
+        max_bytes = float(os.environ.get('TECTOSAUR_NEARFIELD_CACHE_MB', 20000)) * 1e6,
+        max_age = float(os.environ.get('TECTOSAUR_NEARFIELD_CACHE_DAYS', 30)) * 86400
+    )
+
+def get_cache(cache):
+    if cache is None:
+        if os.environ.get('TECTOSAUR_NEARFIELD_CACHE', '0') == '0':
+            return None
+        cache = True
+    if cache is True:
+        return default_cache()
+    if cache is False:
+        return None
+    return cache
+
+def array_key(arr):
+    arr = np.ascontiguousarray(arr)
+    return (arr.dtype.str, arr.shape, arr.tobytes())
+
+def cache_key(*args):
+    parts = [format_version]
+    for a in args:
+        if isinstance(a, np.ndarray):
+            parts.extend(array_key(a))
+        elif type(a) is type:
+            parts.append(np.dtype(a).str)
+        else:
+            parts.append(repr(a))
+    return disk_cache.hash_key(*parts)
+
+def save(cache, key, mats, category_pairs, stats = None):
+    # stats is a json serializable dict of build statistics (the nearfield
+    # bins and congruence hit rates) that is handed back by load.
+    def write(dir):
+        for name, m in mats.items():
+            prefix = os.path.join(dir, name + '_')
+            np.save(prefix + 'indptr.npy', m.indptr)
+            np.save(prefix + 'indices.npy', m.indices)
+            np.save(prefix + 'data.npy', m.data)
+            np.save(prefix + 'shape.npy', np.array(m.shape))
+        for i, pairs in enumerate(category_pairs):
+            np.save(os.path.join(dir, 'pairs' + str(i) + '.npy'), pairs)
+        with open(os.path.join(dir, 'stats.json'), 'w') as f:
+            json.dump(stats or dict(), f, default = lambda x: x.item())
+        np.save(os.path.join(dir, 'complete.npy'), np.array(len(category_pairs)))
+    cache.put_dir(key, write)
+
+def load(cache, key, names):
+    if not cache.contains(key, 'complete.npy'):
+        return None
+    dir = cache.entry_dir(key)
+    out = dict()
+    try:
+        for name in names:
+            prefix = os.path.join(dir, name + '_')
+            if not os.path.exists(prefix + 'shape.npy'):
+                return None
+            out[name] = BSRMatrix(
+                np.load(prefix + 'indptr.npy', mmap_mode = 'r'),
+                np.load(prefix + 'indices.npy', mmap_mode = 'r'),
+                np.load(prefix + 'data.npy', mmap_mode = 'r'),
+                tuple(np.load(prefix + 'shape.npy').tolist())
+            )
+        n_categories = int(np.load(os.path.join(dir, 'complete.npy')))
+        out['category_pairs'] = [
+            np.load(os.path.join(dir, 'pairs' + str(i) + '.npy'), mmap_mode = 'r')
+            for i in range(n_categories)
+        ]
+        with open(os.path.join(dir, 'stats.json'), 'r') as f:
+            out['stats'] = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning('failed to load cached nearfield ' + key + ': ' + str(e))
+        return None
+    cache.touch(key)
+    return out
@@ -1,11 +1,21 @@
+import os
+import weakref
+import tempfile
 import scipy.sparse
 import numpy as np
 
 import tectosaur.mesh.find_near_adj as find_near_adj
 
-from tectosaur.nearfield.pairs_integrator import PairsIntegrator
+from tectosaur.nearfield.pairs_integrator import PairsIntegrator, \
+    normalized_separation, adaptive_nq, pairs_func_name
+from tectosaur.nearfield.table_lookup import coincident_table, adjacent_table
+import tectosaur.nearfield.nearfield_cache as nearfield_cache
+import tectosaur.nearfield.congruence as congruence
+import tectosaur.nearfield.triangle_rules as triangle_rules
+from tectosaur.util.quadrature import gauss4d_tri
 
 from tectosaur.util.timer import Timer
+from tectosaur.util.memory import MemoryMonitor
 import tectosaur.util.sparse as sparse
 import tectosaur.util.gpu as gpu
 
@@ -21,46 +31,81 @@ def any_nearfield(pts, tris, obs_subset, src_subset, near_threshold):
     )
     return nearfield_pairs_dofs.shape[0] > 0
 
+def subset_positions(subset, values):
+    """
+    For each entry of values, the index of its first occurrence in subset.
+    """
+    subset = np.asarray(subset)
+    values = np.asarray(values)
+    order = np.argsort(subset, kind = 'stable')
+    sorted_subset = subset[order]
+    pos = np.searchsorted(sorted_subset, values)
+    pos_in_range = np.minimum(pos, max(subset.shape[0] - 1, 0))
+    if values.size > 0 and (subset.shape[0] == 0 or
+            np.any(sorted_subset[pos_in_range] != values)):
+        raise ValueError('triangle index not found in subset')
+    return order[pos_in_range]
+
 def to_dof_space(tri_indices, obs_subset, src_subset):
-    dof_space_indices = []
-    for pair in tri_indices:
-        try:
-            dof_space_indices.append([
-                np.where(obs_subset == pair[0])[0][0],
-                np.where(src_subset == pair[1])[0][0]
-            ])
-        except:
-            import ipdb
-            ipdb.set_trace()
-    dof_space_indices = np.array(dof_space_indices)
-    if dof_space_indices.shape[0] == 0:
-        dof_space_indices = np.empty((0, 2), dtype = np.int)
-    return dof_space_indices
+    tri_indices = np.asarray(tri_indices)
+    if tri_indices.shape[0] == 0:
+        return np.empty((0, 2), dtype = np.int64)
+    return np.array([
+        subset_positions(obs_subset, tri_indices[:,0]),
+        subset_positions(src_subset, tri_indices[:,1])
+    ]).T
 
 def to_tri_space(dof_indices, obs_subset, src_subset):
     tri_idxs = np.array([obs_subset[dof_indices[:,0]], src_subset[dof_indices[:,1]]]).T
     return np.concatenate((tri_idxs, dof_indices[:,2:]), axis = 1)
 
 def edge_adj_orient(touching_verts):
-    tv = sorted(touching_verts)
-    if tv[0] == 0:
-        if tv[1] == 2:
-            return 2
-        return 0
-    return 1
+    # touching_verts has shape (n, 2). The result is the number of clicks that
+    # rotate the shared edge to the (0, 1) edge of the triangle.
+    touching_verts = np.asarray(touching_verts)
+    lo = np.min(touching_verts, axis = 1)
+    hi = np.max(touching_verts, axis = 1)
+    return np.where(lo == 0, np.where(hi == 2, 2, 0), 1)
 
 def resolve_ea_rotation(tris, ea):
-    out = []
-    for i in range(ea.shape[0]):
-        obs_clicks = edge_adj_orient([ea[i,2], ea[i,4]])
-        src_clicks = edge_adj_orient([ea[i,3], ea[i,5]])
-        src_flip = False
-        if tris[ea[i,0], (0 + obs_clicks) % 3] != tris[ea[i,1], (1 + src_clicks) % 3] or \
-                tris[ea[i,0], (1 + obs_clicks) % 3] != tris[ea[i,1], (0 + src_clicks) % 3]:
-            src_flip = True
-        out.append((ea[i,0], ea[i,1], obs_clicks, src_clicks, src_flip))
-    return np.array(out)
+    ea = np.asarray(ea)
+    if ea.shape[0] == 0:
+        return np.empty((0, 5), dtype = np.int64)
+    obs_clicks = edge_adj_orient(ea[:,[2,4]])
+    src_clicks = edge_adj_orient(ea[:,[3,5]])
+    obs_tris = tris[ea[:,0]]
+    src_tris = tris[ea[:,1]]
+    rows = np.arange(ea.shape[0])
+    src_flip = (
+        (obs_tris[rows, obs_clicks] != src_tris[rows, (1 + src_clicks) % 3])
+        | (obs_tris[rows, (1 + obs_clicks) % 3] != src_tris[rows, src_clicks])
+    )
+    return np.array([
+        ea[:,0], ea[:,1], obs_clicks, src_clicks, src_flip
+    ], dtype = ea.dtype).T
+
+def find_pair_categories(pts, tris, obs_subset, src_subset, near_threshold,
+        mesh_context = None):
+    # The nearfield, vertex adjacent and edge adjacent pairs in both
+    # triangle and dof space. The adjacent pair lists have the five columns
+    # the adjacent pair kernels expect. With a mesh_context, the categories
+    # are shared with every other operator on the same mesh.
+    if mesh_context is not None:
+        return mesh_context.pair_categories(obs_subset, src_subset, near_threshold)
+    close_or_touch_pairs = find_near_adj.find_close_or_touching(
+        pts, tris[obs_subset], pts, tris[src_subset], near_threshold
+    )
+    return split_pair_categories(tris, obs_subset, src_subset, close_or_touch_pairs)
 
+def split_pair_categories(tris, obs_subset, src_subset, close_or_touch_pairs):
+    nearfield_pairs_dofs, va_dofs, ea_dofs = find_near_adj.split_adjacent_close(
+        close_or_touch_pairs, tris[obs_subset], tris[src_subset]
+    )
+    nearfield_pairs = to_tri_space(nearfield_pairs_dofs, obs_subset, src_subset)
+    va = to_tri_space(va_dofs, obs_subset, src_subset)
+    va = np.hstack((va, np.zeros((va.shape[0], 1))))
+    ea = resolve_ea_rotation(tris, to_tri_space(ea_dofs, obs_subset, src_subset))
+    return nearfield_pairs, nearfield_pairs_dofs, va, va_dofs, ea, ea_dofs
 
 def build_nearfield(shape, *mats):
     out = []
@@ -73,112 +118,305 @@ def build_nearfield(shape, *mats):
         out.append(bcoo)
     return out
 
-class RegularizedNearfieldIntegralOp:
+def alloc_blocks(n_blocks, float_type, storage_dir = None, name = None):
+    shape = (n_blocks, 9, 9)
+    if storage_dir is None or n_blocks == 0:
+        return np.zeros(shape, dtype = float_type)
+    os.makedirs(storage_dir, exist_ok = True)
+    # Every matrix gets its own file, so operators can share a storage_dir.
+    # The file is removed once the memmap and every view of it are released.
+    fd, filepath = tempfile.mkstemp(
+        dir = storage_dir, prefix = name + '_', suffix = '.dat'
+    )
+    os.close(fd)
+    # A new memmap file starts out zeroed.
+    out = np.memmap(filepath, dtype = float_type, mode = 'w+', shape = shape)
+    weakref.finalize(out, os.remove, filepath)
+    return out
+
+class NearfieldParts:
+    """
+    Collects the (uncorrected, correction, dofs) blocks of each nearfield
+    category. In lean mode, the correction is subtracted in place and the
+    uncorrected blocks are dropped, so only one set of 9x9 blocks is kept.
+    """
+    def __init__(self, lean):
+        self.lean = lean
+        self.corrected = []
+        self.uncorrected = []
+
+    def add(self, entries, correction, dofs):
+        if self.lean:
+            entries -= correction
+        else:
+            self.uncorrected.append((entries, dofs))
+            entries = entries - correction
+        self.corrected.append((entries, dofs))
+
+    def add_corrected(self, corrected, uncorrected, dofs):
+        # For blocks that already had the correction subtracted on the device.
+        if not self.lean:
+            self.uncorrected.append((uncorrected, dofs))
+        self.corrected.append((corrected, dofs))
+
+class NearfieldMatrixOp:
+    """
+    Shared matrix storage for the nearfield ops. The corrected blocks of the
+    coincident, edge adjacent, vertex adjacent and nearfield pairs are summed
+    into the single BSR matrix self.mat. self.category_pairs keeps the dof
+    pairs of each category, in that order. Outside of lean mode,
+    self.mat_no_correction holds the uncorrected blocks in the same form. In
+    lean mode, mat_no_correction is None and the far rule corrections are
+    recomputed when an uncorrected product is asked for.
+    """
+    # dot is a host BSR product that can run on any thread.
+    dot_uses_device = False
+
+    def setup_storage(self, lean, obs_subset, src_subset, correction_args):
+        self.lean = lean
+        self.obs_subset = obs_subset
+        self.src_subset = src_subset
+        self.correction_args = correction_args
+        self.correction_pairs_int = None
+        self.mat_no_correction = None
+        self.congruence_stats = dict()
+        self.nearfield_bin_stats = []
+
+    def finish_storage(self, parts):
+        self.category_pairs = [
+            np.ascontiguousarray(dofs[:,:2], dtype = np.int64)
+            for _, dofs in parts.corrected
+        ]
+        self.mat = sparse.sum_to_bsr(build_nearfield(self.shape, *parts.corrected))
+        if not self.lean:
+            self.mat_no_correction = sparse.sum_to_bsr(
+                build_nearfield(self.shape, *parts.uncorrected)
+            )
+        self.report_memory()
+
+    def allocate_storage(self, category_dofs, float_type, storage_dir = None):
+        # Builds the final BSR structure up front so that the blocks of each
+        # category can be streamed straight into place by the consumers from
+        # block_consumer, without first holding a copy of every block. With a
+        # storage_dir, the block data lives in memory-mapped files there.
+        self.category_pairs = [
+            np.ascontiguousarray(dofs[:,:2], dtype = np.int64)
+            for dofs in category_dofs
+        ]
+        indptr, indices, self.category_slots = sparse.bsr_structure(
+            self.shape, 9,
+            [p[:,0] for p in self.category_pairs],
+            [p[:,1] for p in self.category_pairs]
+        )
+        names = ['mat'] if self.lean else ['mat', 'mat_no_correction']
+        for name in names:
+            data = alloc_blocks(indices.shape[0], float_type, storage_dir, name)
+            setattr(self, name, sparse.BSRMatrix(indptr, indices, data, self.shape))
+
+    def block_consumer(self, category):
+        slots = self.category_slots[category]
+        def consume(idxs, corrected, uncorrected = None):
+            # The pairs of a single category are unique, so no two blocks in
+            # one chunk share a slot.
+            chunk_slots = slots[idxs]
+            self.mat.data[chunk_slots] += corrected.reshape((-1, 9, 9))
+            if uncorrected is not None:
+                self.mat_no_correction.data[chunk_slots] += \
+                    uncorrected.reshape((-1, 9, 9))
+        return consume
+
+    def report_memory(self):
+        pairs_nbytes = sum(p.nbytes for p in self.category_pairs)
+        self.nbytes = self.mat.nbytes + pairs_nbytes
+        if self.mat_no_correction is not None:
+            self.nbytes += self.mat_no_correction.nbytes
+        self.saved_bytes = 0
+        if self.lean:
+            self.saved_bytes = self.mat.data.nbytes
+        logger.debug(
+            'nearfield matrices use {:.1f} MB, lean mode saved {:.1f} MB'.format(
+                self.nbytes / 1e6, self.saved_bytes / 1e6
+            )
+        )
+
+    def correction_mats(self):
+        if self.correction_pairs_int is None:
+            self.correction_pairs_int = PairsIntegrator(*self.correction_args)
+        for i, dofs in enumerate(self.category_pairs):
+            pairs = np.array([self.obs_subset[dofs[:,0]], self.src_subset[dofs[:,1]]]).T
+            correction = self.correction_pairs_int.correction(pairs, i == 0)
+            yield sparse.BCOOMatrix(
+                dofs[:,0], dofs[:,1], correction.reshape((-1, 9, 9)), self.shape
+            )
+
+    def no_correction_mats(self):
+        if self.mat_no_correction is not None:
+            return [self.mat_no_correction]
+        return [self.mat] + list(self.correction_mats())
+
+    def full_scipy_mat(self):
+        return self.mat.to_scipy()
+
+    def full_scipy_mat_no_correction(self):
+        return sum([m.to_bsr().to_scipy() for m in self.no_correction_mats()])
+
+    def dot(self, v):
+        return self.mat.dot(v)
+
+    def nearfield_no_correction_dot(self, v):
+        return sum(arr.dot(v) for arr in self.no_correction_mats())
+
+    def to_dense(self):
+        return self.mat.to_dense()
+
+    def no_correction_to_dense(self):
+        return sum([
+            mat.to_bsr().to_scipy().todense() for mat in self.no_correction_mats()
+        ])
+
+class RegularizedNearfieldIntegralOp(NearfieldMatrixOp):
     def __init__(self, pts, tris, obs_subset, src_subset,
             nq_coincident, nq_edge_adj, nq_vert_adjacent,
             nq_far, nq_near, near_threshold,
-            K_near_name, K_far_name, params, float_type):
+            K_near_name, K_far_name, params, float_type, cache = None,
+            lean = False, nearfield_tol = None, memory_budget = None,
+            storage_dir = None, mesh_context = None):
+        # The blocks are streamed from the device into the preallocated final
+        # matrices. memory_budget (bytes) bounds the host memory used for the
+        # blocks in flight. storage_dir puts the matrix data in memory-mapped
+        # files instead of RAM.
 
         n_obs_dofs = obs_subset.shape[0] * 9
         n_src_dofs = src_subset.shape[0] * 9
         self.shape = (n_obs_dofs, n_src_dofs)
+        self.setup_storage(
+            lean, obs_subset, src_subset,
+            (K_far_name, params, float_type, nq_far, nq_near, pts, tris)
+        )
 
         timer = Timer(output_fnc = logger.debug, tabs = 1)
+        monitor = MemoryMonitor(output_fnc = logger.debug, tabs = 1)
+        try:
+            self.assemble(
+                timer, monitor, pts, tris, obs_subset, src_subset,
+                nq_coincident, nq_edge_adj, nq_vert_adjacent,
+                nq_far, nq_near, near_threshold,
+                K_near_name, K_far_name, params, float_type, cache,
+                lean, nearfield_tol, memory_budget, storage_dir, mesh_context
+            )
+        finally:
+            monitor.stop()
+            self.memory_report = monitor.stages
+
+    def assemble(self, timer, monitor, pts, tris, obs_subset, src_subset,
+            nq_coincident, nq_edge_adj, nq_vert_adjacent,
+            nq_far, nq_near, near_threshold,
+            K_near_name, K_far_name, params, float_type, cache,
+            lean, nearfield_tol, memory_budget, storage_dir, mesh_context):
+        def report(name):
+            timer.report(name)
+            monitor.report(name)
+
+        cache = nearfield_cache.get_cache(cache)
+        if cache is not None:
+            cache_key = nearfield_cache.cache_key(
+                'RegularizedNearfieldIntegralOp', pts, tris, obs_subset, src_subset,
+                nq_coincident, nq_edge_adj, nq_vert_adjacent, nq_far, nq_near,
+                near_threshold, K_near_name, K_far_name, list(params), float_type,
+                nearfield_tol
+            )
+            names = ['mat'] if lean else ['mat', 'mat_no_correction']
+            cached = nearfield_cache.load(cache, cache_key, names)
+            if cached is not None:
+                self.mat = cached['mat']
+                self.mat_no_correction = cached.get('mat_no_correction', None)
+                self.category_pairs = cached['category_pairs']
+                self.nearfield_bin_stats = cached['stats'].get('nearfield_bins', [])
+                self.congruence_stats = cached['stats'].get('congruence', dict())
+                report('Load cached nearfield')
+                self.report_memory()
+                return
+
+        # The near rules and the far rule corrections are computed together
+        # and only their difference (and, outside of lean mode, the uncorrected
+        # blocks) comes back from the device.
         pairs_int = PairsIntegrator(
-            K_near_name, params, float_type, nq_far, nq_near, pts, tris
-        )
-        correction_pairs_int = PairsIntegrator(
-            K_far_name, params, float_type, nq_far, nq_near, pts, tris
+            K_near_name, params, float_type, nq_far, nq_near, pts, tris,
+            correction_kernel = K_far_name, host_memory_budget = memory_budget
         )
-        timer.report('setup pairs integrator')
+        report('setup pairs integrator')
+        fused = dict(corrected = True, keep_uncorrected = not lean)
 
         co_tris = np.intersect1d(obs_subset, src_subset)
         co_indices = np.array([co_tris, co_tris]).T.copy()
         co_dofs = to_dof_space(co_indices, obs_subset, src_subset)
 
-        co_mat = pairs_int.coincident(nq_coincident, co_indices)
-
-        timer.report("Coincident")
-        co_mat_correction = correction_pairs_int.correction(co_indices, True)
-        timer.report("Coincident correction")
+        nearfield_pairs, nearfield_pairs_dofs, va, va_dofs, ea, ea_dofs = \
+            find_pair_categories(
+                pts, tris, obs_subset, src_subset, near_threshold, mesh_context
+            )
+        report("Find nearfield/adjacency")
 
-        close_or_touch_pairs = find_near_adj.find_close_or_touching(
-            pts, tris[obs_subset], pts, tris[src_subset], near_threshold
+        self.allocate_storage(
+            [co_dofs, ea_dofs, va_dofs, nearfield_pairs_dofs], float_type, storage_dir
         )
-        nearfield_pairs_dofs, va_dofs, ea_dofs = find_near_adj.split_adjacent_close(
-            close_or_touch_pairs, tris[obs_subset], tris[src_subset]
-        )
-        nearfield_pairs = to_tri_space(nearfield_pairs_dofs, obs_subset, src_subset)
-        va = to_tri_space(va_dofs, obs_subset, src_subset)
-        va = np.hstack((va, np.zeros((va.shape[0], 1))))
-        ea = resolve_ea_rotation(tris, to_tri_space(ea_dofs, obs_subset, src_subset))
-        timer.report("Find nearfield/adjacency")
-
-        ea_mat_rot = pairs_int.edge_adj(nq_edge_adj, ea)
-        timer.report("Edge adjacent")
-        if ea.shape[0] == 0:
-            ea_mat_correction = 0 * ea_mat_rot
-        else:
-            ea_mat_correction = correction_pairs_int.correction(ea[:,:2], False)
-        timer.report("Edge adjacent correction")
+        report("Allocate matrix")
 
-        va_mat_rot = pairs_int.vert_adj(nq_vert_adjacent, va)
-        timer.report("Vert adjacent")
-        va_mat_correction = correction_pairs_int.correction(va[:,:2], False)
-        timer.report("Vert adjacent correction")
-
-        nearfield_mat = pairs_int.nearfield(nearfield_pairs)
-        timer.report("Nearfield")
-        nearfield_correction = correction_pairs_int.correction(nearfield_pairs, False)
-        timer.report("Nearfield correction")
-
-        self.mat = build_nearfield(
-            self.shape,
-            (co_mat - co_mat_correction, co_dofs),
-            (ea_mat_rot - ea_mat_correction, ea_dofs[:,:2]),
-            (va_mat_rot - va_mat_correction, va_dofs[:,:2]),
-            (nearfield_mat - nearfield_correction, nearfield_pairs_dofs)
-        )
-        timer.report("Assemble matrix")
-        self.mat_no_correction = build_nearfield(
-            self.shape,
-            (co_mat, co_dofs),
-            (ea_mat_rot, ea_dofs[:,:2]),
-            (va_mat_rot, va_dofs[:,:2]),
-            (nearfield_mat, nearfield_pairs_dofs),
+        pairs_int.coincident(
+            nq_coincident, co_indices, consumer = self.block_consumer(0), **fused
         )
-        timer.report("Assemble uncorrected matrix")
+        report("Coincident")
 
-    def full_scipy_mat(self):
-        return sum([m.to_bsr().to_scipy() for m in self.mat])
-
-    def full_scipy_mat_no_correction(self):
-        return sum([m.to_bsr().to_scipy() for m in self.mat_no_correction])
-
-    def dot(self, v):
-        return sum(arr.dot(v) for arr in self.mat)
-
-    def nearfield_no_correction_dot(self, v):
-        return sum(arr.dot(v) for arr in self.mat_no_correction)
-
-    def to_dense(self):
-        return sum([mat.to_bsr().to_scipy().todense() for mat in self.mat])
+        pairs_int.edge_adj(nq_edge_adj, ea, consumer = self.block_consumer(1), **fused)
+        report("Edge adjacent")
 
-    def no_correction_to_dense(self):
-        return sum([mat.to_bsr().to_scipy().todense() for mat in self.mat_no_correction])
+        pairs_int.vert_adj(
+            nq_vert_adjacent, va, consumer = self.block_consumer(2), **fused
+        )
+        report("Vert adjacent")
 
-class NearfieldIntegralOp:
+        pairs_int.nearfield(
+            nearfield_pairs, tol = nearfield_tol,
+            consumer = self.block_consumer(3), **fused
+        )
+        self.nearfield_bin_stats = pairs_int.nearfield_bin_stats
+        report("Nearfield")
+
+        self.congruence_stats = pairs_int.congruence_stats
+        logger.debug(congruence.report(self.congruence_stats))
+        self.report_memory()
+
+        if cache is not None:
+            to_save = dict(mat = self.mat)
+            if not lean:
+                to_save['mat_no_correction'] = self.mat_no_correction
+            stats = dict(
+                nearfield_bins = self.nearfield_bin_stats,
+                congruence = self.congruence_stats
+            )
+            nearfield_cache.save(
+                cache, cache_key, to_save, self.category_pairs, stats
+            )
+            report("Save nearfield to cache")
+
+class NearfieldIntegralOp(NearfieldMatrixOp):
     def __init__(self, pts, tris, obs_subset, src_subset,
             nq_vert_adjacent, nq_far, nq_near, near_threshold,
-            kernel, params, float_type):
+            kernel, params, float_type, lean = False, mesh_context = None):
 
         n_obs_dofs = obs_subset.shape[0] * 9
         n_src_dofs = src_subset.shape[0] * 9
         self.shape = (n_obs_dofs, n_src_dofs)
+        self.setup_storage(
+            lean, obs_subset, src_subset,
+            (kernel, params, float_type, nq_far, nq_near, pts, tris)
+        )
 
         timer = Timer(output_fnc = logger.debug, tabs = 1)
         pairs_int = PairsIntegrator(kernel, params, float_type, nq_far, nq_near, pts, tris)
+        self.correction_pairs_int = pairs_int
         timer.report('setup pairs integrator')
+        parts = NearfieldParts(lean)
 
         co_tris = np.intersect1d(obs_subset, src_subset)
         co_indices = np.array([co_tris, co_tris]).T.copy()
@@ -186,60 +424,148 @@ class NearfieldIntegralOp:
 
         co_mat = coincident_table(kernel, params, pts[tris[co_tris]], float_type)
         timer.report("Coincident")
-        co_mat_correction = pairs_int.correction(co_indices, True)
+        parts.add(co_mat, pairs_int.correction(co_indices, True), co_dofs)
         timer.report("Coincident correction")
 
-        close_or_touch_pairs = find_near_adj.find_close_or_touching(
-            pts, tris[obs_subset], pts, tris[src_subset], near_threshold
-        )
-        nearfield_pairs_dofs, va_dofs, ea_dofs = find_near_adj.split_adjacent_close(
-            close_or_touch_pairs, tris[obs_subset], tris[src_subset]
-        )
-        nearfield_pairs = to_tri_space(nearfield_pairs_dofs, obs_subset, src_subset)
-        va = to_tri_space(va_dofs, obs_subset, src_subset)
-        ea = to_tri_space(ea_dofs, obs_subset, src_subset)
+        nearfield_pairs, nearfield_pairs_dofs, va, va_dofs, ea, ea_dofs = \
+            find_pair_categories(
+                pts, tris, obs_subset, src_subset, near_threshold, mesh_context
+            )
         timer.report("Find nearfield/adjacency")
 
-        ea_mat_rot = adjacent_table(nq_vert_adjacent, kernel, params, pts, tris, ea, float_type)
+        ea_mat_rot = adjacent_table(
+            nq_vert_adjacent, kernel, params, pts, tris, ea, float_type,
+            nq_near = nq_near
+        )
         timer.report("Edge adjacent")
-        ea_mat_correction = pairs_int.correction(ea, False)
+        parts.add(ea_mat_rot, pairs_int.correction(ea[:,:2], False), ea_dofs[:,:2])
         timer.report("Edge adjacent correction")
 
         va_mat_rot = pairs_int.vert_adj(nq_vert_adjacent, va)
         timer.report("Vert adjacent")
-        va_mat_correction = pairs_int.correction(va[:,:2], False)
+        parts.add(va_mat_rot, pairs_int.correction(va[:,:2], False), va_dofs[:,:2])
         timer.report("Vert adjacent correction")
 
         nearfield_mat = pairs_int.nearfield(nearfield_pairs)
         timer.report("Nearfield")
-        nearfield_correction = pairs_int.correction(nearfield_pairs, False)
+        parts.add(
+            nearfield_mat, pairs_int.correction(nearfield_pairs, False),
+            nearfield_pairs_dofs
+        )
         timer.report("Nearfield correction")
 
-        self.mat = build_nearfield(
-            self.shape,
-            (co_mat - co_mat_correction, co_dofs),
-            (ea_mat_rot - ea_mat_correction, ea_dofs[:,:2]),
-            (va_mat_rot - va_mat_correction, va_dofs[:,:2]),
-            (nearfield_mat - nearfield_correction, nearfield_pairs_dofs)
-        )
+        self.finish_storage(parts)
         timer.report("Assemble matrix")
-        self.mat_no_correction = build_nearfield(
-            self.shape,
-            (co_mat, co_dofs),
-            (ea_mat_rot, ea_dofs[:,:2]),
-            (va_mat_rot, va_dofs[:,:2]),
-            (nearfield_mat, nearfield_pairs_dofs),
+
+class MatrixFreeNearfieldIntegralOp:
+    """
+    The products of RegularizedNearfieldIntegralOp without storing any
+    nearfield blocks. Only the pair lists of each category and the
+    quadrature rules are kept on the device and every product recomputes the
+    blocks in a kernel, trading FLOPs for memory.
+    """
+    # dot launches kernels, so it has to run on a thread with the gpu context.
+    dot_uses_device = True
+
+    def __init__(self, pts, tris, obs_subset, src_subset,
+            nq_coincident, nq_edge_adj, nq_vert_adjacent,
+            nq_far, nq_near, near_threshold,
+            K_near_name, K_far_name, params, float_type, nearfield_tol = None,
+            mesh_context = None):
+
+        n_obs_dofs = obs_subset.shape[0] * 9
+        n_src_dofs = src_subset.shape[0] * 9
+        self.shape = (n_obs_dofs, n_src_dofs)
+        self.congruence_stats = dict()
+        self.nearfield_bin_stats = []
+
+        timer = Timer(output_fnc = logger.debug, tabs = 1)
+        self.pairs_int = PairsIntegrator(
+            K_near_name, params, float_type, nq_far, nq_near, pts, tris,
+            congruence = False, correction_kernel = K_far_name
         )
-        timer.report("Assemble uncorrected matrix")
+        timer.report('setup pairs integrator')
 
-    def dot(self, v):
-        return sum(arr.dot(v) for arr in self.mat)
+        co_tris = np.intersect1d(obs_subset, src_subset)
+        co_indices = np.array([co_tris, co_tris]).T.copy()
+        co_dofs = to_dof_space(co_indices, obs_subset, src_subset)
+        nearfield_pairs, nearfield_pairs_dofs, va, va_dofs, ea, ea_dofs = \
+            find_pair_categories(
+                pts, tris, obs_subset, src_subset, near_threshold, mesh_context
+            )
+        timer.report("Find nearfield/adjacency")
 
-    def nearfield_no_correction_dot(self, v):
-        return sum(arr.dot(v) for arr in self.mat_no_correction)
+        if type(nq_vert_adjacent) is int:
+            nq_vert_adjacent = (nq_vert_adjacent,) * 3
+        adj_fnc = pairs_func_name(False) + '_adj_matvec'
+        self.categories = []
+        self.add_category(
+            pairs_func_name(True) + '_matvec',
+            triangle_rules.coincident_quad(nq_coincident), co_indices, co_dofs
+        )
+        self.add_category(
+            adj_fnc, triangle_rules.edge_adj_quad(nq_edge_adj), ea, ea_dofs
+        )
+        self.add_category(
+            adj_fnc, triangle_rules.vertex_adj_quad(*nq_vert_adjacent), va, va_dofs
+        )
 
-    def to_dense(self):
-        return sum([mat.to_bsr().to_scipy().todense() for mat in self.mat])
+        near_fnc = pairs_func_name(False) + '_matvec'
+        if nearfield_tol is None or nearfield_pairs.shape[0] == 0:
+            self.add_category(
+                near_fnc, gauss4d_tri(nq_near, nq_near),
+                nearfield_pairs, nearfield_pairs_dofs
+            )
+        else:
+            sep = normalized_separation(pts, tris, nearfield_pairs)
+            nqs = adaptive_nq(sep, nearfield_tol, min(nq_far, nq_near), nq_near)
+            for nq in np.unique(nqs):
+                idxs = np.where(nqs == nq)[0]
+                self.add_category(
+                    near_fnc, gauss4d_tri(nq, nq),
+                    nearfield_pairs[idxs], nearfield_pairs_dofs[idxs]
+                )
+                self.nearfield_bin_stats.append(dict(
+                    nq = int(nq), n_pairs = idxs.shape[0],
+                    min_sep = float(np.min(sep[idxs])),
+                    max_sep = float(np.max(sep[idxs]))
+                ))
+        timer.report("Upload pair lists")
+
+        self.nbytes = sum(
+            c['gpu_pairs'].nbytes + c['obs_dofs'].nbytes + c['src_dofs'].nbytes
+            for c in self.categories
+        )
+        logger.debug('matrix free nearfield uses {:.1f} MB'.format(self.nbytes / 1e6))
+
+    def add_category(self, fnc_name, q, pairs, dofs):
+        self.categories.append(dict(
+            integrator = getattr(self.pairs_int.module, fnc_name),
+            q = self.pairs_int.quad_to_gpu(q),
+            gpu_pairs = gpu.to_gpu(np.ascontiguousarray(pairs), np.int32),
+            obs_dofs = np.ascontiguousarray(dofs[:,0], dtype = np.int64),
+            src_dofs = np.ascontiguousarray(dofs[:,1], dtype = np.int64),
+        ))
+
+    def product(self, v, subtract_correction):
+        v_blocks = v.reshape((-1, 9))
+        n_obs_blocks = self.shape[0] // 9
+        out = np.zeros((n_obs_blocks, 9))
+        for c in self.categories:
+            if c['obs_dofs'].shape[0] == 0:
+                continue
+            pair_out = self.pairs_int.pairs_matvec(
+                c['integrator'], c['q'], c['gpu_pairs'], v_blocks[c['src_dofs']],
+                subtract_correction
+            )
+            for k in range(9):
+                out[:,k] += np.bincount(
+                    c['obs_dofs'], weights = pair_out[:,k], minlength = n_obs_blocks
+                )
+        return out.flatten()
 
-    def no_correction_to_dense(self):
-        return sum([mat.to_bsr().to_scipy().todense() for mat in self.mat_no_correction])
+    def dot(self, v):
+        return self.product(v, True)
+
+    def nearfield_no_correction_dot(self, v):
+        return self.product(v, False)
@@ -1,6 +1,7 @@
 import numpy as np
 
 import tectosaur.nearfield.triangle_rules as triangle_rules
+from tectosaur.nearfield.congruence import CongruenceGroups
 import tectosaur.util.gpu as gpu
 from tectosaur.util.quadrature import gauss4d_tri
 
@@ -10,24 +11,78 @@ def pairs_func_name(check0):
         check0_label = 'Z'
     return 'single_pairs' + check0_label
 
+import logging
+logger = logging.getLogger(__name__)
+
 block_size = 256
 
-def get_gpu_config(kernel, float_type):
+def get_gpu_config(kernel, float_type, correction_kernel = None):
     return dict(
         block_size = block_size,
         float_type = gpu.np_to_c_type(float_type),
-        kernel_name = kernel
+        kernel_name = kernel,
+        correction_kernel_name = correction_kernel
     )
 
-def get_gpu_module(kernel, float_type):
+def get_gpu_module(kernel, float_type, correction_kernel = None):
     return gpu.load_gpu('assemble.cl', tmpl_args = get_gpu_config(
-        kernel, float_type
+        kernel, float_type, correction_kernel
+    ))
+
+# Each in-flight chunk gets its own queue/stream so that the kernel for one
+# chunk runs while the previous chunk's results are copied back to the host.
+n_streams = 2
+# Fraction of device memory the in-flight result buffers may use together.
+chunk_memory_fraction = 0.25
+min_chunk_size = 2 ** 12
+max_chunk_size = 2 ** 20
+
+def normalized_separation(pts, tris, pairs_list):
+    # Centroid distance over the sum of the triangle radii, the same measure
+    # find_near_adj.find_close_or_touching compares to near_threshold.
+    tri_pts = pts[tris]
+    centroids = np.mean(tri_pts, axis = 1)
+    r = np.sqrt(np.max(
+        np.sum((tri_pts - centroids[:,np.newaxis,:]) ** 2, axis = 2), axis = 1
     ))
+    obs, src = pairs_list[:,0], pairs_list[:,1]
+    dist = np.linalg.norm(centroids[obs] - centroids[src], axis = 1)
+    return dist / (r[obs] + r[src])
+
+def adaptive_nq(sep, tol, nq_min, nq_max):
+    # A Gauss rule converges like rho ** (-2 * nq) where rho is the size of
+    # the Bernstein ellipse that just reaches the nearest singularity. Pairs
+    # that overlap in the sense of sep <= 1 get the maximum order.
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        rho = sep + np.sqrt(sep ** 2 - 1)
+        nq = np.ceil(np.log(1.0 / tol) / (2 * np.log(rho)))
+    nq[~(sep > 1)] = nq_max
+    return np.clip(nq, nq_min, nq_max).astype(np.int64)
 
 class PairsIntegrator:
-    def __init__(self, kernel, params, float_type, nq_far, nq_near, pts, tris):
+    def __init__(self, kernel, params, float_type, nq_far, nq_near, pts, tris,
+            n_streams = n_streams, chunk_size = None, congruence = True,
+            correction_kernel = None, host_memory_budget = None):
+        # With a correction_kernel, the coincident, edge_adj, vert_adj and
+        # nearfield methods can also return the singular or near rule result
+        # minus the far rule correction with correction_kernel, computed in
+        # one pass on the device.
+        # host_memory_budget (bytes) caps the chunk size so that the chunks
+        # in flight, and a consumer's temporary copy of each, fit in it.
+        self.kernel = kernel
+        self.correction_kernel = correction_kernel
+        self.nq_far = nq_far
+        self.nq_near = nq_near
+        self.nearfield_bin_stats = []
         self.float_type = float_type
-        self.module = get_gpu_module(kernel, float_type)
+        self.congruence = congruence
+        self.congruence_stats = dict()
+        self.pts = np.asarray(pts)
+        self.tris = np.asarray(tris)
+        self.n_streams = n_streams
+        self.fixed_chunk_size = chunk_size
+        self.host_memory_budget = host_memory_budget
+        self.module = get_gpu_module(kernel, float_type, correction_kernel)
         self.gpu_params = gpu.to_gpu(np.array(params), self.float_type)
         self.gpu_near_q = self.quad_to_gpu(gauss4d_tri(nq_near, nq_near))
         self.gpu_far_q = self.quad_to_gpu(gauss4d_tri(nq_far, nq_far))
@@ -37,57 +92,316 @@ class PairsIntegrator:
     def quad_to_gpu(self, q):
         return [gpu.to_gpu(arr, self.float_type) for arr in q]
 
-    def get_gpu_fnc(self, check0):
-        return getattr(self.module, pairs_func_name(check0))
+    def get_gpu_fnc(self, check0, corrected = False):
+        name = pairs_func_name(check0)
+        if corrected:
+            name += '_corrected'
+        return getattr(self.module, name)
 
-    def pairs_quad(self, integrator, q, pairs_list):
-        gpu_pairs_list = gpu.to_gpu(pairs_list.copy(), np.int32)
+    def get_adj_fnc(self, corrected = False):
+        name = pairs_func_name(False) + '_adj'
+        if corrected:
+            name += '_corrected'
+        return getattr(self.module, name)
+
+    def chunk_size(self, n_outputs = 1):
+        if self.fixed_chunk_size is not None:
+            return self.fixed_chunk_size
+        mem = gpu.device_memory()
+        budget = min(mem['free'] * chunk_memory_fraction, mem['max_alloc'])
+        bytes_per_pair = n_outputs * 81 * np.dtype(self.float_type).itemsize
+        size = int(budget / (self.n_streams * bytes_per_pair))
+        size = min(max(size, min_chunk_size), max_chunk_size)
+        if self.host_memory_budget is not None:
+            n_in_flight = self.n_streams * gpu.n_devices()
+            host_size = int(self.host_memory_budget / (2 * n_in_flight * bytes_per_pair))
+            size = min(size, max(host_size, block_size))
+        return size - size % block_size
+
+    def pairs_quad(self, integrator, q, pairs_list, far_q = None,
+            keep_uncorrected = False, consumer = None):
+        # Without far_q, the result of the rule q. With far_q, integrator is
+        # a fused kernel and the result is the pair (q result minus far_q
+        # correction, q result or None if not keep_uncorrected).
+        # With a consumer, nothing is returned. Instead, each chunk is passed
+        # to consumer(idxs, *chunk_results) as soon as it arrives, where idxs
+        # selects the chunk's rows of pairs_list, so only the chunks in
+        # flight are ever held in host memory.
+        fused = far_q is not None
+        n_outputs = 2 if fused and keep_uncorrected else 1
         n = pairs_list.shape[0]
 
+        results = None
+        if consumer is None:
+            results = [
+                np.empty((n, 3, 3, 3, 3), dtype = self.float_type)
+                for j in range(n_outputs)
+            ]
         if n == 0:
-            return np.empty((0,3,3,3,3), dtype = self.float_type)
+            if consumer is None:
+                return self.quad_output(results, fused)
+            return
 
-        call_size = 2 ** 17
-        result = np.empty((n, 3, 3, 3, 3), dtype = self.float_type)
+        gpu_pairs_list = gpu.to_gpu(pairs_list.copy(), np.int32)
+        # Consecutive chunks are dealt out round-robin to every stream of
+        # every device in the device set.
+        streams = [
+            s for stream_idx in range(self.n_streams)
+            for s in [
+                gpu.get_streams(self.n_streams, d)[stream_idx]
+                for d in range(gpu.n_devices())
+            ]
+        ]
+        in_flight = [None] * len(streams)
 
-        def call_integrator(start_idx, end_idx):
+        def call_integrator(start_idx, end_idx, stream):
             n_pairs = (end_idx - start_idx)
             n_threads = int(np.ceil(n_pairs / block_size))
-            gpu_result = gpu.empty_gpu((n_pairs, 3, 3, 3, 3), self.float_type)
+            gpu_results = [
+                gpu.empty_gpu((n_pairs, 3, 3, 3, 3), self.float_type)
+                for j in range(n_outputs)
+            ]
+            args = [gpu_results[0], np.int32(q[0].shape[0]), q[0], q[1]]
+            if fused:
+                args = (
+                    [gpu_results[0], gpu_results[-1], np.int32(q[0].shape[0]), q[0], q[1]]
+                    + [np.int32(far_q[0].shape[0]), far_q[0], far_q[1]]
+                )
+            args += [
+                self.gpu_pts, self.gpu_tris,
+                gpu_pairs_list, np.int32(start_idx), np.int32(end_idx),
+                self.gpu_params
+            ]
+            if fused:
+                args.append(np.int32(keep_uncorrected))
             integrator(
-                gpu_result, np.int32(q[0].shape[0]), q[0], q[1],
+                *args,
+                grid = (n_threads, 1, 1), block = (block_size, 1, 1),
+                stream = stream
+            )
+            if consumer is None:
+                host_results = [r[start_idx:end_idx] for r in results]
+            else:
+                host_results = [
+                    np.empty((n_pairs, 3, 3, 3, 3), dtype = self.float_type)
+                    for j in range(n_outputs)
+                ]
+            copies = [
+                gpu.get_async(gpu_r, r, stream)
+                for gpu_r, r in zip(gpu_results, host_results)
+            ]
+            return copies, gpu_results, (start_idx, end_idx), host_results
+
+        def finish(f):
+            for c in f[0]:
+                c.wait()
+            if consumer is not None:
+                consumer(slice(*f[2]), *self.output_tuple(f[3], fused))
+
+        chunk_size = min(
+            self.chunk_size(n_outputs), int(np.ceil(n / gpu.n_devices()))
+        )
+        for i, I in enumerate(gpu.intervals(n, chunk_size)):
+            which = i % len(streams)
+            if in_flight[which] is not None:
+                finish(in_flight[which])
+            in_flight[which] = call_integrator(*I, streams[which])
+
+        # The remaining chunks finish in launch order.
+        n_launched = len(gpu.intervals(n, chunk_size))
+        for j in range(len(streams)):
+            f = in_flight[(n_launched + j) % len(streams)]
+            if f is not None:
+                finish(f)
+        if consumer is None:
+            return self.quad_output(results, fused)
+
+    def pairs_matvec(self, integrator, q, gpu_pairs_list, v_pairs,
+            subtract_correction):
+        # For a matvec kernel, the product of each pair's block with its row
+        # of v_pairs, the (n, 9) src entries of the input. Only the (n, 9)
+        # products come back from the device.
+        n = v_pairs.shape[0]
+        result = np.empty((n, 9), dtype = self.float_type)
+        if n == 0:
+            return result
+        streams = [
+            s for stream_idx in range(self.n_streams)
+            for s in [
+                gpu.get_streams(self.n_streams, d)[stream_idx]
+                for d in range(gpu.n_devices())
+            ]
+        ]
+        in_flight = [None] * len(streams)
+
+        def call_integrator(start_idx, end_idx, stream):
+            n_pairs = (end_idx - start_idx)
+            n_threads = int(np.ceil(n_pairs / block_size))
+            gpu_result = gpu.empty_gpu((n_pairs, 9), self.float_type)
+            gpu_input = gpu.to_gpu(v_pairs[start_idx:end_idx], self.float_type)
+            integrator(
+                gpu_result, gpu_input, np.int32(q[0].shape[0]), q[0], q[1],
+                np.int32(self.gpu_far_q[0].shape[0]), self.gpu_far_q[0], self.gpu_far_q[1],
                 self.gpu_pts, self.gpu_tris,
                 gpu_pairs_list, np.int32(start_idx), np.int32(end_idx),
-                self.gpu_params,
-                grid = (n_threads, 1, 1), block = (block_size, 1, 1)
+                self.gpu_params, np.int32(subtract_correction),
+                grid = (n_threads, 1, 1), block = (block_size, 1, 1),
+                stream = stream
             )
-            result[start_idx:end_idx] = gpu_result.get()
+            copy = gpu.get_async(gpu_result, result[start_idx:end_idx], stream)
+            return copy, gpu_result, gpu_input
+
+        chunk_size = min(self.chunk_size(), int(np.ceil(n / gpu.n_devices())))
+        for i, I in enumerate(gpu.intervals(n, chunk_size)):
+            which = i % len(streams)
+            if in_flight[which] is not None:
+                in_flight[which][0].wait()
+            in_flight[which] = call_integrator(*I, streams[which])
 
-        for I in gpu.intervals(n, call_size):
-            call_integrator(*I)
+        for f in in_flight:
+            if f is not None:
+                f[0].wait()
         return result
 
+    def quad_output(self, results, fused):
+        if not fused:
+            return results[0]
+        return results[0], (results[1] if len(results) > 1 else None)
+
+    def output_tuple(self, results, fused):
+        out = self.quad_output(results, fused)
+        return out if fused else (out,)
+
+    def fused_args(self, corrected, keep_uncorrected):
+        if not corrected:
+            return dict()
+        if self.correction_kernel is None:
+            raise ValueError(
+                'corrected results need a PairsIntegrator with a correction_kernel'
+            )
+        return dict(far_q = self.gpu_far_q, keep_uncorrected = keep_uncorrected)
+
+    def singular_quad(self, name, integrator, q, pairs_list, far_q = None,
+            keep_uncorrected = False, consumer = None):
+        # Coincident and adjacent pairs are integrated once per congruence
+        # class. See tectosaur/nearfield/congruence.py
+        quad_args = (integrator, q)
+        quad_kwargs = dict()
+        if far_q is not None:
+            quad_kwargs = dict(far_q = far_q, keep_uncorrected = keep_uncorrected)
+        # The fused results only transform like the kernel's if the correction
+        # kernel is the same.
+        congruence = self.congruence and (
+            far_q is None or self.correction_kernel == self.kernel
+        )
+        if not congruence or pairs_list.shape[0] == 0:
+            return self.pairs_quad(
+                *quad_args, pairs_list, consumer = consumer, **quad_kwargs
+            )
+        groups = CongruenceGroups(self.kernel, self.pts, self.tris, pairs_list)
+        self.congruence_stats[name] = groups.stats()
+        logger.debug('{} congruence: {} pairs, {} unique'.format(
+            name, groups.n_pairs, groups.n_unique
+        ))
+        rep_results = self.pairs_quad(
+            *quad_args, pairs_list[groups.rep_idxs], **quad_kwargs
+        )
+        rep_results = rep_results if far_q is not None else (rep_results,)
+        def scatter(idxs = None):
+            return tuple(
+                None if r is None else groups.scatter(r, self.float_type, idxs)
+                for r in rep_results
+            )
+        if consumer is None:
+            return self.quad_output(scatter(), far_q is not None)
+        # Only the representatives' results are held in full. The expanded
+        # results are handed over a chunk at a time.
+        n = pairs_list.shape[0]
+        step = self.chunk_size(len(rep_results))
+        for start in range(0, n, step):
+            idxs = slice(start, min(start + step, n))
+            consumer(idxs, *scatter(idxs))
+
     def correction(self, pairs_list, check0):
         return self.pairs_quad(self.get_gpu_fnc(check0), self.gpu_far_q, pairs_list)
 
-    def nearfield(self, pairs_list):
-        return self.pairs_quad(self.get_gpu_fnc(False), self.gpu_near_q, pairs_list)
+    def nearfield(self, pairs_list, tol = None, corrected = False,
+            keep_uncorrected = True, consumer = None):
+        # With a tolerance, pairs are binned by normalized separation and each
+        # bin is integrated with the lowest order between nq_far and nq_near
+        # that is expected to reach it.
+        self.nearfield_bin_stats = []
+        integrator = self.get_gpu_fnc(False, corrected)
+        fused_args = self.fused_args(corrected, keep_uncorrected)
+        if tol is None or pairs_list.shape[0] == 0:
+            return self.pairs_quad(
+                integrator, self.gpu_near_q, pairs_list,
+                consumer = consumer, **fused_args
+            )
+        sep = normalized_separation(self.pts, self.tris, pairs_list)
+        nqs = adaptive_nq(sep, tol, min(self.nq_far, self.nq_near), self.nq_near)
+        n_outputs = 2 if corrected and keep_uncorrected else 1
+        results = None
+        if consumer is None:
+            results = [
+                np.empty((pairs_list.shape[0], 3, 3, 3, 3), dtype = self.float_type)
+                for j in range(n_outputs)
+            ]
+        for nq in np.unique(nqs):
+            idxs = np.where(nqs == nq)[0]
+            if nq == self.nq_near:
+                q = self.gpu_near_q
+            else:
+                q = self.quad_to_gpu(gauss4d_tri(nq, nq))
+            if consumer is None:
+                bin_results = self.pairs_quad(
+                    integrator, q, pairs_list[idxs], **fused_args
+                )
+                if not corrected:
+                    bin_results = [bin_results]
+                for r, bin_r in zip(results, bin_results):
+                    r[idxs] = bin_r
+            else:
+                bin_consumer = lambda chunk, *r, idxs = idxs: consumer(idxs[chunk], *r)
+                self.pairs_quad(
+                    integrator, q, pairs_list[idxs],
+                    consumer = bin_consumer, **fused_args
+                )
+            self.nearfield_bin_stats.append(dict(
+                nq = int(nq), n_pairs = idxs.shape[0],
+                min_sep = float(np.min(sep[idxs])), max_sep = float(np.max(sep[idxs]))
+            ))
+        logger.debug('nearfield bins: ' + ', '.join(
+            'nq={nq}: {n_pairs}'.format(**b) for b in self.nearfield_bin_stats
+        ))
+        if consumer is None:
+            return self.quad_output(results, corrected)
 
-    def vert_adj(self, nq, pairs_list):
-        integrator = getattr(self.module, pairs_func_name(False) + '_adj')
+    def vert_adj(self, nq, pairs_list, corrected = False, keep_uncorrected = True,
+            consumer = None):
         if type(nq) is int:
             nq = (nq, nq, nq)
         q = triangle_rules.vertex_adj_quad(nq[0], nq[1], nq[2])
         gpu_q = self.quad_to_gpu(q)
-        return self.pairs_quad(integrator, gpu_q, pairs_list)
+        return self.singular_quad(
+            'vert_adj', self.get_adj_fnc(corrected), gpu_q, pairs_list,
+            consumer = consumer, **self.fused_args(corrected, keep_uncorrected)
+        )
 
-    def coincident(self, nq, pairs_list):
+    def coincident(self, nq, pairs_list, corrected = False, keep_uncorrected = True,
+            consumer = None):
         q = triangle_rules.coincident_quad(nq)
         co_q = self.quad_to_gpu(q)
-        return self.pairs_quad(self.get_gpu_fnc(True), co_q, pairs_list)
+        return self.singular_quad(
+            'coincident', self.get_gpu_fnc(True, corrected), co_q, pairs_list,
+            consumer = consumer, **self.fused_args(corrected, keep_uncorrected)
+        )
 
-    def edge_adj(self, nq, pairs_list):
-        integrator = getattr(self.module, pairs_func_name(False) + '_adj')
+    def edge_adj(self, nq, pairs_list, corrected = False, keep_uncorrected = True,
+            consumer = None):
         q = triangle_rules.edge_adj_quad(nq)
         co_q = self.quad_to_gpu(q)
-        return self.pairs_quad(integrator, co_q, pairs_list)
+        return self.singular_quad(
+            'edge_adj', self.get_adj_fnc(corrected), co_q, pairs_list,
+            consumer = consumer, **self.fused_args(corrected, keep_uncorrected)
+        )
@@ -0,0 +1,107 @@
+import numpy as np
+
+from tectosaur.nearfield.table_params import coincident_min_x, coincident_max_x, \
+    coincident_y_range
+from tectosaur.nearfield.interpolate import from_interval
+
+# A triangle is standardized by relabeling its vertices so that the longest
+# edge comes first, then moving, rotating and scaling it so that the longest
+# edge runs from (0, 0, 0) to (1, 0, 0) and the third vertex is at (x, y, 0)
+# with y > 0. If should_relabel is set and x > 0.5, the first two vertices are
+# swapped, which mirrors the third vertex to (1 - x, y) but reverses the
+# triangle's orientation. Only proper rotations are used, so a standardized
+# triangle maps back to the original by
+#   original[labels[k]] = translation + scale * R.dot(standard[k])
+
+angle_eps = 1e-9
+
+class BadTriangleException(Exception):
+    pass
+
+def internal_angles(tri_pts):
+    tri_pts = np.asarray(tri_pts, dtype = np.float64)
+    out = np.empty(tri_pts.shape[:-1])
+    for d in range(3):
+        e1 = tri_pts[...,(d + 1) % 3,:] - tri_pts[...,d,:]
+        e2 = tri_pts[...,(d + 2) % 3,:] - tri_pts[...,d,:]
+        cos_angle = np.sum(e1 * e2, axis = -1) / (
+            np.linalg.norm(e1, axis = -1) * np.linalg.norm(e2, axis = -1)
+        )
+        out[...,d] = np.arccos(np.clip(cos_angle, -1.0, 1.0))
+    return out
+
+def edge_frames(p0, p1, p2):
+    """
+    Orthonormal frames (as the columns of R) with the first axis along
+    p1 - p0 and the third axis along the normal of the triangle (p0, p1, p2).
+    """
+    edge = p1 - p0
+    scale = np.linalg.norm(edge, axis = -1)
+    e0 = edge / scale[...,np.newaxis]
+    normal = np.cross(edge, p2 - p0)
+    e2 = normal / np.linalg.norm(normal, axis = -1)[...,np.newaxis]
+    e1 = np.cross(e2, e0)
+    return scale, np.stack((e0, e1, e2), axis = -1)
+
+def standardize_many(tri_pts, angle_lim, should_relabel = True):
+    """
+    Vectorized standardization of an (n, 3, 3) array of triangles. Returns a
+    dict of labels (n, 3), flipped (n,), translation (n, 3), scale (n,),
+    R (n, 3, 3), xy (n, 2) with the standardized third vertex and valid (n,),
+    which is False for triangles with an internal angle below angle_lim.
+    """
+    tri_pts = np.asarray(tri_pts, dtype = np.float64)
+    n = tri_pts.shape[0]
+    edge_lens = np.linalg.norm(tri_pts[:,[1,2,0],:] - tri_pts, axis = 2)
+    longest = np.argmax(edge_lens, axis = 1)
+    labels = (longest[:,np.newaxis] + np.arange(3)[np.newaxis,:]) % 3
+
+    rows = np.arange(n)[:,np.newaxis]
+    p = tri_pts[rows, labels]
+    scale, R = edge_frames(p[:,0], p[:,1], p[:,2])
+    rel = np.einsum('nji,nj->ni', R, p[:,2] - p[:,0]) / scale[:,np.newaxis]
+
+    flipped = np.zeros(n, dtype = bool)
+    if should_relabel:
+        flipped = rel[:,0] > 0.5
+        labels[flipped] = labels[flipped][:,[1,0,2]]
+        rel[flipped,0] = 1.0 - rel[flipped,0]
+        R[flipped,:,0] *= -1
+        R[flipped,:,2] *= -1
+
+    valid = np.min(internal_angles(tri_pts), axis = 1) >= angle_lim - angle_eps
+    translation = tri_pts[np.arange(n), labels[:,0]]
+    return dict(
+        labels = labels, flipped = flipped, translation = translation,
+        scale = scale, R = R, xy = rel[:,:2].copy(), valid = valid
+    )
+
+def standardize(tri, angle_lim, should_relabel):
+    """
+    Standardize a single triangle given as a 3x3 list. Raises
+    BadTriangleException for triangles with an internal angle below angle_lim.
+    """
+    out = standardize_many(np.array([tri]), angle_lim, should_relabel)
+    if not out['valid'][0]:
+        raise BadTriangleException(
+            'triangle has an internal angle smaller than ' +
+            str(np.rad2deg(angle_lim)) + ' degrees'
+        )
+    x, y = out['xy'][0]
+    standard_tri = [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [x, y, 0.0]]
+    return (
+        standard_tri, out['labels'][0].tolist(), out['translation'][0],
+        out['R'][0], out['scale'][0]
+    )
+
+def coincident_xyhat(xy):
+    """
+    Map standardized third vertices to the [-1, 1]^2 coordinates of the
+    coincident table.
+    """
+    x = np.clip(xy[:,0], coincident_min_x, coincident_max_x)
+    ylo, yhi = coincident_y_range(x)
+    y = np.clip(xy[:,1], ylo, yhi)
+    xhat = from_interval(coincident_min_x, coincident_max_x, x)
+    yhat = from_interval(ylo, yhi, y)
+    return np.array([xhat, yhat]).T
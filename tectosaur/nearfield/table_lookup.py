@@ -0,0 +1,304 @@
+import os
+import numpy as np
+
+from tectosaur.kernels import kernels
+import tectosaur.nearfield.table_params as table_params
+import tectosaur.nearfield.edge_adj_setup as edge_adj_setup
+from tectosaur.nearfield.standardize import standardize_many, coincident_xyhat, \
+    edge_frames
+from tectosaur.nearfield.interpolate import cheb, cheb_wts, barycentric_factors, \
+    from_interval
+from tectosaur.nearfield.congruence import rotate_blocks
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Coincident and edge adjacent integrals for the elastic kernels are looked up
+# in precomputed tables instead of being integrated with high order
+# quadrature for every pair.
+#
+# Coincident: the triangle is standardized (see standardize.py) and the
+# integrals are interpolated from a Chebyshev grid over the position of the
+# standardized third vertex.
+#
+# Edge adjacent: both triangles are split at the point above the midpoint of
+# the shared edge (see edge_adj_setup.py). The two sub-triangles touching the
+# shared edge then have a fixed shape and only the angle phi between them
+# varies, so their integral comes from a table in phi. The other eight
+# sub-pairs touch at a vertex or not at all and are integrated with the vertex
+# adjacent and nearfield rules. sub_basis maps everything back to the basis
+# functions of the full triangles.
+#
+# (1 - nu) times any of the elastic integrals is linear in nu, so the tables
+# store (1 - nu) * I at the two values in table_params.table_nus with G = 1.
+#
+# Pairs outside the tables (slivers, nearly folded pairs) fall back to direct
+# quadrature. The tables are built by build_tables.py.
+
+def table_filepath(kernel, data_dir = None):
+    if data_dir is None:
+        data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+    return os.path.join(data_dir, kernel + '_tables.npz')
+
+def table_metadata():
+    return dict(
+        format_version = table_params.table_format_version,
+        table_min_internal_angle = table_params.table_min_internal_angle,
+        min_intersect_angle = table_params.min_intersect_angle,
+        min_angle_isoceles_height = table_params.min_angle_isoceles_height,
+        table_nus = table_params.table_nus
+    )
+
+loaded_tables = dict()
+
+def load_tables(kernel, data_dir = None):
+    if kernel not in table_params.table_kernels:
+        raise ValueError(
+            'there are no lookup tables for ' + kernel + ', the supported '
+            'kernels are ' + ', '.join(table_params.table_kernels)
+        )
+    filepath = table_filepath(kernel, data_dir)
+    if filepath in loaded_tables:
+        return loaded_tables[filepath]
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(
+            'no lookup table for ' + kernel + ' at ' + filepath +
+            ', build it with python -m tectosaur.nearfield.build_tables'
+        )
+    with np.load(filepath) as f:
+        tables = {k: f[k] for k in f.files}
+    for k, v in table_metadata().items():
+        if not np.allclose(tables[k], v):
+            raise ValueError(
+                'the lookup table at ' + filepath + ' was built with different '
+                'table parameters, rebuild it with python -m '
+                'tectosaur.nearfield.build_tables'
+            )
+    loaded_tables[filepath] = tables
+    return tables
+
+def basis_at(ref_pts):
+    """
+    Linear basis functions evaluated at reference points: (..., 2) -> (..., 3)
+    """
+    x, y = ref_pts[...,0], ref_pts[...,1]
+    return np.stack((1 - x - y, x, y), axis = -1)
+
+def sub_basis(I, obs_basis_tri, src_basis_tri):
+    """
+    Convert the integrals I over a pair of sub-triangles into integrals
+    against the basis functions of the parent triangles. obs_basis_tri and
+    src_basis_tri are the sub-triangle vertices in the reference coordinates
+    of their parents.
+    """
+    I = np.asarray(I, dtype = np.float64).reshape((1, 3, 3, 3, 3))
+    return sub_basis_many(
+        I, np.array([obs_basis_tri]), np.array([src_basis_tri])
+    )[0]
+
+def sub_basis_many(I, obs_basis_tris, src_basis_tris):
+    obs_phi = basis_at(np.asarray(obs_basis_tris, dtype = np.float64))
+    src_phi = basis_at(np.asarray(src_basis_tris, dtype = np.float64))
+    return np.einsum('nka,nlb,nkilj->naibj', obs_phi, src_phi, I, optimize = True)
+
+def nu_interpolate(values, nu):
+    # values has the two Poisson ratio samples along its first axis.
+    nu0, nu1 = table_params.table_nus
+    t = (nu - nu0) / (nu1 - nu0)
+    return ((1 - t) * values[0] + t * values[1]) / (1 - nu)
+
+def kernel_factors(kernel, params, scale):
+    K = kernels[kernel]
+    return scale ** (-K.scale_type) * params[0] ** (-K.sm_power)
+
+def interp_coincident(tables, xyhat, nu):
+    vals = nu_interpolate(tables['coincident_values'], nu)
+    n_x, n_y = vals.shape[:2]
+    Lx = barycentric_factors(cheb(-1, 1, n_x), cheb_wts(-1, 1, n_x), xyhat[:,0])
+    Ly = barycentric_factors(cheb(-1, 1, n_y), cheb_wts(-1, 1, n_y), xyhat[:,1])
+    return np.einsum('nx,ny,xyo->no', Lx, Ly, vals, optimize = True).reshape((-1,3,3,3,3))
+
+def interp_adjacent(tables, phi, nu):
+    vals = nu_interpolate(tables['adjacent_values'], nu)
+    n_phi = vals.shape[0]
+    phihat = from_interval(
+        table_params.adjacent_min_phi, table_params.adjacent_max_phi, phi
+    )
+    L = barycentric_factors(cheb(-1, 1, n_phi), cheb_wts(-1, 1, n_phi), phihat)
+    return L.dot(vals).reshape((-1,3,3,3,3))
+
+def pairs_integrator(kernel, params, float_type, pts, tris, nq_near = 1):
+    from tectosaur.nearfield.pairs_integrator import PairsIntegrator
+    return PairsIntegrator(kernel, params, float_type, 1, nq_near, pts, tris)
+
+def unlabel(I, obs_labels, src_labels):
+    """
+    out[:, obs_labels[k], :, src_labels[l], :] = I[:, k, :, l, :]
+    """
+    obs_inv = np.argsort(obs_labels, axis = 1)
+    src_inv = np.argsort(src_labels, axis = 1)
+    rows = np.arange(I.shape[0])[:,np.newaxis,np.newaxis]
+    return I[
+        rows, obs_inv[:,:,np.newaxis], :, src_inv[:,np.newaxis,:], :
+    ].transpose((0, 1, 3, 2, 4))
+
+def coincident_table(kernel, params, tri_pts, float_type,
+        fallback_nq = table_params.coincident_nq, data_dir = None):
+    tri_pts = np.asarray(tri_pts, dtype = np.float64)
+    n = tri_pts.shape[0]
+    out = np.empty((n, 3, 3, 3, 3))
+    if n == 0:
+        return out.astype(float_type)
+    K = kernels[kernel]
+    std = standardize_many(tri_pts, table_params.table_min_internal_angle)
+    valid = std['valid']
+
+    if np.any(valid):
+        tables = load_tables(kernel, data_dir)
+        I = interp_coincident(tables, coincident_xyhat(std['xy'][valid]), params[1])
+        factor = kernel_factors(kernel, params, std['scale'][valid])
+        # Relabeling the vertices to mirror the triangle reverses its
+        # orientation, which flips the sign of each normal the kernel uses.
+        n_normals = int(K.needs_obsn) + int(K.needs_srcn)
+        flip_sign = np.where(std['flipped'][valid], (-1.0) ** n_normals, 1.0)
+        I = rotate_blocks(std['R'][valid], I)
+        I *= (factor * flip_sign)[:,np.newaxis,np.newaxis,np.newaxis,np.newaxis]
+        labels = std['labels'][valid]
+        out[valid] = unlabel(I, labels, labels)
+
+    if not np.all(valid):
+        bad_pts = tri_pts[~valid]
+        n_bad = bad_pts.shape[0]
+        logger.debug(
+            str(n_bad) + ' coincident triangles are outside the lookup table'
+        )
+        pairs_int = pairs_integrator(
+            kernel, params, float_type, bad_pts.reshape((-1, 3)),
+            np.arange(3 * n_bad).reshape((-1, 3))
+        )
+        idxs = np.arange(n_bad)
+        out[~valid] = pairs_int.coincident(fallback_nq, np.array([idxs, idxs]).T)
+    return out.astype(float_type)
+
+# The sub-pairs of an edge adjacent pair that are not in the table. Obs
+# sub-triangle vertices index (A, B, C, q) and src sub-triangle vertices index
+# (B, A, D, q'), where q and q' are the split points. The vertex adjacent
+# sub-pairs list the shared vertex first.
+adjacent_va_subpairs = [
+    ([0, 1, 3], [1, 2, 3]),
+    ([1, 3, 0], [0, 3, 2]),
+    ([1, 2, 3], [0, 1, 3]),
+    ([0, 3, 2], [1, 3, 0]),
+    ([1, 2, 3], [0, 3, 2]),
+    ([0, 3, 2], [1, 2, 3]),
+]
+adjacent_near_subpairs = [
+    ([1, 2, 3], [1, 2, 3]),
+    ([2, 0, 3], [2, 0, 3]),
+]
+adjacent_table_subpair = ([0, 1, 3], [0, 1, 3])
+
+def adjacent_sub_pts(tri_pts, split_pts, split_xyhat):
+    n = tri_pts.shape[0]
+    pts = np.concatenate((tri_pts, split_pts[:,np.newaxis,:]), axis = 1)
+    ref = np.empty((n, 4, 2))
+    ref[:,:3] = [[0, 0], [1, 0], [0, 1]]
+    ref[:,3] = split_xyhat
+    return pts, ref
+
+def adjacent_table(nq_vert_adjacent, kernel, params, pts, tris, ea, float_type,
+        nq_near = None, fallback_nq = table_params.adjacent_nq, data_dir = None):
+    """
+    ea is a resolved edge adjacent pairs list, see resolve_ea_rotation.
+    """
+    ea = np.asarray(ea).astype(np.int64)
+    n = ea.shape[0]
+    out = np.empty((n, 3, 3, 3, 3))
+    if n == 0:
+        return out.astype(float_type)
+    if nq_near is None:
+        nq_near = nq_vert_adjacent
+    pts = np.asarray(pts, dtype = np.float64)
+
+    obs_labels, src_labels = edge_adj_setup.rotated_pair_labels(ea)
+    obs_tri_pts, src_tri_pts = edge_adj_setup.rotated_pair_pts(pts, tris, ea)
+    phi = edge_adj_setup.adjacent_phi(obs_tri_pts, src_tri_pts)
+    obs_split = edge_adj_setup.split_pts(obs_tri_pts)
+    src_split = edge_adj_setup.split_pts(src_tri_pts)
+    obs_xyhat = edge_adj_setup.xyhat_from_pts(obs_split, obs_tri_pts)
+    src_xyhat = edge_adj_setup.xyhat_from_pts(src_split, src_tri_pts)
+    valid = (
+        edge_adj_setup.check_xyhats(obs_xyhat) & edge_adj_setup.check_xyhats(src_xyhat)
+        & (phi >= table_params.adjacent_min_phi)
+        & (phi <= table_params.adjacent_max_phi)
+    )
+
+    if np.any(valid):
+        obs_pts, obs_ref = adjacent_sub_pts(
+            obs_tri_pts[valid], obs_split[valid], obs_xyhat[valid]
+        )
+        src_pts, src_ref = adjacent_sub_pts(
+            src_tri_pts[valid], src_split[valid], src_xyhat[valid]
+        )
+        I = adjacent_table_part(
+            kernel, params, obs_tri_pts[valid], phi[valid], obs_ref, src_ref, data_dir
+        )
+        I += adjacent_quad_part(
+            kernel, params, float_type, nq_vert_adjacent, nq_near,
+            obs_pts, obs_ref, src_pts, src_ref
+        )
+        # A flipped src triangle is integrated in the (B, A, D) orientation,
+        # but its normal has to point the way the original triangle's does.
+        if kernels[kernel].needs_srcn:
+            I[ea[valid,4] != 0] *= -1
+        out[valid] = unlabel(I, obs_labels[valid], src_labels[valid])
+
+    if not np.all(valid):
+        logger.debug(
+            str(np.sum(~valid)) + ' edge adjacent pairs are outside the lookup table'
+        )
+        pairs_int = pairs_integrator(kernel, params, float_type, pts, tris)
+        out[~valid] = pairs_int.edge_adj(fallback_nq, ea[~valid])
+    return out.astype(float_type)
+
+def adjacent_table_part(kernel, params, obs_tri_pts, phi, obs_ref, src_ref, data_dir):
+    tables = load_tables(kernel, data_dir)
+    I = interp_adjacent(tables, phi, params[1])
+    scale, R = edge_frames(obs_tri_pts[:,0], obs_tri_pts[:,1], obs_tri_pts[:,2])
+    I = rotate_blocks(R, I)
+    I *= kernel_factors(kernel, params, scale)[:,np.newaxis,np.newaxis,np.newaxis,np.newaxis]
+    obs_sub, src_sub = adjacent_table_subpair
+    return sub_basis_many(I, obs_ref[:,obs_sub], src_ref[:,src_sub])
+
+def adjacent_quad_part(kernel, params, float_type, nq_vert_adjacent, nq_near,
+        obs_pts, obs_ref, src_pts, src_ref):
+    n = obs_pts.shape[0]
+    subpairs = adjacent_va_subpairs + adjacent_near_subpairs
+    n_va = len(adjacent_va_subpairs)
+
+    # Every sub-pair gets its own two triangles in a flat list of points.
+    sub_tri_pts = np.empty((len(subpairs), 2, n, 3, 3))
+    for i, (obs_sub, src_sub) in enumerate(subpairs):
+        sub_tri_pts[i,0] = obs_pts[:,obs_sub]
+        sub_tri_pts[i,1] = src_pts[:,src_sub]
+    flat_pts = sub_tri_pts.reshape((-1, 3))
+    flat_tris = np.arange(flat_pts.shape[0]).reshape((-1, 3))
+    tri_idx = np.arange(flat_tris.shape[0]).reshape((len(subpairs), 2, n))
+
+    pairs_int = pairs_integrator(
+        kernel, params, float_type, flat_pts, flat_tris, nq_near = nq_near
+    )
+    va_rows = np.zeros((n_va * n, 5), dtype = np.int64)
+    va_rows[:,0] = tri_idx[:n_va,0].flatten()
+    va_rows[:,1] = tri_idx[:n_va,1].flatten()
+    va_I = pairs_int.vert_adj(nq_vert_adjacent, va_rows).reshape((n_va, n, 3, 3, 3, 3))
+    near_rows = np.array([
+        tri_idx[n_va:,0].flatten(), tri_idx[n_va:,1].flatten()
+    ]).T.copy()
+    near_I = pairs_int.nearfield(near_rows).reshape((-1, n, 3, 3, 3, 3))
+
+    out = np.zeros((n, 3, 3, 3, 3))
+    for i, (obs_sub, src_sub) in enumerate(subpairs):
+        I = va_I[i] if i < n_va else near_I[i - n_va]
+        out += sub_basis_many(I, obs_ref[:,obs_sub], src_ref[:,src_sub])
+    return out
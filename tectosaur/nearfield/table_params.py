@@ -0,0 +1,50 @@
+import numpy as np
+
+# Parameters shared by the lookup table builder (build_tables.py), the
+# evaluator (table_lookup.py) and the mesh checks in check_for_problems.py.
+# Changing any of these requires rebuilding the tables in tectosaur/data.
+
+table_format_version = 1
+
+# Triangles with a smaller internal angle are outside the coincident table
+# and are integrated directly.
+table_min_internal_angle = np.deg2rad(20.0)
+
+# The height of the isoceles triangle with unit base whose base angles are
+# table_min_internal_angle. Every triangle that passes the internal angle
+# check contains the point at this height above the midpoint of each of its
+# edges, which is where edge adjacent triangles are split.
+min_angle_isoceles_height = 0.5 * np.tan(table_min_internal_angle)
+
+# Edge adjacent pairs that fold closer together than this are outside the
+# adjacent table.
+min_intersect_angle = np.deg2rad(20.0)
+
+# The integrals times (1 - nu) are linear in nu for all the elastic kernels,
+# so two Poisson ratio samples are exact.
+table_nus = np.array([0.0, 0.25])
+
+# The hypersingular kernel has no table: its coincident and edge adjacent
+# integrals only exist as finite parts, which the direct quadrature the
+# tables are built from does not converge to. Use the regularized kernels
+# through RegularizedNearfieldIntegralOp instead.
+table_kernels = ['elasticU3', 'elasticT3', 'elasticA3']
+
+# Default table resolution and the quadrature order used to build them.
+coincident_n_x = 9
+coincident_n_y = 9
+coincident_nq = 12
+adjacent_n_phi = 33
+adjacent_nq = 12
+
+# Coincident triangles are standardized so that the longest edge runs from
+# (0, 0) to (1, 0) and the third vertex (x, y) has x <= 0.5. The internal
+# angle limit then bounds the region the table has to cover.
+coincident_min_x = 1.0 - np.cos(table_min_internal_angle)
+coincident_max_x = 0.5
+
+def coincident_y_range(x):
+    return (1.0 - x) * np.tan(table_min_internal_angle), np.sqrt(1.0 - (1.0 - x) ** 2)
+
+adjacent_min_phi = min_intersect_angle
+adjacent_max_phi = 2 * np.pi - min_intersect_angle
@@ -3,6 +3,10 @@ import numpy as np
 import scipy.sparse
 
 from tectosaur.fmm.tsfmm import TSFMM
+from tectosaur.fmm.cfg import make_config, equivalent_kernels
+import tectosaur.fmm.builder as kifmm_builder
+from tectosaur.fmm.evaluator import FMMEvaluator
+from tectosaur.mesh.mesh_context import get_mesh_context
 import tectosaur.util.geometry as geometry
 import tectosaur.util.gpu as gpu
 from tectosaur.farfield import farfield_pts_direct
@@ -13,50 +17,106 @@ from tectosaur.kernels import kernels
 import logging
 logger = logging.getLogger(__name__)
 
+# The farfield ops take either a vector or a block of right hand sides, v of
+# shape (n, k). TriToTriDirectFarfieldOp handles up to max_rhs of them per
+# launch, with the values for each entry stored contiguously, so the geometry
+# and kernel setup of each pair of quadrature points are shared by all of them.
+
 class TriToTriDirectFarfieldOp:
     def __init__(self, nq_far, K_name, params, pts, tris,
-            float_type, obs_subset, src_subset):
+            float_type, obs_subset, src_subset, max_rhs = 8):
         self.shape = (obs_subset.shape[0] * 9, src_subset.shape[0] * 9)
         self.dim = pts.shape[1]
         self.tensor_dim = kernels[K_name].tensor_dim
         self.n_obs = obs_subset.shape[0]
         self.n_src = src_subset.shape[0]
-
-        in_size = self.n_src * self.dim * self.tensor_dim
-        out_size = self.n_obs * self.dim * self.tensor_dim
-        self.gpu_in = gpu.empty_gpu(in_size, float_type)
-        self.gpu_out = gpu.empty_gpu(out_size, float_type)
+        self.K_name = K_name
+        self.float_type = float_type
+        self.max_rhs = max_rhs
 
         self.q = gauss2d_tri(nq_far)
 
         self.gpu_pts = gpu.to_gpu(pts, float_type)
-        self.gpu_obs_tris = gpu.to_gpu(tris[obs_subset], np.int32)
         self.gpu_src_tris = gpu.to_gpu(tris[src_subset], np.int32)
         self.gpu_params = gpu.to_gpu(np.array(params), float_type)
         self.block_size = 128
-        self.n_blocks = int(np.ceil(self.n_obs / self.block_size))
-
-        self.module = gpu.load_gpu(
-            'matrix_free.cl',
-            tmpl_args = dict(
-                block_size = self.block_size,
-                float_type = gpu.np_to_c_type(float_type),
-                quad_pts = self.q[0],
-                quad_wts = self.q[1]
+
+        # Each device in the device set handles a contiguous block of
+        # observation triangles and writes to its own output buffer.
+        self.obs_splits = gpu.split_work(np.ones(self.n_obs), gpu.n_devices())
+        self.gpu_obs_tris = [
+            gpu.to_gpu(tris[obs_subset[start:end]], np.int32)
+            if end > start else None
+            for start, end in self.obs_splits
+        ]
+        self.rhs_setups = dict()
+        self.use_rhs(1)
+
+    def use_rhs(self, n_rhs):
+        # The module and the input and output buffers for n_rhs right hand
+        # sides, made the first time they're needed.
+        if n_rhs not in self.rhs_setups:
+            in_size = self.n_src * self.dim * self.tensor_dim * n_rhs
+            gpu_outs = [
+                gpu.empty_gpu(
+                    (end - start) * self.dim * self.tensor_dim * n_rhs,
+                    self.float_type
+                )
+                if end > start else None
+                for start, end in self.obs_splits
+            ]
+            module = gpu.load_gpu(
+                'matrix_free.cl',
+                tmpl_args = dict(
+                    block_size = self.block_size,
+                    float_type = gpu.np_to_c_type(self.float_type),
+                    quad_pts = self.q[0],
+                    quad_wts = self.q[1],
+                    n_rhs = n_rhs
+                )
             )
-        )
-        self.fnc = getattr(self.module, "farfield_tris_to_tris" + K_name)
+            self.rhs_setups[n_rhs] = (
+                gpu.empty_gpu(in_size, self.float_type), gpu_outs,
+                getattr(module, "farfield_tris_to_tris" + self.K_name)
+            )
+        self.n_rhs = n_rhs
+        self.gpu_in, self.gpu_outs, self.fnc = self.rhs_setups[n_rhs]
 
     def dot(self, v):
-        self.gpu_in[:] = v[:].astype(self.gpu_in.dtype)
-        self.fnc(
-            self.gpu_out, self.gpu_in,
-            self.gpu_pts, self.gpu_obs_tris, self.gpu_src_tris,
-            self.gpu_params,
-            np.int32(self.n_obs), np.int32(self.n_src),
-            grid = (self.n_blocks, 1, 1), block = (self.block_size, 1, 1)
-        )
-        return self.gpu_out.get()
+        out = np.empty((self.shape[0],) + v.shape[1:], dtype = self.float_type)
+        out_cols = out.reshape((self.shape[0], -1))
+        for start, end, chunk in gpu.rhs_chunks(v, self.max_rhs, self.float_type):
+            out_cols[:, start:end] = self.chunk_dot(chunk)[:, :(end - start)]
+        return out
+
+    def chunk_dot(self, V):
+        self.use_rhs(V.shape[1])
+        self.gpu_in[:] = V.flatten()
+        gpu.synchronize()
+        out = np.empty((self.shape[0], self.n_rhs), dtype = self.float_type)
+        out_flat = out.reshape(-1)
+        dofs_per_el = self.dim * self.tensor_dim * self.n_rhs
+        copies = []
+        for d, (start, end) in enumerate(self.obs_splits):
+            n_obs = end - start
+            if n_obs == 0:
+                continue
+            stream = gpu.device_queue(d)
+            self.fnc(
+                self.gpu_outs[d], self.gpu_in,
+                self.gpu_pts, self.gpu_obs_tris[d], self.gpu_src_tris,
+                self.gpu_params,
+                np.int32(n_obs), np.int32(self.n_src),
+                grid = (int(np.ceil(n_obs / self.block_size)), 1, 1),
+                block = (self.block_size, 1, 1),
+                stream = stream
+            )
+            copies.append(gpu.get_async(
+                self.gpu_outs[d], out_flat[start * dofs_per_el:end * dofs_per_el], stream
+            ))
+        for c in copies:
+            c.wait()
+        return out
 
     async def async_dot(self, v):
         return self.dot(v)
@@ -75,16 +135,21 @@ class FMMFarfieldOp:
     mac = attr.ib()
     pts_per_cell = attr.ib()
     order = attr.ib()
+    use_mesh_context = attr.ib(default = True)
+    treecode = attr.ib(default = True)
+    max_rhs = attr.ib(default = 8)
     def __call__(self, nq_far, K_name, params, pts, tris, float_type,
             obs_subset, src_subset):
         return FMMFarfieldOpImpl(
             nq_far, K_name, params, pts, tris, float_type,
-            obs_subset, src_subset, self.mac, self.pts_per_cell, self.order
+            obs_subset, src_subset, self.mac, self.pts_per_cell, self.order,
+            self.use_mesh_context, self.treecode, self.max_rhs
         )
 
 class FMMFarfieldOpImpl:
     def __init__(self, nq_far, K_name, params, pts, tris, float_type,
-            obs_subset, src_subset, mac, pts_per_cell, order):
+            obs_subset, src_subset, mac, pts_per_cell, order,
+            use_mesh_context = True, treecode = True, max_rhs = 8):
 
         L_scale = np.max(pts)
         scaled_pts = pts / L_scale
@@ -93,12 +158,23 @@ class FMMFarfieldOpImpl:
 
         self.L_factor = L_scale ** (-kernels[K_name].scale_type)
 
+        # The FMM plan only depends on the mesh, so operators with different
+        # kernels on the same mesh share it.
+        plan = None
+        self.mesh_context = None
+        if use_mesh_context:
+            ctx = self.mesh_context = get_mesh_context(pts, tris)
+            plan = ctx.fmm_plan(
+                obs_subset, src_subset, L_scale, mac, pts_per_cell, treecode
+            )
+
         self.fmm = TSFMM(
             m_obs, m_src, params = params, order = order,
             quad_order = nq_far, float_type = float_type,
             K_name = K_name,
             mac = mac, max_pts_per_cell = pts_per_cell,
-            n_workers_per_block = 128
+            n_workers_per_block = 128, treecode = treecode, plan = plan,
+            max_rhs = max_rhs
         )
 
     def dot(self, v):
@@ -118,3 +194,72 @@ class FMMFarfieldOpImpl:
 
     def farfield_dot(self, v):
         return self.dot(v)
+
+# The kernel independent FMM (fmm.builder.FMM) represents the far field of a
+# cell with elasticU3 densities on an equivalent sphere fit to the field on a
+# check sphere. So, unlike TSFMM, it also handles the unregularized elasticT3,
+# elasticA3 and elasticH3 kernels. The regularized kernels are not supported:
+# the field of a single triangle under a regularized kernel differs from the
+# elastic field by line integrals around the triangle's edges, which the
+# equivalent densities can't represent. order is the refinement of the sphere
+# surfaces and mac is the radius of the check surfaces relative to the cell.
+@attr.s()
+class KIFMMFarfieldOp:
+    mac = attr.ib()
+    pts_per_cell = attr.ib()
+    order = attr.ib()
+    inner_r = attr.ib(default = 1.1)
+    alpha = attr.ib(default = 1e-8)
+    treecode = attr.ib(default = False)
+    def __call__(self, nq_far, K_name, params, pts, tris, float_type,
+            obs_subset, src_subset):
+        return KIFMMFarfieldOpImpl(
+            nq_far, K_name, params, pts, tris, float_type,
+            obs_subset, src_subset, self.mac, self.pts_per_cell, self.order,
+            self.inner_r, self.alpha, self.treecode
+        )
+
+class KIFMMFarfieldOpImpl:
+    def __init__(self, nq_far, K_name, params, pts, tris, float_type,
+            obs_subset, src_subset, mac, pts_per_cell, order,
+            inner_r = 1.1, alpha = 1e-8, treecode = False):
+        if K_name not in equivalent_kernels:
+            raise ValueError(
+                'the kernel independent FMM supports ' +
+                ', '.join(equivalent_kernels) + ', not ' + K_name
+            )
+
+        L_scale = np.max(pts)
+        scaled_pts = pts / L_scale
+        m_obs = (scaled_pts, tris[obs_subset].copy())
+        m_src = (scaled_pts, tris[src_subset].copy())
+
+        self.L_factor = L_scale ** (-kernels[K_name].scale_type)
+
+        cfg = make_config(
+            K_name, params, inner_r, mac, order, nq_far, float_type,
+            alpha = alpha, treecode = treecode
+        )
+        self.fmm = kifmm_builder.FMM(
+            kifmm_builder.make_tree(m_obs, cfg, pts_per_cell), m_obs,
+            kifmm_builder.make_tree(m_src, cfg, pts_per_cell), m_src, cfg
+        )
+        self.evaluator = FMMEvaluator(self.fmm)
+
+    def dot(self, v):
+        t = Timer(output_fnc = logger.debug)
+        out = self.fmm.to_orig(self.evaluator.eval(self.fmm.to_tree(v)))
+        t.report('kifmm eval')
+        return self.L_factor * out
+
+    async def async_dot(self, v):
+        return self.dot(v)
+
+    def nearfield_dot(self, v):
+        return self.dot(v)
+
+    def nearfield_no_correction_dot(self, v):
+        return self.dot(v)
+
+    def farfield_dot(self, v):
+        return self.dot(v)
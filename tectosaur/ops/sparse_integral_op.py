@@ -1,29 +1,79 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-from tectosaur.nearfield.nearfield_op import NearfieldIntegralOp, RegularizedNearfieldIntegralOp
+from tectosaur.nearfield.nearfield_op import NearfieldIntegralOp, \
+    RegularizedNearfieldIntegralOp, MatrixFreeNearfieldIntegralOp
 
+from tectosaur.mesh.mesh_context import get_mesh_context
 from tectosaur.util.timer import Timer
 
 import logging
 logger = logging.getLogger(__name__)
 
+# The BSR matvec releases the GIL, so running it on this thread lets the
+# nearfield product proceed while the farfield is launched and awaited. The
+# matrix free nearfield product launches kernels instead and stays on the
+# calling thread, which holds the gpu context (on cuda, a worker thread has
+# none) and is the only thread using the buffer pools.
+nearfield_executor = None
+
+def get_nearfield_executor():
+    global nearfield_executor
+    if nearfield_executor is None:
+        nearfield_executor = ThreadPoolExecutor(max_workers = 1)
+    return nearfield_executor
+
 class RegularizedSparseIntegralOp:
     def __init__(self, nq_coincident, nq_edge_adj, nq_vert_adjacent,
             nq_far, nq_near, near_threshold,
             K_near_name, K_far_name, params, pts, tris, float_type, farfield_op_type,
-            obs_subset = None, src_subset = None):
+            obs_subset = None, src_subset = None, nearfield_cache = None,
+            lean_nearfield = False, nearfield_tol = None,
+            matrix_free_nearfield = False, nearfield_memory_budget = None,
+            nearfield_storage_dir = None, mesh_context = None):
+        # nearfield_tol trades accuracy for speed in the nearfield: with a
+        # tolerance, well separated nearfield pairs are integrated with lower
+        # order rules than nq_near. None uses nq_near for every pair.
+        # matrix_free_nearfield stores no nearfield blocks at all and
+        # recomputes them on every product instead.
+        # nearfield_memory_budget (bytes) bounds the host memory used while
+        # streaming the nearfield blocks into place and nearfield_storage_dir
+        # keeps the assembled blocks in memory-mapped files in that directory.
+        # mesh_context shares the kernel independent setup (the nearfield pair
+        # categories) between operators on the same mesh. None looks up the
+        # shared context for (pts, tris) and False disables sharing. The op
+        # keeps its context alive, see mesh_context.py.
 
         if obs_subset is None:
             obs_subset = np.arange(tris.shape[0])
         if src_subset is None:
             src_subset = np.arange(tris.shape[0])
 
-        self.nearfield = RegularizedNearfieldIntegralOp(
+        if mesh_context is None:
+            mesh_context = get_mesh_context(pts, tris)
+        elif mesh_context is False:
+            mesh_context = None
+        self.mesh_context = mesh_context
+
+        nearfield_args = (
             pts, tris, obs_subset, src_subset,
             nq_coincident, nq_edge_adj, nq_vert_adjacent, nq_far, nq_near,
-            near_threshold, K_near_name, K_far_name,
-            params, float_type
+            near_threshold, K_near_name, K_far_name, params, float_type
         )
+        if matrix_free_nearfield:
+            self.nearfield = MatrixFreeNearfieldIntegralOp(
+                *nearfield_args, nearfield_tol = nearfield_tol,
+                mesh_context = mesh_context
+            )
+        else:
+            self.nearfield = RegularizedNearfieldIntegralOp(
+                *nearfield_args, cache = nearfield_cache, lean = lean_nearfield,
+                nearfield_tol = nearfield_tol,
+                memory_budget = nearfield_memory_budget,
+                storage_dir = nearfield_storage_dir,
+                mesh_context = mesh_context
+            )
+        self.nearfield_bin_stats = self.nearfield.nearfield_bin_stats
 
         self.farfield = farfield_op_type(
             nq_far, K_far_name, params, pts, tris,
@@ -35,7 +85,13 @@ class RegularizedSparseIntegralOp:
     async def nearfield_dot(self, v):
         t = Timer(output_fnc = logger.debug)
         logger.debug("start nearfield_dot")
-        out = self.nearfield.dot(v)
+        if self.nearfield.dot_uses_device:
+            out = self.nearfield.dot(v)
+        else:
+            import asyncio
+            out = await asyncio.get_event_loop().run_in_executor(
+                get_nearfield_executor(), self.nearfield.dot, v
+            )
         t.report("nearfield_dot")
         return out
 
@@ -5,11 +5,23 @@ import uuid
 from scipy.optimize import fsolve
 
 import tectosaur as tct
-import cppimport.import_hook
-from .pt_average import pt_averageD
-from . import newton
+from tectosaur.util.cpp import imp, lazy_fnc
+newton = imp('tectosaur.qd.newton')
+pt_averageD = lazy_fnc(imp('tectosaur.qd.pt_average'), 'pt_averageD')
+
+def check_fmm_cfg(cfg):
+    # The qd T, A and H operators use the regularized kernels, which the
+    # kernel independent FMM (KIFMMFarfieldOp) can't represent, so TSFMM is
+    # the only FMM available here.
+    fmm_type = cfg.get('fmm_type', 'tsfmm')
+    if cfg['use_fmm'] and fmm_type != 'tsfmm':
+        raise ValueError(
+            'unsupported fmm_type ' + repr(fmm_type) + ', the qd models only '
+            'support \'tsfmm\''
+        )
 
 def get_farfield_op(cfg):
+    check_fmm_cfg(cfg)
     if cfg['use_fmm']:
         return tct.FMMFarfieldOp(
             mac = cfg['fmm_mac'],
@@ -67,6 +79,7 @@ def calc_derived_constants(cfg):
     if type(cfg['tectosaur_cfg']['log_level']) is str:
         log_level = getattr(logging, cfg['tectosaur_cfg']['log_level'])
         cfg['tectosaur_cfg']['log_level'] = log_level
+    check_fmm_cfg(cfg['tectosaur_cfg'])
 
     out_cfg = cfg.copy()
 
@@ -3,6 +3,7 @@ from scipy.sparse.linalg import cg, lsmr, gmres
 import scipy.sparse
 
 import tectosaur as tct
+import tectosaur.mesh.refine
 from tectosaur.util.geometry import unscaled_normals
 from tectosaur.util.timer import Timer
 from tectosaur.constraints import ConstraintEQ, Term
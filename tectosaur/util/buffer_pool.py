@@ -0,0 +1,135 @@
+import weakref
+import numpy as np
+
+# Every allocation made by to_gpu/empty_gpu/zeros_gpu goes through a
+# BufferPool. Freed buffers are held in size buckets and handed back out to
+# later allocations of the same bucket instead of going back to the driver.
+# Once more than max_held_bytes are sitting unused in the pool, the held
+# buffers are released.
+
+class BufferPool:
+    def __init__(self, max_held_bytes):
+        self.max_held_bytes = max_held_bytes
+        self.hits = 0
+        self.misses = 0
+        self.peak_active_bytes = 0
+
+    def allocate(self, nbytes):
+        buf, hit = self._allocate(nbytes)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.peak_active_bytes = max(self.peak_active_bytes, self.active_bytes())
+        if self.max_held_bytes is not None and self.held_bytes() > self.max_held_bytes:
+            self.free_held()
+        return buf
+
+    def stats(self):
+        return dict(
+            hits = self.hits,
+            misses = self.misses,
+            held_bytes = self.held_bytes(),
+            active_bytes = self.active_bytes(),
+            peak_active_bytes = self.peak_active_bytes,
+            max_held_bytes = self.max_held_bytes
+        )
+
+class DriverPool(BufferPool):
+    """
+    Wraps the pyopencl.tools.MemoryPool or pycuda.tools.DeviceMemoryPool
+    created by make_pool on first use. Those pools bucket by size and return
+    a buffer to its bucket when the last array viewing it is freed.
+    """
+    def __init__(self, make_pool, max_held_bytes):
+        super().__init__(max_held_bytes)
+        self.make_pool = make_pool
+        self.pool = None
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = self.make_pool()
+        return self.pool
+
+    def _allocate(self, nbytes):
+        pool = self.get_pool()
+        held_before = pool.held_blocks
+        buf = pool.allocate(nbytes)
+        return buf, pool.held_blocks < held_before
+
+    def __call__(self, nbytes):
+        return self.allocate(nbytes)
+
+    def held_bytes(self):
+        if self.pool is None:
+            return 0
+        return (
+            getattr(self.pool, 'managed_bytes', 0)
+            - getattr(self.pool, 'active_bytes', 0)
+        )
+
+    def active_bytes(self):
+        if self.pool is None:
+            return 0
+        return getattr(self.pool, 'active_bytes', 0)
+
+    def free_held(self):
+        if self.pool is not None:
+            self.pool.free_held()
+
+def bucket_size(nbytes):
+    # Eight buckets per power of two, so at most 1/8 of a buffer is wasted.
+    if nbytes <= 256:
+        return 256
+    step = 2 ** max(nbytes.bit_length() - 4, 0)
+    return -(-nbytes // step) * step
+
+class PoolOwner(np.ndarray):
+    pass
+
+class HostPool(BufferPool):
+    """
+    Pool of host memory for the cpu backend. allocate returns a uint8 array
+    whose lifetime tracks every array later viewed from it. When the last one
+    is garbage collected, the underlying block goes back to its bucket.
+    """
+    def __init__(self, max_held_bytes):
+        super().__init__(max_held_bytes)
+        self.held = dict()
+        self._held_bytes = 0
+        self._active_bytes = 0
+
+    def _allocate(self, nbytes):
+        size = bucket_size(nbytes)
+        bucket = self.held.get(size, [])
+        if len(bucket) > 0:
+            raw = bucket.pop()
+            self._held_bytes -= size
+            hit = True
+        else:
+            raw = np.empty(size, dtype = np.uint8)
+            hit = False
+        self._active_bytes += size
+
+        owner = raw[:nbytes].view(PoolOwner)
+        weakref.finalize(owner, self.release, raw)
+        return owner, hit
+
+    def release(self, raw):
+        size = raw.shape[0]
+        self._active_bytes -= size
+        if self.max_held_bytes is not None \
+                and self._held_bytes + size > self.max_held_bytes:
+            return
+        self.held.setdefault(size, []).append(raw)
+        self._held_bytes += size
+
+    def held_bytes(self):
+        return self._held_bytes
+
+    def active_bytes(self):
+        return self._active_bytes
+
+    def free_held(self):
+        self.held = dict()
+        self._held_bytes = 0
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import multiprocessing
+
+from tectosaur.util.cpp import extension_names, manifest_filename, \
+    source_filepath, package_dir
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Each extension is built in its own process. The templated sources are
+# rendered to separate .rendered.* files and distutils uses a separate
+# temporary directory per build, so the builds do not interfere.
+
+# These are cppimport internals, not its public API. They exist in the
+# cppimport versions allowed by setup.py (<20); check for them so that a
+# different cppimport fails with a clear message instead of an
+# AttributeError halfway through the build.
+importer_fncs = ['setup_module_data', 'check_checksum', 'template_and_build']
+
+def get_importer():
+    import cppimport.importer as importer
+    missing = [f for f in importer_fncs if not hasattr(importer, f)]
+    if len(missing) > 0:
+        raise ImportError(
+            'the installed cppimport does not provide cppimport.importer.' +
+            ', cppimport.importer.'.join(missing) + ', the ahead of time '
+            'build needs cppimport<20'
+        )
+    return importer
+
+def build_one(args):
+    name, root, force = args
+    importer = get_importer()
+
+    start = time.time()
+    filepath = source_filepath(name, root)
+    module_data = importer.setup_module_data(name, filepath)
+    if force or not importer.check_checksum(module_data):
+        importer.template_and_build(filepath, module_data)
+        built = True
+    else:
+        built = False
+    return name, module_data['ext_path'], built, time.time() - start
+
+def build_all(root = None, names = None, n_jobs = None, force = False):
+    """
+    Compile every extension under root (the package directory by default)
+    and write the manifest that lets tectosaur.util.cpp.imp load them
+    without checksumming.
+    """
+    if root is None:
+        root = package_dir()
+    if names is None:
+        names = extension_names
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = max(min(n_jobs, len(names)), 1)
+    get_importer()
+
+    manifest_path = os.path.join(root, manifest_filename)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    jobs = [(name, root, force) for name in names]
+    if n_jobs == 1:
+        results = [build_one(j) for j in jobs]
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(n_jobs) as pool:
+            results = pool.map(build_one, jobs, chunksize = 1)
+
+    for name, ext_path, built, runtime in results:
+        logger.info('{} {} ({:.1f}s)'.format(
+            'built' if built else 'up to date', ext_path, runtime
+        ))
+
+    with open(manifest_path, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    return results
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog = 'python -m tectosaur.util.build_extensions',
+        description = 'Compile the tectosaur C++ extensions ahead of time.'
+    )
+    parser.add_argument('-j', '--jobs', type = int, default = None,
+        help = 'number of extensions to build in parallel (default: # of cpus)')
+    parser.add_argument('--force', action = 'store_true',
+        help = 'rebuild even if the sources are unchanged')
+    parser.add_argument('--root', default = None,
+        help = 'package directory to build in (default: the imported tectosaur)')
+    opts = parser.parse_args(args)
+
+    start = time.time()
+    results = build_all(root = opts.root, n_jobs = opts.jobs, force = opts.force)
+    for name, ext_path, built, runtime in results:
+        print('{:>10} {:6.1f}s {}'.format(
+            'built' if built else 'up to date', runtime, ext_path
+        ))
+    print('total {:.1f}s'.format(time.time() - start))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
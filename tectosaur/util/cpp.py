@@ -1,10 +1,108 @@
+import os
 import sys
 import ctypes
-import cppimport
+import importlib
 
-def imp(name):
+import logging
+logger = logging.getLogger(__name__)
+
+# Every pybind11 extension in the package. "python -m
+# tectosaur.util.build_extensions" (also run by "setup.py build_py") compiles
+# all of them ahead of time and writes manifest_filename next to them. When
+# the manifest is present, imp loads the prebuilt shared objects directly
+# instead of going through cppimport, which checksums the sources and may
+# rebuild. Setting TECTOSAUR_DEV=1 always goes through cppimport.
+extension_names = [
+    'tectosaur.fast_constraints',
+    'tectosaur._check_for_problems',
+    'tectosaur.util.fast_sparse',
+    'tectosaur.util._geometry',
+    'tectosaur.util.tri_tri_intersect',
+    'tectosaur.ops._mass_op',
+    'tectosaur.mesh.fast_find_nearfield',
+    'tectosaur.mesh.fast_modify',
+    'tectosaur.fmm.traversal_wrapper',
+    'tectosaur.qd.newton',
+    'tectosaur.qd.pt_average',
+]
+
+manifest_filename = 'prebuilt_extensions.txt'
+
+def package_dir():
+    return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def source_filepath(name, root = None):
+    if root is None:
+        root = package_dir()
+    return os.path.join(root, *name.split('.')[1:]) + '.cpp'
+
+def dev_mode():
+    return os.environ.get('TECTOSAUR_DEV', '0') != '0'
+
+prebuilt = None
+def get_prebuilt():
+    global prebuilt
+    if prebuilt is None:
+        try:
+            with open(os.path.join(package_dir(), manifest_filename), 'r') as f:
+                prebuilt = set(l.strip() for l in f if l.strip() != '')
+        except OSError:
+            prebuilt = set()
+    return prebuilt
+
+def load_prebuilt(name):
+    if dev_mode() or name not in get_prebuilt():
+        return None
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        logger.warning(
+            'failed to load prebuilt extension ' + name + ', falling back to '
+            'cppimport: ' + str(e)
+        )
+        return None
+
+def imp_now(name):
     flags = sys.getdlopenflags()
     sys.setdlopenflags(flags | ctypes.RTLD_GLOBAL)
-    out = cppimport.cppimport(name)
-    sys.setdlopenflags(flags)
+    try:
+        out = load_prebuilt(name)
+        if out is None:
+            import cppimport
+            out = cppimport.cppimport(name)
+    finally:
+        sys.setdlopenflags(flags)
     return out
+
+class LazyExtension:
+    """
+    Stands in for a cppimport extension module. The extension is built (if
+    needed) and loaded the first time one of its attributes is used, so
+    importing a python module does not pay for every extension it might call.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = imp_now(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+def imp(name):
+    return LazyExtension(name)
+
+def lazy_fnc(ext, name):
+    def wrapper(*args, **kwargs):
+        return getattr(ext, name)(*args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__qualname__ = name
+    return wrapper
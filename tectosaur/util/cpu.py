@@ -0,0 +1,318 @@
+import os
+import re
+import sys
+import hashlib
+import tempfile
+import numpy as np
+
+import tectosaur.util.disk_cache as disk_cache
+from tectosaur.util.buffer_pool import HostPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The host backend renders the same mako kernels as the cuda and opencl
+# backends, but compiles them as C++ with cppimport. Each kernel launch
+# becomes an OpenMP loop over the work groups. The work items inside a group
+# are run one after another by the same thread, so LOCAL_BARRIER is a no-op and
+# kernels that cooperate through local memory must either branch on
+# cpu_backend or be launched with one work item per group.
+
+cpu_initialized = False
+
+def ensure_initialized():
+    global cpu_initialized
+    if not cpu_initialized:
+        cpu_initialized = True
+        logger.info('initializing host backend')
+
+class CPUArray(np.ndarray):
+    def get(self):
+        return np.array(self)
+
+buffer_pool = HostPool(
+    float(os.environ.get('TECTOSAUR_POOL_MB', 1024)) * 1e6
+)
+
+def to_gpu(arr, float_type):
+    ensure_initialized()
+    if type(arr) is CPUArray:
+        return arr
+    out = empty_gpu(np.shape(arr), float_type)
+    out[...] = arr
+    return out
+
+def zeros_gpu(shape, float_type):
+    out = empty_gpu(shape, float_type)
+    out.fill(0)
+    return out
+
+def empty_gpu(shape, float_type):
+    ensure_initialized()
+    dtype = np.dtype(float_type)
+    if not isinstance(shape, tuple):
+        shape = (shape,)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    owner = buffer_pool.allocate(nbytes)
+    return owner.view(dtype).reshape(shape).view(CPUArray)
+
+def threaded_get(arr):
+    return arr.get()
+
+# Kernel launches and copies on the host are synchronous, so streams and
+# devices are only placeholders. TECTOSAUR_FAKE_DEVICES=n still splits work
+# into n pieces to exercise the multi-device code paths.
+def n_devices():
+    return max(int(os.environ.get('TECTOSAUR_FAKE_DEVICES', 0)), 1)
+
+def device_queue(device):
+    return None
+
+def synchronize():
+    pass
+
+def make_stream(device = 0):
+    return None
+
+class DoneCopy:
+    def wait(self):
+        pass
+
+def get_async(arr, out, stream = None):
+    out[...] = arr
+    return DoneCopy()
+
+def device_memory():
+    import psutil
+    mem = psutil.virtual_memory()
+    # LOCAL_MEM arrays are locals of the kernel function, so local_mem is a
+    # budget for the stack rather than a hardware limit.
+    return dict(
+        total = mem.total, free = mem.available, max_alloc = mem.available,
+        local_mem = 48 * 1024
+    )
+
+class ModuleWrapper:
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        kernel = getattr(self.module, name)
+        def launch_wrapper(*args, grid = None, block = None, stream = None):
+            return kernel(tuple(grid), tuple(block), *args)
+        return launch_wrapper
+
+kernel_name_regex = re.compile(r'KERNEL\s+void\s+(\w+)\s*\(')
+
+def kernel_names(code):
+    return list(dict.fromkeys(kernel_name_regex.findall(code)))
+
+cppimport_header = """// cppimport
+/*
+<%
+setup_pybind11(cfg)
+cfg['compiler_args'] += ['-std=c++14', '-O3', '-fopenmp', '-w']
+cfg['linker_args'] += ['-fopenmp']
+%>
+*/
+"""
+
+module_tmpl = """
+#include <array>
+#include <tuple>
+#include <utility>
+#include <stdexcept>
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+
+#include "${kernels_filename}"
+
+namespace py = pybind11;
+
+namespace tct_cpu {
+
+template <typename T>
+struct ArgCast {
+    static T cast(py::handle h) { return h.cast<T>(); }
+};
+
+template <typename T>
+struct ArgCast<T*> {
+    static T* cast(py::handle h) {
+        return reinterpret_cast<T*>(h.cast<py::array>().mutable_data());
+    }
+};
+
+inline std::array<size_t,3> to_dims(py::tuple t) {
+    std::array<size_t,3> out{1, 1, 1};
+    for (size_t d = 0; d < std::min<size_t>(3, t.size()); d++) {
+        out[d] = t[d].cast<size_t>();
+    }
+    return out;
+}
+
+template <typename... Args, size_t... I>
+void launch_impl(void (*f)(Args...), py::tuple grid_in, py::tuple block_in,
+    py::args args, std::index_sequence<I...>)
+{
+    if (args.size() != sizeof...(Args)) {
+        throw std::runtime_error("wrong number of kernel arguments");
+    }
+    std::tuple<Args...> vals{ArgCast<Args>::cast(args[I])...};
+    auto grid = to_dims(grid_in);
+    auto block = to_dims(block_in);
+    long n_groups = grid[0] * grid[1] * grid[2];
+
+    py::gil_scoped_release release;
+#pragma omp parallel for schedule(dynamic)
+    for (long g = 0; g < n_groups; g++) {
+        WorkItem& wi = tct_work_item;
+        wi.group_id[0] = g % grid[0];
+        wi.group_id[1] = (g / grid[0]) % grid[1];
+        wi.group_id[2] = g / (grid[0] * grid[1]);
+        for (int d = 0; d < 3; d++) {
+            wi.local_size[d] = block[d];
+            wi.num_groups[d] = grid[d];
+        }
+        for (size_t lz = 0; lz < block[2]; lz++) {
+        for (size_t ly = 0; ly < block[1]; ly++) {
+        for (size_t lx = 0; lx < block[0]; lx++) {
+            wi.local_id[0] = lx;
+            wi.local_id[1] = ly;
+            wi.local_id[2] = lz;
+            for (int d = 0; d < 3; d++) {
+                wi.global_id[d] = wi.group_id[d] * block[d] + wi.local_id[d];
+            }
+            f(std::get<I>(vals)...);
+        }
+        }
+        }
+    }
+}
+
+template <typename... Args>
+void launch(void (*f)(Args...), py::tuple grid, py::tuple block, py::args args) {
+    launch_impl(f, grid, block, args, std::index_sequence_for<Args...>{});
+}
+
+} // end namespace tct_cpu
+
+PYBIND11_MODULE(${module_name}, m) {
+% for name in names:
+    m.def("${name}", [] (py::tuple grid, py::tuple block, py::args args) {
+        tct_cpu::launch(${name}, grid, block, args);
+    });
+% endfor
+}
+"""
+
+def write_if_missing(filepath, text):
+    if os.path.exists(filepath):
+        return
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        f.write(text)
+    os.replace(tmp_filepath, filepath)
+
+def build_module(module_dir, module_name, code):
+    from mako.template import Template
+    import cppimport
+
+    kernels_filename = module_name + '_kernels.hpp'
+    module_code = cppimport_header + Template(module_tmpl).render(
+        module_name = module_name,
+        kernels_filename = kernels_filename,
+        names = kernel_names(code)
+    )
+
+    os.makedirs(module_dir, exist_ok = True)
+    write_if_missing(os.path.join(module_dir, kernels_filename), code)
+    module_filepath = os.path.join(module_dir, module_name + '.cpp')
+    write_if_missing(module_filepath, module_code)
+
+    sys.path.insert(0, module_dir)
+    try:
+        return cppimport.imp_from_filepath(module_filepath, module_name)
+    finally:
+        sys.path.remove(module_dir)
+
+def device_identity():
+    import platform
+    import sysconfig
+    return (
+        platform.machine(), platform.processor(),
+        sysconfig.get_config_var('EXT_SUFFIX'), cppimport_header
+    )
+
+# Modules compiled without a cache are built in one temporary directory per
+# process, removed at exit.
+tmp_build_dir = None
+def get_tmp_build_dir():
+    global tmp_build_dir
+    if tmp_build_dir is None:
+        tmp_build_dir = tempfile.TemporaryDirectory(prefix = 'tectosaur_cpu_')
+    return tmp_build_dir.name
+
+def compile(code, cache = None):
+    ensure_initialized()
+    code_hash = hashlib.sha1(code.encode()).hexdigest()[:20]
+    module_name = 'tct_cpu_' + code_hash
+    # With a cache, the built extension lives in the cache entry and is
+    # reused by later processes. Without one, it is built in a temporary
+    # directory that is removed when the process exits.
+    if cache is None:
+        module_dir = os.path.join(get_tmp_build_dir(), code_hash)
+        os.makedirs(module_dir, exist_ok = True)
+    else:
+        key = disk_cache.hash_key(code, device_identity())
+        module_dir = cache.entry_dir(key)
+        cache.touch(key)
+    module = build_module(module_dir, module_name, code)
+    if cache is not None:
+        cache.evict()
+    return ModuleWrapper(module)
+
+cluda_preamble = """
+#include <math.h>
+#include <cmath>
+#include <cstddef>
+#define CPU
+#define LOCAL_BARRIER
+#define WITHIN_KERNEL static inline
+#define KERNEL static
+#define GLOBAL_MEM
+#define LOCAL_MEM
+#define LOCAL_MEM_DYNAMIC
+#define LOCAL_MEM_ARG
+#define CONSTANT static const
+#define INLINE inline
+#define SIZE_T size_t
+#define VSIZE_T size_t
+#define ALIGN(bytes) __attribute__ ((aligned(bytes)))
+
+struct WorkItem {
+    size_t global_id[3];
+    size_t local_id[3];
+    size_t group_id[3];
+    size_t local_size[3];
+    size_t num_groups[3];
+};
+static thread_local WorkItem tct_work_item;
+
+static inline size_t get_global_id(int d) { return tct_work_item.global_id[d]; }
+static inline size_t get_local_id(int d) { return tct_work_item.local_id[d]; }
+static inline size_t get_group_id(int d) { return tct_work_item.group_id[d]; }
+static inline size_t get_local_size(int d) { return tct_work_item.local_size[d]; }
+static inline size_t get_num_groups(int d) { return tct_work_item.num_groups[d]; }
+static inline size_t get_global_size(int d) {
+    return tct_work_item.local_size[d] * tct_work_item.num_groups[d];
+}
+
+static inline float rsqrt(float x) { return 1.0f / std::sqrt(x); }
+static inline double rsqrt(double x) { return 1.0 / std::sqrt(x); }
+
+template <typename A, typename B>
+static inline auto min(A a, B b) -> decltype(a + b) { return (b < a) ? b : a; }
+template <typename A, typename B>
+static inline auto max(A a, B b) -> decltype(a + b) { return (a < b) ? b : a; }
+"""
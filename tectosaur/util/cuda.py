@@ -1,7 +1,12 @@
+import os
 import numpy as np
 import pycuda
 import pycuda.gpuarray
 import pycuda.compiler
+import pycuda.driver
+import pycuda.tools
+import tectosaur.util.disk_cache as disk_cache
+from tectosaur.util.buffer_pool import DriverPool
 import tectosaur.util.logging as tct_log
 
 import logging
@@ -23,20 +28,25 @@ def ptr(arr):
         return arr.gpudata
     return arr
 
+buffer_pool = DriverPool(
+    lambda: pycuda.tools.DeviceMemoryPool(),
+    float(os.environ.get('TECTOSAUR_POOL_MB', 1024)) * 1e6
+)
+
 def to_gpu(arr, float_type):
     ensure_initialized()
     if type(arr) is pycuda.gpuarray.GPUArray:
         return arr
     to_type = arr.astype(float_type)
-    return pycuda.gpuarray.to_gpu(to_type)
+    return pycuda.gpuarray.to_gpu(to_type, allocator = buffer_pool)
 
 def empty_gpu(shape, float_type):
     ensure_initialized()
-    return pycuda.gpuarray.empty(shape, float_type)
+    return pycuda.gpuarray.empty(shape, float_type, allocator = buffer_pool)
 
 def zeros_gpu(shape, float_type):
     ensure_initialized()
-    return pycuda.gpuarray.zeros(shape, float_type)
+    return pycuda.gpuarray.zeros(shape, float_type, allocator = buffer_pool)
 
 class CUDAContextWrapper(object):
     def __init__(self, context):
@@ -54,6 +64,56 @@ def threaded_get(arr):
     with CUDAContextWrapper(pycuda.autoinit.context):
         return arr.get()
 
+# Only a single CUDA device is supported. TECTOSAUR_FAKE_DEVICES=n splits work
+# over n streams on that device to exercise the multi-device code paths.
+device_streams = None
+
+def n_devices():
+    return len(get_device_streams())
+
+def get_device_streams():
+    global device_streams
+    if device_streams is None:
+        ensure_initialized()
+        n_fake = int(os.environ.get('TECTOSAUR_FAKE_DEVICES', 0))
+        if n_fake > 0:
+            device_streams = [pycuda.driver.Stream() for i in range(n_fake)]
+        else:
+            device_streams = [None]
+    return device_streams
+
+def device_queue(device):
+    return get_device_streams()[device]
+
+def synchronize():
+    pycuda.driver.Context.synchronize()
+
+def make_stream(device = 0):
+    ensure_initialized()
+    return pycuda.driver.Stream()
+
+class StreamCopy:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def wait(self):
+        if self.stream is None:
+            pycuda.driver.Context.synchronize()
+        else:
+            self.stream.synchronize()
+
+def get_async(arr, out, stream = None):
+    arr.get_async(stream, out)
+    return StreamCopy(stream)
+
+def device_memory():
+    ensure_initialized()
+    free, total = pycuda.driver.mem_get_info()
+    local_mem = pycuda.driver.Context.get_device().get_attribute(
+        pycuda.driver.device_attribute.MAX_SHARED_MEMORY_PER_BLOCK
+    )
+    return dict(total = total, free = free, max_alloc = free, local_mem = local_mem)
+
 class ModuleWrapper:
     def __init__(self, module):
         self.module = module
@@ -65,12 +125,28 @@ class ModuleWrapper:
             return kernel(*arg_ptrs, **kwargs)
         return wrapper
 
-def compile(code):
+def device_identity():
+    ensure_initialized()
+    dev = pycuda.driver.Context.get_device()
+    return (
+        dev.name(), dev.compute_capability(),
+        pycuda.driver.get_driver_version(), pycuda.driver.get_version()
+    )
+
+def compile(code, cache = None):
     ensure_initialized()
     compiler_args = ['--use_fast_math', '--restrict']
-    return ModuleWrapper(pycuda.compiler.SourceModule(
-        code, options = compiler_args
-    ))
+    if cache is None:
+        return ModuleWrapper(pycuda.compiler.SourceModule(
+            code, options = compiler_args
+        ))
+
+    key = disk_cache.hash_key(code, compiler_args, device_identity())
+    cubin = cache.get(key)
+    if cubin is None:
+        cubin = pycuda.compiler.compile(code, options = compiler_args)
+        cache.put(key, cubin)
+    return ModuleWrapper(pycuda.driver.module_from_buffer(cubin))
 
 cluda_preamble = """
 #include <stdio.h>
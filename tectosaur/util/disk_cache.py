@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Every persistent cache in tectosaur is a directory under cache_root() holding
+# one subdirectory per entry. The entry directory's mtime is refreshed on each
+# hit, so eviction can drop the least recently used entries first.
+
+def cache_root():
+    default = os.path.join(
+        os.environ.get(
+            'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')
+        ),
+        'tectosaur'
+    )
+    return os.environ.get('TECTOSAUR_CACHE_DIR', default)
+
+def hash_key(*parts):
+    h = hashlib.sha256()
+    for p in parts:
+        if not isinstance(p, bytes):
+            p = str(p).encode()
+        h.update(p)
+        h.update(b'\0')
+    return h.hexdigest()
+
+def dir_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return total
+
+class DiskCache:
+    def __init__(self, name, max_bytes = None, max_age = None):
+        self.name = name
+        self.dir = os.path.join(cache_root(), name)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def entry_dir(self, key):
+        return os.path.join(self.dir, key)
+
+    def contains(self, key, filename = 'data'):
+        return os.path.exists(os.path.join(self.entry_dir(key), filename))
+
+    def touch(self, key):
+        try:
+            os.utime(self.entry_dir(key))
+        except OSError:
+            pass
+
+    def get(self, key, filename = 'data'):
+        path = os.path.join(self.entry_dir(key), filename)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.touch(key)
+        return data
+
+    def put(self, key, data, filename = 'data'):
+        entry_dir = self.entry_dir(key)
+        os.makedirs(entry_dir, exist_ok = True)
+        path = os.path.join(entry_dir, filename)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def put_dir(self, key, write_fnc):
+        """
+        Build a multi-file entry. write_fnc fills a temporary directory that
+        is then renamed into place, so readers never see a partial entry.
+        """
+        os.makedirs(self.dir, exist_ok = True)
+        tmp_dir = os.path.join(self.dir, '.' + key + '.' + str(os.getpid()) + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+        os.makedirs(tmp_dir)
+        try:
+            write_fnc(tmp_dir)
+            self.remove(key)
+            os.rename(tmp_dir, self.entry_dir(key))
+        except OSError:
+            # Another process may have finished the same entry first.
+            if not os.path.isdir(self.entry_dir(key)):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+        self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.dir):
+            return []
+        out = []
+        for key in os.listdir(self.dir):
+            if key.startswith('.'):
+                continue
+            path = self.entry_dir(key)
+            if not os.path.isdir(path):
+                continue
+            out.append(dict(
+                key = key, nbytes = dir_bytes(path), mtime = os.path.getmtime(path)
+            ))
+        return sorted(out, key = lambda e: e['mtime'])
+
+    def total_bytes(self):
+        return sum(e['nbytes'] for e in self.entries())
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_dir(key), ignore_errors = True)
+
+    def evict(self, max_bytes = None, max_age = None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_age = self.max_age if max_age is None else max_age
+        if max_bytes is None and max_age is None:
+            return []
+
+        entries = self.entries()
+        removed = []
+        if max_age is not None:
+            now = time.time()
+            for e in entries:
+                if now - e['mtime'] > max_age:
+                    removed.append(e)
+        if max_bytes is not None:
+            kept = [e for e in entries if e not in removed]
+            total = sum(e['nbytes'] for e in kept)
+            for e in kept:
+                if total <= max_bytes:
+                    break
+                removed.append(e)
+                total -= e['nbytes']
+
+        for e in removed:
+            self.remove(e['key'])
+        if len(removed) > 0:
+            logger.debug(
+                'evicted ' + str(len(removed)) + ' entries from cache ' + self.name
+            )
+        return [e['key'] for e in removed]
+
+    def clear(self):
+        for e in self.entries():
+            self.remove(e['key'])
+
+def all_caches():
+    root = cache_root()
+    if not os.path.isdir(root):
+        return []
+    return [
+        DiskCache(name) for name in sorted(os.listdir(root))
+        if os.path.isdir(os.path.join(root, name))
+    ]
+
+def report(caches):
+    lines = []
+    for c in caches:
+        entries = c.entries()
+        nbytes = sum(e['nbytes'] for e in entries)
+        lines.append('{}: {} entries, {:.1f} MB'.format(
+            c.dir, len(entries), nbytes / 1e6
+        ))
+    return '\n'.join(lines)
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog = 'python -m tectosaur.util.disk_cache',
+        description = 'Inspect and prune the tectosaur on-disk caches.'
+    )
+    parser.add_argument('command', choices = ['list', 'evict', 'clear'])
+    parser.add_argument('--cache', default = None,
+        help = 'only act on this cache (e.g. programs)')
+    parser.add_argument('--max-mb', type = float, default = None)
+    parser.add_argument('--max-age-days', type = float, default = None)
+    opts = parser.parse_args(args)
+
+    caches = all_caches()
+    if opts.cache is not None:
+        caches = [DiskCache(opts.cache)]
+
+    if opts.command == 'evict':
+        max_bytes = None if opts.max_mb is None else opts.max_mb * 1e6
+        max_age = None if opts.max_age_days is None else opts.max_age_days * 86400
+        for c in caches:
+            c.evict(max_bytes = max_bytes, max_age = max_age)
+    elif opts.command == 'clear':
+        for c in caches:
+            c.clear()
+    print(report(caches))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,68 +6,127 @@ cfg['dependencies'] = [
 ]
 %>
 
+#include <vector>
+#include <algorithm>
 #include <pybind11/pybind11.h>
 #include "include/pybind11_nparray.hpp"
 
 namespace py = pybind11;
 
-py::tuple make_bsr_matrix(size_t n_rows, size_t n_cols, 
-        NPArray<double> in_data, NPArray<long> rows, NPArray<long> cols) 
+template <typename F>
+struct BlockRef {
+    long col;
+    const F* data;
+};
+
+// Merges any number of block COO matrices (given as parallel lists of rows,
+// cols and data arrays) into one BSR matrix. Blocks at the same (row, col)
+// are summed, in the order that they appear in the input lists.
+template <typename F>
+py::tuple make_bsr_matrix(size_t n_rows, size_t n_cols, py::list rows_list,
+        py::list cols_list, py::list data_list, size_t blocksize)
 {
-    size_t blockrows = in_data.request().shape[1];
-    size_t blockcols = in_data.request().shape[2];
-    assert(blockrows == blockcols);
-
-    size_t n_row_blocks = n_rows / blockrows;
-    size_t n_blocks = rows.request().shape[0];
-    size_t blocksize = blockrows * blockcols;
-
-    auto* rows_ptr = as_ptr<long>(rows);
-    auto* cols_ptr = as_ptr<long>(cols);
-    auto* in_data_ptr = as_ptr<double>(in_data);
-
-    auto indptr = make_array<long>({n_row_blocks + 1});
-    auto indices = make_array<long>({n_blocks});
-    auto data = make_array<double>({n_blocks, blockrows, blockcols});
-
-    auto* indptr_ptr = as_ptr<long>(indptr);
-    auto* indices_ptr = as_ptr<long>(indices);
-    auto* data_ptr = as_ptr<double>(data);
-
-    std::fill(indptr_ptr, indptr_ptr + n_row_blocks, 0.0);
-
-    for (size_t i = 0; i < n_blocks; i++) {
-        indptr_ptr[rows_ptr[i]]++;
+    size_t n_parts = rows_list.size();
+    size_t n_row_blocks = n_rows / blocksize;
+    size_t block_entries = blocksize * blocksize;
+
+    std::vector<NPArray<long>> rows_arrs;
+    std::vector<NPArray<long>> cols_arrs;
+    std::vector<NPArray<F>> data_arrs;
+    std::vector<size_t> part_sizes;
+    for (size_t p = 0; p < n_parts; p++) {
+        rows_arrs.push_back(rows_list[p].cast<NPArray<long>>());
+        cols_arrs.push_back(cols_list[p].cast<NPArray<long>>());
+        data_arrs.push_back(data_list[p].cast<NPArray<F>>());
+        part_sizes.push_back(rows_arrs[p].request().shape[0]);
     }
-
-    for (size_t i = 0, cumsum = 0; i < n_row_blocks; i++) {
-        int temp = indptr_ptr[i];
-        indptr_ptr[i] = cumsum;
-        cumsum += temp;
+    std::vector<long*> rows_ptrs;
+    std::vector<long*> cols_ptrs;
+    std::vector<F*> data_ptrs;
+    for (size_t p = 0; p < n_parts; p++) {
+        rows_ptrs.push_back(as_ptr<long>(rows_arrs[p]));
+        cols_ptrs.push_back(as_ptr<long>(cols_arrs[p]));
+        data_ptrs.push_back(as_ptr<F>(data_arrs[p]));
     }
-    indptr_ptr[n_row_blocks] = n_blocks;
 
-    for (size_t n = 0; n < n_blocks; n++) {
-        int row = rows_ptr[n];
-        int dest = indptr_ptr[row];
+    std::vector<long> row_start(n_row_blocks + 1, 0);
+    std::vector<long> unique_start(n_row_blocks + 1, 0);
+    std::vector<BlockRef<F>> refs;
+    {
+        py::gil_scoped_release release;
+
+        size_t n_blocks = 0;
+        for (size_t p = 0; p < n_parts; p++) {
+            for (size_t i = 0; i < part_sizes[p]; i++) {
+                row_start[rows_ptrs[p][i] + 1]++;
+            }
+            n_blocks += part_sizes[p];
+        }
+        for (size_t r = 0; r < n_row_blocks; r++) {
+            row_start[r + 1] += row_start[r];
+        }
 
-        indices_ptr[dest] = cols_ptr[n];
-        for (size_t k = 0; k < blocksize; k++) {
-            data_ptr[dest * blocksize + k] = in_data_ptr[n * blocksize + k];
+        refs.resize(n_blocks);
+        std::vector<long> next(row_start.begin(), row_start.end() - 1);
+        for (size_t p = 0; p < n_parts; p++) {
+            for (size_t i = 0; i < part_sizes[p]; i++) {
+                auto& dest = refs[next[rows_ptrs[p][i]]++];
+                dest.col = cols_ptrs[p][i];
+                dest.data = data_ptrs[p] + i * block_entries;
+            }
         }
 
-        indptr_ptr[row]++;
+#pragma omp parallel for schedule(dynamic, 256)
+        for (size_t r = 0; r < n_row_blocks; r++) {
+            auto first = refs.begin() + row_start[r];
+            auto last = refs.begin() + row_start[r + 1];
+            std::stable_sort(first, last,
+                [] (const BlockRef<F>& a, const BlockRef<F>& b) { return a.col < b.col; }
+            );
+            long n_unique = 0;
+            for (auto it = first; it != last; ++it) {
+                if (it == first || it->col != (it - 1)->col) {
+                    n_unique++;
+                }
+            }
+            unique_start[r + 1] = n_unique;
+        }
+        for (size_t r = 0; r < n_row_blocks; r++) {
+            unique_start[r + 1] += unique_start[r];
+        }
     }
 
-    for (size_t i = 0, last = 0; i <= n_row_blocks; i++) {
-        int temp = indptr_ptr[i];
-        indptr_ptr[i] = last;
-        last = temp;
+    size_t n_unique_blocks = unique_start[n_row_blocks];
+    auto indptr = array_from_vector(unique_start);
+    auto indices = make_array<long>({n_unique_blocks});
+    auto data = make_array<F>({n_unique_blocks, blocksize, blocksize});
+    auto* indices_ptr = as_ptr<long>(indices);
+    auto* out_ptr = as_ptr<F>(data);
+    {
+        py::gil_scoped_release release;
+
+#pragma omp parallel for schedule(dynamic, 256)
+        for (size_t r = 0; r < n_row_blocks; r++) {
+            long dest = unique_start[r] - 1;
+            for (long i = row_start[r]; i < row_start[r + 1]; i++) {
+                const auto& ref = refs[i];
+                if (i == row_start[r] || ref.col != refs[i - 1].col) {
+                    dest++;
+                    indices_ptr[dest] = ref.col;
+                    for (size_t k = 0; k < block_entries; k++) {
+                        out_ptr[dest * block_entries + k] = ref.data[k];
+                    }
+                } else {
+                    for (size_t k = 0; k < block_entries; k++) {
+                        out_ptr[dest * block_entries + k] += ref.data[k];
+                    }
+                }
+            }
+        }
     }
     return py::make_tuple(indptr, indices, data);
 }
 
-
 <%def name="bsrmv(blocksize)">
 template <typename F>
 void bsrmv${blocksize}(NPArray<long> indptr, NPArray<long> indices,
@@ -81,7 +140,8 @@ void bsrmv${blocksize}(NPArray<long> indptr, NPArray<long> indices,
     auto* x_ptr = as_ptr<F>(x);
     auto* y_ptr = as_ptr<F>(y);
 
-#pragma omp parallel for
+    py::gil_scoped_release release;
+#pragma omp parallel for schedule(dynamic, 256)
     for (size_t block_row_idx = 0; block_row_idx < mb; block_row_idx++) {
         auto* y_start = y_ptr + ${blocksize} * block_row_idx;
 
@@ -138,6 +198,7 @@ void bcoomv${blocksize}(NPArray<long> rows, NPArray<long> cols,
     auto* x_ptr = as_ptr<F>(x);
     auto* y_ptr = as_ptr<F>(y);
 
+    py::gil_scoped_release release;
 #pragma omp parallel for
     for (size_t block_idx = 0; block_idx < n_blocks; block_idx++) {
         auto* x_start = x_ptr + ${blocksize} * cols_ptr[block_idx];
@@ -168,7 +229,8 @@ void bcoomv${blocksize}(NPArray<long> rows, NPArray<long> cols,
 % endfor 
 
 PYBIND11_MODULE(fast_sparse,m) {
-    m.def("make_bsr_matrix", &make_bsr_matrix);
+    m.def("smake_bsr_matrix", &make_bsr_matrix<float>);
+    m.def("dmake_bsr_matrix", &make_bsr_matrix<double>);
     % for blocksize in range(1, 10):
         m.def("sbsrmv${blocksize}", &bsrmv${blocksize}<float>);
         m.def("dbsrmv${blocksize}", &bsrmv${blocksize}<double>);
@@ -1,8 +1,12 @@
 import numpy as np
 
-from tectosaur.util.cpp import imp
+from tectosaur.util.cpp import imp, lazy_fnc
 _geometry = imp('tectosaur.util._geometry')
-locals().update({k:v for k, v in _geometry.__dict__.items() if not k.startswith('__')})
+rotation_matrix = lazy_fnc(_geometry, 'rotation_matrix')
+vec_angle = lazy_fnc(_geometry, 'vec_angle')
+get_edge_lens = lazy_fnc(_geometry, 'get_edge_lens')
+get_longest_edge = lazy_fnc(_geometry, 'get_longest_edge')
+triangle_internal_angles = lazy_fnc(_geometry, 'triangle_internal_angles')
 
 def random_rotation():
     axis = np.random.rand(3) * 2 - 1.0
@@ -1,25 +1,107 @@
 import os
+import pickle
+import hashlib
 
 import numpy as np
 
 import tectosaur
 from tectosaur.util.timer import Timer
-try:
+
+def pick_backend(requested):
+    # TECTOSAUR_BACKEND = cuda, opencl or cpu forces a backend. Otherwise, the
+    # first importable of cuda and opencl is used, falling back to the host.
+    if requested is not None:
+        return requested
+    for name in ['cuda', 'opencl']:
+        try:
+            __import__('tectosaur.util.' + name)
+            return name
+        except ImportError:
+            pass
+    return 'cpu'
+
+backend = pick_backend(os.environ.get('TECTOSAUR_BACKEND'))
+if backend == 'cuda':
     from tectosaur.util.cuda import compile, empty_gpu, zeros_gpu, to_gpu,\
-            cluda_preamble, threaded_get
-    cuda_backend = True
-    ocl_backend = False
-except ImportError:
+            cluda_preamble, threaded_get, buffer_pool, make_stream, get_async,\
+            device_memory, n_devices, device_queue, synchronize
+elif backend == 'opencl':
     from tectosaur.util.opencl import compile, empty_gpu, zeros_gpu, to_gpu,\
-            cluda_preamble, threaded_get
-    cuda_backend = False
-    ocl_backend = True
+            cluda_preamble, threaded_get, buffer_pool, make_stream, get_async,\
+            device_memory, n_devices, device_queue, synchronize
+elif backend == 'cpu':
+    from tectosaur.util.cpu import compile, empty_gpu, zeros_gpu, to_gpu,\
+            cluda_preamble, threaded_get, buffer_pool, make_stream, get_async,\
+            device_memory, n_devices, device_queue, synchronize
+else:
+    raise ValueError('unknown TECTOSAUR_BACKEND: ' + str(backend))
+cuda_backend = backend == 'cuda'
+ocl_backend = backend == 'opencl'
+cpu_backend = backend == 'cpu'
+
+import tectosaur.util.disk_cache as disk_cache
 
 import logging
 logger = logging.getLogger(__name__)
 
 gpu_module = dict()
 
+# Compiled programs are stored on disk keyed by a hash of the rendered source
+# and the device/driver identity, so that new processes skip compilation.
+# TECTOSAUR_PROGRAM_CACHE=0 turns this off.
+program_cache = disk_cache.DiskCache(
+    'programs',
+    max_bytes = float(os.environ.get('TECTOSAUR_PROGRAM_CACHE_MB', 2000)) * 1e6,
+    max_age = float(os.environ.get('TECTOSAUR_PROGRAM_CACHE_DAYS', 60)) * 86400
+)
+use_program_cache = os.environ.get('TECTOSAUR_PROGRAM_CACHE', '1') != '0'
+
+streams = dict()
+def get_streams(n, device = 0):
+    device_streams = streams.setdefault(device, [])
+    while len(device_streams) < n:
+        device_streams.append(make_stream(device))
+    return device_streams[:n]
+
+def split_work(weights, n_parts):
+    """
+    Split range(len(weights)) into n_parts contiguous (start, end) pieces with
+    roughly equal total weight.
+    """
+    weights = np.asarray(weights, dtype = np.float64)
+    n = weights.shape[0]
+    if n == 0:
+        return [(0, 0)] * n_parts
+    cumulative = np.cumsum(weights)
+    targets = cumulative[-1] * np.arange(1, n_parts) / n_parts
+    bounds = [0] + np.searchsorted(cumulative, targets).tolist() + [n]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def rhs_chunks(v, max_rhs, dtype):
+    """
+    Split the columns of v, a vector or an (n, k) block of right hand sides,
+    into (start, end, chunk) pieces. Each chunk has min(k, max_rhs) columns,
+    with the last one padded with zeros.
+    """
+    V = v.reshape((v.shape[0], -1))
+    n_rhs = min(V.shape[1], max_rhs)
+    for start in range(0, V.shape[1], n_rhs):
+        end = min(start + n_rhs, V.shape[1])
+        chunk = np.zeros((V.shape[0], n_rhs), dtype = dtype)
+        chunk[:, :(end - start)] = V[:, start:end]
+        yield start, end, chunk
+
+def pool_stats():
+    return buffer_pool.stats()
+
+def set_pool_high_water(max_held_bytes):
+    buffer_pool.max_held_bytes = max_held_bytes
+    if max_held_bytes is not None and buffer_pool.held_bytes() > max_held_bytes:
+        buffer_pool.free_held()
+
+def free_pool():
+    buffer_pool.free_held()
+
 def np_to_c_type(t):
     if t == np.float32:
         return 'float'
@@ -60,21 +142,39 @@ def compare(a, b):
             return res
     return a == b
 
-def get_existing_module(tmpl_name, tmpl_args):
-    if tmpl_name not in gpu_module:
-        return None
-
-    existing_modules = gpu_module[tmpl_name]
-    for module_info in existing_modules:
-        tmpl_args_match = True
-        for k, v in module_info['tmpl_args'].items():
-            if not compare(v, tmpl_args[k]):
-                tmpl_args_match = False
-                break
-        if tmpl_args_match:
-            return module_info['module']
+def tmpl_args_key(v):
+    if type(v) is np.ndarray:
+        return (
+            'ndarray', v.dtype.str, v.shape,
+            hashlib.sha1(np.ascontiguousarray(v).tobytes()).hexdigest()
+        )
+    if type(v) is list or type(v) is tuple:
+        return (type(v).__name__,) + tuple(tmpl_args_key(x) for x in v)
+    if type(v) is set or type(v) is frozenset:
+        return (type(v).__name__,) + tuple(sorted(tmpl_args_key(x) for x in v))
+    if type(v) is dict:
+        return ('dict',) + tuple(sorted(
+            (k, tmpl_args_key(x)) for k, x in v.items()
+        ))
+    try:
+        hash(v)
+        return (type(v).__name__, v)
+    except TypeError:
+        pass
+    # Unhashable objects are keyed by their contents, not their id, which
+    # can be reused by a different object once v is freed.
+    if hasattr(v, '__dict__'):
+        return (type(v).__qualname__, tmpl_args_key(vars(v)))
+    return (
+        type(v).__qualname__,
+        hashlib.sha1(pickle.dumps(v, protocol = pickle.HIGHEST_PROTOCOL)).hexdigest()
+    )
+
+def module_key(tmpl_name, tmpl_args):
+    return (tmpl_name, tmpl_args_key(tmpl_args))
 
-    return None
+def get_existing_module(tmpl_name, tmpl_args):
+    return gpu_module.get(module_key(tmpl_name, tmpl_args), None)
 
 def get_template(tmpl_name, tmpl_dir):
     import mako.lookup
@@ -89,7 +189,8 @@ def template_with_mako(tmpl, tmpl_args):
     try:
         return tmpl.render(
             **tmpl_args, cluda_preamble = cluda_preamble,
-            cuda_backend = cuda_backend, ocl_backend = ocl_backend
+            cuda_backend = cuda_backend, ocl_backend = ocl_backend,
+            cpu_backend = cpu_backend
         )
     except:
         import mako.exceptions
@@ -133,10 +234,8 @@ def compile_module(tmpl, tmpl_name, save_code, tmpl_args):
     if save_code:
         save_code_to_tmp(code)
 
-    module_info = dict()
-    module_info['tmpl_args'] = tmpl_args
-    module_info['module'] = compile(code)
+    module = compile(code, cache = program_cache if use_program_cache else None)
     t.report('compile')
 
-    gpu_module[tmpl_name] = gpu_module.get(tmpl_name, []) + [module_info]
-    return module_info['module']
+    gpu_module[module_key(tmpl_name, tmpl_args)] = module
+    return module
@@ -0,0 +1,54 @@
+import threading
+
+import psutil
+
+# Reports the resident memory high-water mark of each stage of a
+# computation, next to the Timer reports. The resident set size is sampled
+# on a background thread, so very short spikes between samples can be
+# missed.
+
+class MemoryMonitor:
+    def __init__(self, prefix = '', tabs = 0, output_fnc = print, interval = 0.01):
+        self.prefix = prefix
+        self.tabs = tabs
+        self.output_fnc = output_fnc
+        self.interval = interval
+        self.process = psutil.Process()
+        self.stages = dict()
+        self.lock = threading.Lock()
+        self.stage_peak = self.rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target = self.sample, daemon = True)
+        self.thread.start()
+
+    def rss(self):
+        return self.process.memory_info().rss
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            rss = self.rss()
+            with self.lock:
+                self.stage_peak = max(self.stage_peak, rss)
+
+    def report(self, name):
+        """
+        Log and record the peak resident memory since the last report.
+        """
+        rss = self.rss()
+        with self.lock:
+            peak = max(self.stage_peak, rss)
+            self.stage_peak = rss
+        self.stages[name] = peak
+        text = '    ' * self.tabs + self.prefix + ' '
+        text += '{} peak memory {:.1f} MB, now {:.1f} MB'.format(
+            name, peak / 1e6, rss / 1e6
+        )
+        self.output_fnc(text)
+        return peak
+
+    def peak(self):
+        return max(self.stages.values(), default = self.rss())
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
@@ -1,72 +1,163 @@
 import os
+import pickle
 import pyopencl
 import pyopencl.array
+import pyopencl.tools
 import warnings
 import numpy as np
 
+import tectosaur.util.disk_cache as disk_cache
+from tectosaur.util.buffer_pool import DriverPool
+
 import logging
 logger = logging.getLogger(__name__)
 
 gpu_initialized = False
 gpu_ctx = None
 gpu_queue = None
+# The device set: one queue per device in the context. Setting
+# TECTOSAUR_FAKE_DEVICES=n instead spreads n queues over the context's
+# devices, which allows testing the multi-device code paths on one device.
+gpu_devices = []
+device_queues = []
+all_queues = []
 
 def report_devices(ctx):
     device_names = [d.name for d in ctx.devices]
     logger.info('initializing opencl context with devices = ' + str(device_names))
 
+def new_queue(device, **kwargs):
+    q = pyopencl.CommandQueue(gpu_ctx, device = device, **kwargs)
+    all_queues.append(q)
+    return q
+
 def initialize_with_ctx(ctx):
-    global gpu_initialized, gpu_ctx, gpu_queue
+    global gpu_initialized, gpu_ctx, gpu_queue, gpu_devices, device_queues
     gpu_ctx = ctx
-    gpu_queue = pyopencl.CommandQueue(
-        gpu_ctx,
+    gpu_devices = list(ctx.devices)
+    n_fake = int(os.environ.get('TECTOSAUR_FAKE_DEVICES', 0))
+    if n_fake > 0:
+        gpu_devices = [ctx.devices[i % len(ctx.devices)] for i in range(n_fake)]
+    gpu_queue = new_queue(
+        gpu_devices[0],
         properties=pyopencl.command_queue_properties.PROFILING_ENABLE
     )
+    device_queues = [gpu_queue] + [new_queue(d) for d in gpu_devices[1:]]
     gpu_initialized = True
 
     report_devices(ctx)
 
+def initialize_with_sub_devices(n):
+    device = pyopencl.create_some_context().devices[0]
+    units = max(device.max_compute_units // n, 1)
+    sub_devices = device.create_sub_devices(
+        [pyopencl.device_partition_property.EQUALLY, units]
+    )
+    initialize_with_ctx(pyopencl.Context(sub_devices[:n]))
+
 def ensure_initialized():
     global gpu_initialized
     if not gpu_initialized:
         initialize_with_ctx(pyopencl.create_some_context())
 
+def n_devices():
+    ensure_initialized()
+    return len(device_queues)
+
+def device_queue(device):
+    ensure_initialized()
+    return device_queues[device]
+
+def synchronize():
+    for q in all_queues:
+        q.finish()
+
 def ptr(arr):
     if type(arr) is pyopencl.array.Array:
         return arr.data
     return arr
 
+buffer_pool = DriverPool(
+    lambda: pyopencl.tools.MemoryPool(pyopencl.tools.ImmediateAllocator(gpu_queue)),
+    float(os.environ.get('TECTOSAUR_POOL_MB', 1024)) * 1e6
+)
+
 def to_gpu(arr, float_type):
     ensure_initialized()
     if type(arr) is pyopencl.array.Array:
         return arr
     to_type = arr.astype(float_type)
-    return pyopencl.array.to_device(gpu_queue, to_type)
+    return pyopencl.array.to_device(gpu_queue, to_type, allocator = buffer_pool)
 
 def zeros_gpu(shape, float_type):
     ensure_initialized()
-    return pyopencl.array.zeros(gpu_queue, shape, float_type)
+    return pyopencl.array.zeros(gpu_queue, shape, float_type, allocator = buffer_pool)
 
 def empty_gpu(shape, float_type):
     ensure_initialized()
-    return pyopencl.array.empty(gpu_queue, shape, float_type)
+    return pyopencl.array.empty(gpu_queue, shape, float_type, allocator = buffer_pool)
 
 def threaded_get(arr):
     return arr.get()
 
+def make_stream(device = 0):
+    ensure_initialized()
+    return new_queue(gpu_devices[device])
+
+def get_async(arr, out, stream = None):
+    queue = gpu_queue if stream is None else stream
+    return pyopencl.enqueue_copy(queue, out, arr.data, is_blocking = False)
+
+def device_memory():
+    ensure_initialized()
+    # OpenCL has no query for currently free memory.
+    d = gpu_ctx.devices[0]
+    return dict(
+        total = d.global_mem_size, free = d.global_mem_size,
+        max_alloc = d.max_mem_alloc_size, local_mem = d.local_mem_size
+    )
+
 class ModuleWrapper:
     def __init__(self, module):
         self.module = module
 
     def __getattr__(self, name):
         kernel = getattr(self.module, name)
-        def provide_queue_wrapper(*args, grid = None, block = None, **kwargs):
+        def provide_queue_wrapper(*args, grid = None, block = None, stream = None,
+                **kwargs):
             global_size = [b * g for b, g in zip(grid, block)]
             arg_ptrs = [ptr(a) for a in args]
-            return kernel(gpu_queue, global_size, block, *arg_ptrs, **kwargs)
+            queue = gpu_queue if stream is None else stream
+            return kernel(queue, global_size, block, *arg_ptrs, **kwargs)
         return provide_queue_wrapper
 
-def compile(code):
+def device_identity():
+    ensure_initialized()
+    return [
+        (d.platform.name, d.platform.version, d.name, d.version, d.driver_version)
+        for d in gpu_ctx.devices
+    ]
+
+def build_program(code, compile_options, cache):
+    if cache is None:
+        return pyopencl.Program(gpu_ctx, code).build(options = compile_options)
+
+    key = disk_cache.hash_key(code, compile_options, device_identity())
+    binary = cache.get(key)
+    if binary is not None:
+        try:
+            return pyopencl.Program(
+                gpu_ctx, gpu_ctx.devices, pickle.loads(binary)
+            ).build(options = compile_options)
+        except Exception as e:
+            logger.warning('discarding unusable cached program binary: ' + str(e))
+            cache.remove(key)
+
+    program = pyopencl.Program(gpu_ctx, code).build(options = compile_options)
+    cache.put(key, pickle.dumps(program.get_info(pyopencl.program_info.BINARIES)))
+    return program
+
+def compile(code, cache = None):
     ensure_initialized()
 
     compile_options = []
@@ -84,9 +175,7 @@ def compile(code):
 
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=pyopencl.CompilerWarning)
-        return ModuleWrapper(pyopencl.Program(
-            gpu_ctx, code
-        ).build(options = compile_options))
+        return ModuleWrapper(build_program(code, compile_options, cache))
 
 cluda_preamble = """
 // taken from pyopencl._cluda
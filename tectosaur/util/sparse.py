@@ -33,10 +33,7 @@ class BCOOMatrix:
         return out
 
     def to_bsr(self):
-        indptr, indices, data = fast_sparse.make_bsr_matrix(
-            *self.shape, self.data, self.rows, self.cols
-        )
-        return BSRMatrix(indptr, indices, data, self.shape)
+        return sum_to_bsr([self])
 
     def to_dense(self):
         return self.to_bsr().to_scipy().todense()
@@ -58,16 +55,70 @@ class BSRMatrix:
         return self.data.shape[1]
 
     def dot(self, v):
-        out = np.empty(self.shape[1], dtype = self.dtype)
+        out = np.empty(self.shape[0], dtype = self.dtype)
         fnc = get_mv_fnc('bsrmv', self.dtype, self.blocksize)
         fnc(self.indptr, self.indices, self.data, v.astype(self.dtype), out)
         return out
 
+    def to_bsr(self):
+        return self
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
     def to_scipy(self):
         return scipy.sparse.bsr_matrix((self.data, self.indices, self.indptr), self.shape)
 
     def to_dense(self):
         return self.to_scipy().todense()
 
+def sum_to_bsr(mats):
+    """
+    Merge a list of BCOOMatrix with the same shape and blocksize into a single
+    BSRMatrix. Duplicate blocks, both within and between the inputs, are
+    summed.
+    """
+    shape = mats[0].shape
+    blocksize = mats[0].blocksize
+    dtype = np.result_type(*[m.dtype for m in mats])
+    assert(all(m.shape == shape and m.blocksize == blocksize for m in mats))
+    if dtype == np.float32:
+        make_fnc = fast_sparse.smake_bsr_matrix
+    else:
+        dtype = np.float64
+        make_fnc = fast_sparse.dmake_bsr_matrix
+    indptr, indices, data = make_fnc(
+        shape[0], shape[1],
+        [np.ascontiguousarray(m.rows, dtype = np.int64) for m in mats],
+        [np.ascontiguousarray(m.cols, dtype = np.int64) for m in mats],
+        [np.ascontiguousarray(m.data, dtype = dtype) for m in mats],
+        blocksize
+    )
+    return BSRMatrix(indptr, indices, data, shape)
+
+def bsr_structure(shape, blocksize, rows_list, cols_list):
+    """
+    The indptr and indices of a BSR matrix with a block at each of the
+    (row, col) block positions in rows_list and cols_list. slots_list gives
+    the index into the BSR data of each of those blocks so that the data can
+    be filled in later, in any order. Duplicate positions share a slot.
+    """
+    n_block_rows = shape[0] // blocksize
+    n_block_cols = shape[1] // blocksize
+    rows = np.concatenate([np.asarray(r, dtype = np.int64) for r in rows_list])
+    cols = np.concatenate([np.asarray(c, dtype = np.int64) for c in cols_list])
+    keys = rows * n_block_cols + cols
+    unique_keys, inverse = np.unique(keys, return_inverse = True)
+    indices = unique_keys % n_block_cols
+    indptr = np.zeros(n_block_rows + 1, dtype = np.int64)
+    np.cumsum(
+        np.bincount(unique_keys // n_block_cols, minlength = n_block_rows),
+        out = indptr[1:]
+    )
+    splits = np.cumsum([len(r) for r in rows_list])[:-1]
+    slots_list = np.split(inverse.reshape(-1), splits)
+    return indptr, indices, slots_list
+
 def from_scipy_bsr(A):
     return BSRMatrix(A.indptr, A.indices, A.data, A.shape)
@@ -216,3 +216,34 @@ def test_elasticU():
         # print(n_src * n_obs, n_src * n_multipole + n_multipole * n_obs)
         print(order, (result - correct)[-1], result[-1], correct[-1])
     print(result)
+
+def test_m2l_l2l_invr():
+    np.random.seed(20)
+    n_src = 100
+    n_obs = 20
+    order = 10
+    src_pts = np.random.rand(n_src, 3) - 0.5
+    str = np.random.rand(n_src)
+    obs_pts = np.random.rand(n_obs, 3) - 0.5
+    obs_pts[:,0] += 3
+
+    r = scipy.spatial.distance.cdist(src_pts, obs_pts)
+    correct = np.sum((1.0 / r).T * str, axis = 1)
+
+    Mreal = np.zeros((order + 1, 2 * order + 1))
+    Mimag = np.zeros((order + 1, 2 * order + 1))
+    for i in range(n_src):
+        Rvr, Rvi = R(order, src_pts[i,:])
+        Mreal += Rvr * str[i]
+        Mimag += Rvi * str[i]
+
+    parent_center = np.array([3.0, 0.0, 0.0])
+    child_center = np.array([3.2, 0.1, -0.1])
+    Lreal, Limag = m2l(order, Mreal, Mimag, parent_center)
+    Lreal, Limag = l2l(order, Lreal, Limag, child_center - parent_center)
+
+    result = np.zeros(n_obs)
+    for i in range(n_obs):
+        Rvr, Rvi = R(order, obs_pts[i,:] - child_center)
+        result[i] = np.sum(Rvr * Lreal - Rvi * Limag)
+    np.testing.assert_allclose(result, correct, rtol = 1e-4)
@@ -3,13 +3,14 @@ from math import factorial
 import scipy.special
 import scipy.spatial
 import numpy as np
+import pytest
 
 import tectosaur as tct
 from tectosaur.mesh.modify import concat
 from tectosaur.fmm.tsfmm import *
 import tectosaur.util.gpu as gpu
 
-def fmm_tester(K_name, far_only = False, one_cell = False):
+def fmm_tester(K_name, far_only = False, one_cell = False, treecode = True):
     np.random.seed(123987)
     for order in [8]:#range(2, 13):
         float_type = np.float64
@@ -46,8 +47,11 @@ def fmm_tester(K_name, far_only = False, one_cell = False):
             quad_order = quad_order, float_type = float_type,
             K_name = K_name,
             mac = 2.5, max_pts_per_cell = max_pts_per_cell,
-            n_workers_per_block = 128
+            n_workers_per_block = 128, treecode = treecode
         )
+        if not treecode:
+            assert(fmm.interactions.m2p.src_n_idxs.shape[0] == 0)
+            assert(fmm.interactions.m2l.src_n_idxs.shape[0] > 0)
         if far_only:
             assert(fmm.interactions.p2p.src_n_idxs.shape[0] == 0)
         report_interactions(fmm)
@@ -69,6 +73,211 @@ def test_fmmA():
 def test_fmmH():
     fmm_tester('elasticRH3')
 
+def test_full_fmmU():
+    fmm_tester('elasticU3', treecode = False)
+
+def test_full_fmmT():
+    fmm_tester('elasticRT3', treecode = False)
+
+def test_full_fmmA():
+    fmm_tester('elasticRA3', treecode = False)
+
+def test_full_fmmH():
+    fmm_tester('elasticRH3', treecode = False)
+
+def small_fmm_mesh():
+    corners = [[-1.0, -1.0, 0], [-1.0, 1.0, 0], [1.0, 1.0, 0], [1.0, -1.0, 0]]
+    return tct.make_rect(8, 8, corners)
+
+def small_tsfmm(m, K_name = 'elasticRH3', treecode = True, **kwargs):
+    return TSFMM(
+        m, m, params = np.array([1.0, 0.25]), order = 4,
+        quad_order = 2, float_type = np.float64, K_name = K_name,
+        mac = 2.5, max_pts_per_cell = 2, n_workers_per_block = 128,
+        treecode = treecode, **kwargs
+    )
+
+def test_fmm_split_devices(monkeypatch):
+    np.random.seed(10)
+    m = small_fmm_mesh()
+    v = np.random.rand(m[1].shape[0] * 9)
+    def run(treecode):
+        return small_tsfmm(m, treecode = treecode).dot(v)
+    y1 = [run(True), run(False)]
+    device_queue = gpu.device_queue
+    monkeypatch.setattr(gpu, 'n_devices', lambda: 3)
+    monkeypatch.setattr(gpu, 'device_queue', lambda d: device_queue(0))
+    y3 = [run(True), run(False)]
+    for a, b in zip(y1, y3):
+        np.testing.assert_allclose(a, b, rtol = 1e-10, atol = 1e-10 * np.max(np.abs(a)))
+
+def test_fmm_plan(tmpdir):
+    np.random.seed(11)
+    m = small_fmm_mesh()
+    v = np.random.rand(m[1].shape[0] * 9)
+    plan = make_plan(m, m, 2.5, 2, treecode = False)
+    def run(K_name, **kwargs):
+        return small_tsfmm(m, K_name, treecode = False, **kwargs).dot(v)
+    for K_name in ['elasticRH3', 'elasticRT3']:
+        np.testing.assert_almost_equal(run(K_name, plan = plan), run(K_name), 12)
+
+    filename = str(tmpdir.join('plan.npz'))
+    plan.save(filename)
+    loaded = load_plan(filename)
+    assert(not loaded.treecode and loaded.mac == 2.5)
+    np.testing.assert_almost_equal(
+        run('elasticRH3', plan = loaded), run('elasticRH3', plan = plan), 12
+    )
+
+    tree = make_tree(m, 2)
+    cpp = traversal_module().fmmmm_interactions(tree, tree, 2.5, 2.5, 0, False)
+    for op_name in ['p2p', 'p2m', 'm2l', 'l2p', 'm2m']:
+        op = getattr(cpp, op_name)
+        correct = sum([
+            traversal_module().count_interactions(
+                level_op, tree, tree, op_name[2] != 'p', op_name[0] != 'p', 3
+            ) for level_op in (op if type(op) is list else [op])
+        ])
+        assert(loaded.count_interactions(op_name, 3) == correct)
+
+    with pytest.raises(ValueError):
+        run('elasticRH3', plan = make_plan(m, m, 2.5, 2, treecode = True))
+
+def test_fmm_max_rhs_local_mem(monkeypatch):
+    m = small_fmm_mesh()
+    device_memory = gpu.device_memory
+    def fake_device_memory(local_mem):
+        return lambda: dict(device_memory(), local_mem = local_mem)
+    monkeypatch.setattr(gpu, 'device_memory', fake_device_memory(2 ** 30))
+    assert(small_tsfmm(m, max_rhs = 3).max_rhs == 3)
+    monkeypatch.setattr(gpu, 'device_memory', fake_device_memory(1))
+    assert(small_tsfmm(m, max_rhs = 3).max_rhs == 1)
+
+def test_fmm_block_dot():
+    np.random.seed(12)
+    m = small_fmm_mesh()
+    all_tris = np.arange(m[1].shape[0])
+    V = np.random.rand(m[1].shape[0] * 9, 5)
+    ops = [
+        tct.TriToTriDirectFarfieldOp(
+            2, 'elasticRH3', [1.0, 0.25], m[0], m[1], np.float64,
+            all_tris, all_tris, max_rhs = 3
+        )
+    ]
+    for treecode in [True, False]:
+        ops.append(small_tsfmm(m, treecode = treecode, max_rhs = 3))
+    for op in ops:
+        Y = op.dot(V)
+        assert(Y.shape == V.shape)
+        for i in range(V.shape[1]):
+            y = op.dot(V[:,i])
+            np.testing.assert_allclose(Y[:,i], y, rtol = 1e-10, atol = 1e-10 * np.max(np.abs(y)))
+
+def kifmm_tester(K_name):
+    np.random.seed(123987)
+    float_type = np.float64
+    corners = [[-1.0, -1.0, 0], [-1.0, 1.0, 0], [1.0, 1.0, 0], [1.0, -1.0, 0]]
+    m_src = tct.make_rect(30, 30, corners)
+    m_obs = tct.make_rect(30, 30, corners)
+    m_obs[0][:,2] += 0.5
+    full_m = concat(m_src, m_obs)
+    src_subset = np.arange(0, m_src[1].shape[0])
+    obs_subset = np.arange(0, m_obs[1].shape[0]) + m_src[1].shape[0]
+    v = np.random.rand(src_subset.shape[0] * 9)
+
+    args = (2, K_name, [1.0, 0.25], full_m[0], full_m[1], float_type,
+        obs_subset, src_subset)
+    y1 = tct.TriToTriDirectFarfieldOp(*args).dot(v)
+    op = tct.KIFMMFarfieldOp(mac = 3.0, pts_per_cell = 20, order = 1)(*args)
+    assert(op.fmm.interactions.m2l.src_n_idxs.shape[0] > 0)
+    y2 = op.dot(v)
+    err = np.linalg.norm(y1 - y2) / np.linalg.norm(y1)
+    assert(err < 1e-4)
+
+def test_kifmmU():
+    kifmm_tester('elasticU3')
+
+def test_kifmmT():
+    kifmm_tester('elasticT3')
+
+def test_kifmmA():
+    kifmm_tester('elasticA3')
+
+def test_kifmmH():
+    kifmm_tester('elasticH3')
+
+def test_kifmm_rejects_regularized():
+    m = tct.make_rect(2, 2, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0], [1, -1, 0]])
+    all_tris = np.arange(m[1].shape[0])
+    with pytest.raises(ValueError):
+        tct.KIFMMFarfieldOp(mac = 3.0, pts_per_cell = 20, order = 1)(
+            2, 'elasticRH3', [1.0, 0.25], m[0], m[1], np.float64,
+            all_tris, all_tris
+        )
+
+@pytest.mark.parametrize('K_name,tol', [
+    ('elasticU3', 1e-4), ('elasticRT3', 1e-2), ('elasticRA3', 1e-2)
+])
+def test_kifmm_builder(K_name, tol):
+    from tectosaur.fmm.builder import FMM, make_tree
+    from tectosaur.fmm.cfg import make_config
+    from tectosaur.fmm.evaluator import FMMEvaluator
+    np.random.seed(1)
+    corners = [[-1.0, -1.0, 0], [-1.0, 1.0, 0], [1.0, 1.0, 0], [1.0, -1.0, 0]]
+    m_src = tct.make_rect(20, 20, corners)
+    m_obs = tct.make_rect(20, 20, corners)
+    m_obs[0][:,2] += 0.5
+    full_m = concat(m_src, m_obs)
+    src_subset = np.arange(0, m_src[1].shape[0])
+    obs_subset = np.arange(0, m_obs[1].shape[0]) + m_src[1].shape[0]
+    v = np.random.rand(src_subset.shape[0] * 9)
+
+    y1 = tct.TriToTriDirectFarfieldOp(
+        2, K_name, [1.0, 0.25], full_m[0], full_m[1], np.float64,
+        obs_subset, src_subset
+    ).dot(v)
+
+    cfg = make_config(K_name, [1.0, 0.25], 1.1, 3.0, 1, 2, np.float64, alpha = 1e-8)
+    assert(K_name in cfg.gpu_modules)
+    obs_m = (full_m[0], full_m[1][obs_subset])
+    src_m = (full_m[0], full_m[1][src_subset])
+    fmm = FMM(
+        make_tree(obs_m, cfg, 20), obs_m, make_tree(src_m, cfg, 20), src_m, cfg
+    )
+    y2 = fmm.to_orig(FMMEvaluator(fmm).eval(fmm.to_tree(v)))
+    err = np.linalg.norm(y1 - y2) / np.linalg.norm(y1)
+    assert(err < tol)
+
+def test_c2e_cache(tmpdir, monkeypatch):
+    import tectosaur.fmm.c2e as c2e
+    import tectosaur.util.disk_cache as disk_cache
+    monkeypatch.setenv('TECTOSAUR_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(c2e, 'c2e_cache', disk_cache.DiskCache('c2e'))
+    monkeypatch.setattr(c2e, 'use_c2e_cache', True)
+    monkeypatch.setattr(c2e, 'c2e_memo', dict())
+
+    results = c2e.precompute(['elasticH3'], [1], [1.0, 0.25], 1.1, [3.0], 4)
+    assert([r[0] for r in results] == ['elasticU3', 'elasticU3'])
+    assert(not any(r[-1] for r in results))
+    assert(len(c2e.c2e_cache.entries()) == 2)
+    computed = dict(c2e.c2e_memo)
+
+    def fail(*args):
+        raise AssertionError('c2e should be loaded from the cache')
+    monkeypatch.setattr(c2e, 'compute_c2e', fail)
+    c2e.c2e_memo.clear()
+    results = c2e.precompute(['elasticH3'], [1], [1.0, 0.25], 1.1, [3.0], 4)
+    assert(all(r[-1] for r in results))
+    for k, v in computed.items():
+        for a, b in zip(v, c2e.c2e_memo[k]):
+            np.testing.assert_array_equal(a, b)
+
+    m = tct.make_rect(2, 2, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0], [1, -1, 0]])
+    all_tris = np.arange(m[1].shape[0])
+    tct.KIFMMFarfieldOp(mac = 3.0, pts_per_cell = 20, order = 1)(
+        2, 'elasticT3', [1.0, 0.25], m[0], m[1], np.float64, all_tris, all_tris
+    )
+
 def benchmark():
     compare = False
     np.random.seed(123456)
@@ -102,7 +311,6 @@ def benchmark():
             t.report('op.dot oldfmm')
 
     # TODO: still maybe some room in p2p compared to direct
-    # TODO: maybe do full fmm?
     fmm = TSFMM(
         m, m, params = np.array([1.0, 0.25]), order = 4,
         K_name = K_name, quad_order = 2, float_type = float_type,
@@ -129,5 +337,106 @@ def benchmark():
     # print(out, correct, y1)
     np.testing.assert_almost_equal(out, correct, 5)
 
+def benchmark_full_fmm_scaling():
+    # The treecode does O(N log N) work and the full FMM O(N), so the time per
+    # triangle of the full FMM should flatten out as the mesh grows while the
+    # treecode's keeps growing.
+    np.random.seed(123456)
+    float_type = np.float32
+    K_name = 'elasticRH3'
+    corners = [[-1.0, -1.0, 0], [-1.0, 1.0, 0], [1.0, 1.0, 0], [1.0, -1.0, 0]]
+    for n in [72, 159, 317, 708, 1001]:
+        m = tct.make_rect(n, n, corners)
+        n_tris = m[1].shape[0]
+        v = np.random.rand(n_tris * 9).astype(float_type)
+        out = []
+        for treecode in [True, False]:
+            fmm = TSFMM(
+                m, m, params = np.array([1.0, 0.25]), order = 4,
+                K_name = K_name, quad_order = 2, float_type = float_type,
+                mac = 2.5, max_pts_per_cell = 80, n_workers_per_block = 128,
+                treecode = treecode
+            )
+            fmm.dot(v)
+            start = time.time()
+            out.append(fmm.dot(v))
+            took = time.time() - start
+            print('n_tris: {}, {}: {:.3f}s, {:.3g} us/tri'.format(
+                n_tris, 'treecode' if treecode else 'full fmm',
+                took, took / n_tris * 1e6
+            ))
+        print('relative difference: {:.3g}'.format(
+            np.linalg.norm(out[0] - out[1]) / np.linalg.norm(out[0])
+        ))
+
+def benchmark_kifmm_vs_tsfmm():
+    # elasticU3 is the only kernel both FMMs handle. The KIFMM is also run for
+    # elasticH3, which TSFMM only handles in its regularized form.
+    np.random.seed(123456)
+    float_type = np.float64
+    corners = [[-1.0, -1.0, 0], [-1.0, 1.0, 0], [1.0, 1.0, 0], [1.0, -1.0, 0]]
+    for n in [50, 100]:
+        m = tct.make_rect(n, n, corners)
+        n_tris = m[1].shape[0]
+        all_tris = np.arange(n_tris)
+        v = np.random.rand(n_tris * 9).astype(float_type)
+        ops = [
+            ('tsfmm', 'elasticU3', tct.FMMFarfieldOp(
+                mac = 2.5, pts_per_cell = 80, order = 4, treecode = False)),
+            ('kifmm', 'elasticU3', tct.KIFMMFarfieldOp(
+                mac = 3.0, pts_per_cell = 160, order = 1)),
+            ('kifmm', 'elasticH3', tct.KIFMMFarfieldOp(
+                mac = 3.0, pts_per_cell = 160, order = 1)),
+        ]
+        for name, K_name, op_type in ops:
+            args = (2, K_name, [1.0, 0.25], m[0], m[1], float_type,
+                all_tris, all_tris)
+            start = time.time()
+            op = op_type(*args)
+            build_time = time.time() - start
+            op.dot(v)
+            start = time.time()
+            y = op.dot(v)
+            took = time.time() - start
+            y_direct = tct.TriToTriDirectFarfieldOp(*args).dot(v)
+            print('n_tris: {}, {} {}: build {:.2f}s, dot {:.3f}s, {:.3g} us/tri, '
+                'error {:.3g}'.format(
+                n_tris, name, K_name, build_time, took, took / n_tris * 1e6,
+                np.linalg.norm(y - y_direct) / np.linalg.norm(y_direct)
+            ))
+
+def benchmark_block_dot():
+    # The time per column of a block matvec should drop as more right hand
+    # sides share each tree traversal.
+    np.random.seed(123456)
+    float_type = np.float32
+    corners = [[-1.0, -1.0, 0], [-1.0, 1.0, 0], [1.0, 1.0, 0], [1.0, -1.0, 0]]
+    m = tct.make_rect(71, 71, corners)
+    n_tris = m[1].shape[0]
+    for K_name in ['elasticU3', 'elasticRH3']:
+        fmm = TSFMM(
+            m, m, params = np.array([1.0, 0.25]), order = 4,
+            K_name = K_name, quad_order = 2, float_type = float_type,
+            mac = 2.5, max_pts_per_cell = 80, n_workers_per_block = 128,
+            treecode = False
+        )
+        for k in [1, 2, 4, 8]:
+            V = np.random.rand(n_tris * 9, k).astype(float_type)
+            fmm.dot(V)
+            start = time.time()
+            fmm.dot(V)
+            took = time.time() - start
+            print('n_tris: {}, {} k = {}: {:.3f}s per column'.format(
+                n_tris, K_name, k, took / k
+            ))
+
 if __name__ == "__main__":
-    benchmark()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'scaling':
+        benchmark_full_fmm_scaling()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'kifmm':
+        benchmark_kifmm_vs_tsfmm()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'block':
+        benchmark_block_dot()
+    else:
+        benchmark()
@@ -38,6 +38,23 @@ def test_tri_tri_farfield():
     out2 = T2.dot(in_vals)
     np.testing.assert_almost_equal(out1, out2)
 
+def test_tri_tri_farfield_split_devices(monkeypatch):
+    import tectosaur.util.gpu as gpu
+    m, surf1_idxs, surf2_idxs = make_meshes()
+    def run(in_vals):
+        op = TriToTriDirectFarfieldOp(
+            2, 'elasticT3', [1.0,0.25], m[0], m[1],
+            np.float64, obs_subset = surf1_idxs, src_subset = surf2_idxs
+        )
+        return op.dot(in_vals)
+    in_vals = np.random.rand(surf2_idxs.shape[0] * 9)
+    out1 = run(in_vals)
+    device_queue = gpu.device_queue
+    monkeypatch.setattr(gpu, 'n_devices', lambda: 3)
+    monkeypatch.setattr(gpu, 'device_queue', lambda d: device_queue(0))
+    out3 = run(in_vals)
+    np.testing.assert_almost_equal(out1, out3)
+
 def timing(n, runtime, name, flops):
     print("for " + name)
     cycles = runtime * 5e12
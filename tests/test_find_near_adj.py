@@ -100,6 +100,116 @@ def benchmark_adjacency():
     close, va, ea = split_adjacent_close(close_pairs, m[1])
     t.report('find adj')
 
+def loop_to_dof_space(tri_indices, obs_subset, src_subset):
+    return np.array([
+        [np.where(obs_subset == pair[0])[0][0], np.where(src_subset == pair[1])[0][0]]
+        for pair in tri_indices
+    ])
+
+def loop_edge_adj_orient(touching_verts):
+    tv = sorted(touching_verts)
+    if tv[0] == 0:
+        if tv[1] == 2:
+            return 2
+        return 0
+    return 1
+
+def loop_resolve_ea_rotation(tris, ea):
+    out = []
+    for i in range(ea.shape[0]):
+        obs_clicks = loop_edge_adj_orient([ea[i,2], ea[i,4]])
+        src_clicks = loop_edge_adj_orient([ea[i,3], ea[i,5]])
+        src_flip = False
+        if tris[ea[i,0], (0 + obs_clicks) % 3] != tris[ea[i,1], (1 + src_clicks) % 3] or \
+                tris[ea[i,0], (1 + obs_clicks) % 3] != tris[ea[i,1], (0 + src_clicks) % 3]:
+            src_flip = True
+        out.append((ea[i,0], ea[i,1], obs_clicks, src_clicks, src_flip))
+    return np.array(out)
+
+def subset_ea(n, subset_frac = 0.5, flip_frac = 0.0):
+    from tectosaur.nearfield.nearfield_op import to_tri_space
+    corners = [[-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0]]
+    pts, tris = mesh_gen.make_rect(n, n, corners)
+    flip = np.random.rand(tris.shape[0]) < flip_frac
+    tris[flip] = tris[flip][:,::-1]
+    n_subset = int(tris.shape[0] * subset_frac)
+    obs_subset = np.random.permutation(tris.shape[0])[:n_subset]
+    src_subset = np.random.permutation(tris.shape[0])[:n_subset]
+    close_pairs = find_close_or_touching(pts, tris[obs_subset], pts, tris[src_subset], 1.25)
+    close, va, ea = split_adjacent_close(close_pairs, tris[obs_subset], tris[src_subset])
+    return tris, obs_subset, src_subset, to_tri_space(ea, obs_subset, src_subset)
+
+def test_to_dof_space():
+    from tectosaur.nearfield.nearfield_op import to_dof_space
+    np.random.seed(11)
+    tris, obs_subset, src_subset, ea = subset_ea(10)
+    np.testing.assert_equal(
+        to_dof_space(ea[:,:2], obs_subset, src_subset),
+        loop_to_dof_space(ea[:,:2], obs_subset, src_subset)
+    )
+    assert(to_dof_space(np.empty((0, 2)), obs_subset, src_subset).shape == (0, 2))
+
+def test_resolve_ea_rotation():
+    from tectosaur.nearfield.nearfield_op import resolve_ea_rotation
+    np.random.seed(12)
+    # Flip half the triangles so that both src_flip cases are covered.
+    tris, obs_subset, src_subset, ea = subset_ea(10, flip_frac = 0.5)
+    out = resolve_ea_rotation(tris, ea)
+    assert(np.any(out[:,4] == 0) and np.any(out[:,4] == 1))
+    np.testing.assert_equal(out, loop_resolve_ea_rotation(tris, ea))
+
+def test_find_nearfield_threads_deterministic():
+    n = 30
+    pts, tris = mesh_gen.make_rect(n, n, [[-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0]])
+    max_threads = fast_find_nearfield.get_max_threads()
+    outs = []
+    try:
+        for n_threads in [1, 3]:
+            fast_find_nearfield.set_num_threads(n_threads)
+            close_pairs = find_close_or_touching(pts, tris, pts, tris, 1.25)
+            outs.append([close_pairs] + list(split_adjacent_close(close_pairs, tris, tris)))
+    finally:
+        fast_find_nearfield.set_num_threads(max_threads)
+    for a, b in zip(*outs):
+        np.testing.assert_equal(a, b)
+
+def benchmark_find_nearfield_scaling():
+    from tectosaur.util.timer import Timer
+    corners = [[-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0]]
+    pts, tris = mesh_gen.make_rect(500, 500, corners)
+    print('n_tris: ' + str(tris.shape[0]))
+    max_threads = fast_find_nearfield.get_max_threads()
+    n_threads = 1
+    while n_threads <= max_threads:
+        fast_find_nearfield.set_num_threads(n_threads)
+        print('n_threads: ' + str(n_threads))
+        t = Timer()
+        close_pairs = find_close_or_touching(pts, tris, pts, tris, 1.25)
+        t.report('close or touching')
+        split_adjacent_close(close_pairs, tris, tris)
+        t.report('split adjacent close')
+        n_threads *= 2
+    fast_find_nearfield.set_num_threads(max_threads)
+
+def benchmark_nearfield_setup():
+    from tectosaur.nearfield.nearfield_op import to_dof_space, resolve_ea_rotation
+    from tectosaur.util.timer import Timer
+    np.random.seed(13)
+    for n in [20, 40, 80]:
+        tris, obs_subset, src_subset, ea = subset_ea(n)
+        print('n_tris: ' + str(tris.shape[0]) + ', n_ea: ' + str(ea.shape[0]))
+        t = Timer()
+        loop_to_dof_space(ea[:,:2], obs_subset, src_subset)
+        t.report('loop to_dof_space')
+        to_dof_space(ea[:,:2], obs_subset, src_subset)
+        t.report('vectorized to_dof_space')
+        loop_resolve_ea_rotation(tris, ea)
+        t.report('loop resolve_ea_rotation')
+        resolve_ea_rotation(tris, ea)
+        t.report('vectorized resolve_ea_rotation')
+
 if __name__ == "__main__":
+    benchmark_find_nearfield_scaling()
+    benchmark_nearfield_setup()
     benchmark_adjacency()
     # benchmark_find_nearfield()
@@ -3,7 +3,7 @@ import pytest
 import numpy as np
 import taskloaf
 import tectosaur.util.gpu as gpu
-import tectosaur.util.opencl as opencl
+import tectosaur.util.disk_cache as disk_cache
 
 def test_gpu_compare_simple():
     assert(gpu.compare(1, 1))
@@ -41,6 +41,92 @@ def test_simple_module():
         correct = in_arr + arg
         np.testing.assert_almost_equal(correct, output)
 
+def test_cpu_backend_module():
+    import tectosaur.util.cpu as cpu
+    n = 10
+    in_arr = np.random.rand(n)
+    this_dir = os.path.dirname(os.path.realpath(__file__))
+    tmpl = gpu.get_template('kernel.cl', this_dir)
+    module = cpu.compile(tmpl.render(arg = 1.0, cluda_preamble = cpu.cluda_preamble))
+
+    in_cpu = cpu.to_gpu(in_arr, np.float32)
+    out_cpu = cpu.empty_gpu(n, np.float32)
+    module.add(out_cpu, in_cpu, grid = (n // 2, 1, 1), block = (2, 1, 1))
+    np.testing.assert_almost_equal(in_arr + 1.0, out_cpu.get())
+
+def test_disk_cache_evict(tmpdir, monkeypatch):
+    monkeypatch.setenv('TECTOSAUR_CACHE_DIR', str(tmpdir))
+    cache = disk_cache.DiskCache('test')
+    cache.put('a', b'0' * 100)
+    cache.put('b', b'1' * 100)
+    os.utime(cache.entry_dir('a'), (0, 0))
+    assert(cache.get('b') == b'1' * 100)
+    assert(cache.total_bytes() == 200)
+    assert(cache.evict(max_bytes = 150) == ['a'])
+    assert(cache.get('a') is None)
+    assert(cache.evict(max_age = 60) == [])
+
+def test_program_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('TECTOSAUR_CACHE_DIR', str(tmpdir))
+    cache = disk_cache.DiskCache('programs')
+    this_dir = os.path.dirname(os.path.realpath(__file__))
+    code = gpu.template_with_mako(
+        gpu.get_template('kernel.cl', this_dir), dict(arg = 2.0)
+    )
+    gpu.compile(code, cache = cache)
+    assert(len(cache.entries()) == 1)
+    module = gpu.compile(code, cache = cache)
+    assert(len(cache.entries()) == 1)
+
+    n = 10
+    in_arr = np.random.rand(n)
+    out_gpu = gpu.empty_gpu(n, np.float32)
+    module.add(out_gpu, gpu.to_gpu(in_arr, np.float32), grid = (n,1,1), block = (1,1,1))
+    np.testing.assert_almost_equal(in_arr + 2.0, out_gpu.get())
+
+class UnhashableArg:
+    __hash__ = None
+    def __init__(self, value):
+        self.value = value
+
+def test_tmpl_args_key_by_content():
+    key = lambda v: gpu.tmpl_args_key(dict(arg = UnhashableArg(v)))
+    assert(key([1.0, 2.0]) == key([1.0, 2.0]))
+    assert(key([1.0, 2.0]) != key([1.0, 3.0]))
+    assert(gpu.tmpl_args_key({1, 2}) == gpu.tmpl_args_key({2, 1}))
+
+def test_buffer_pool_reuse():
+    gpu.free_pool()
+    before = gpu.pool_stats()
+    A = gpu.empty_gpu(1000, np.float32)
+    del A
+    B = gpu.zeros_gpu(1000, np.float32)
+    after = gpu.pool_stats()
+    assert(after['hits'] == before['hits'] + 1)
+    np.testing.assert_almost_equal(B.get(), 0.0)
+
+def test_host_pool_view_keeps_block():
+    from tectosaur.util.buffer_pool import HostPool, bucket_size
+    pool = HostPool(None)
+    A = pool.allocate(800).view(np.float64)
+    V = A[10:20]
+    del A
+    assert(pool.held_bytes() == 0)
+    del V
+    assert(pool.held_bytes() == bucket_size(800))
+    pool.allocate(790)
+    assert(pool.hits == 1)
+
+def test_split_work():
+    weights = np.array([1, 5, 1, 1, 1, 1, 1, 1, 0, 0])
+    splits = gpu.split_work(weights, 3)
+    assert(len(splits) == 3)
+    assert(splits[0][0] == 0 and splits[-1][1] == weights.shape[0])
+    for (a, b), (c, d) in zip(splits[:-1], splits[1:]):
+        assert(b == c)
+    assert(max(np.sum(weights[a:b]) for a, b in splits) <= 6)
+    assert(gpu.split_work([], 2) == [(0, 0), (0, 0)])
+
 def test_async_get():
     R = np.random.rand(10)
     gpu_R = gpu.to_gpu(R, np.float32)
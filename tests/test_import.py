@@ -0,0 +1,83 @@
+import sys
+import time
+import subprocess
+
+def run_python(code):
+    return subprocess.check_output([sys.executable, '-c', code]).decode()
+
+extension_names = [
+    'tectosaur.fast_constraints', 'tectosaur.util.fast_sparse',
+    'tectosaur.util._geometry', 'tectosaur.mesh.fast_find_nearfield',
+    'tectosaur.mesh.fast_modify', 'tectosaur.ops._mass_op',
+    'tectosaur.fmm.traversal_wrapper'
+]
+
+def test_import_is_lazy():
+    out = run_python(
+        'import sys, tectosaur;'
+        'print([m for m in sys.modules if m.startswith("tectosaur")])'
+    )
+    loaded = eval(out)
+    for name in extension_names + ['tectosaur.util.gpu', 'tectosaur.ops.mass_op']:
+        assert(name not in loaded)
+
+def test_lazy_attribute():
+    import tectosaur as tct
+    from tectosaur.mesh.mesh_gen import make_rect
+    assert(tct.make_rect is make_rect)
+    assert('make_rect' in dir(tct))
+
+def test_lazy_extension():
+    out = run_python(
+        'import sys; import tectosaur.util.geometry as geometry;'
+        'print("tectosaur.util._geometry" in sys.modules);'
+        'print(geometry.vec_angle([1,0,0],[0,1,0]));'
+        'print("tectosaur.util._geometry" in sys.modules)'
+    )
+    before, angle, after = out.split()
+    assert(before == 'False')
+    assert(abs(float(angle) - 1.5707963267948966) < 1e-12)
+    assert(after == 'True')
+
+def test_lazy_constraint_classes():
+    out = run_python(
+        'import sys; import tectosaur.constraints as c;'
+        'print("tectosaur.fast_constraints" in sys.modules);'
+        'eq = c.ConstraintEQ([c.Term(1.0, 0)], 0.0);'
+        'print(isinstance(eq, c.ConstraintEQ) and isinstance(eq.terms[0], c.Term));'
+        'print(c.ConstraintEQ is c.fast_constraints.ConstraintEQ)'
+    )
+    assert(out.split() == ['False', 'True', 'True'])
+
+def test_prebuilt_extension_skips_cppimport():
+    # In a fresh process so that the result does not depend on which
+    # extensions earlier tests already loaded.
+    out = run_python(
+        'import os, cppimport, pytest;'
+        'import tectosaur.util.cpp as cpp;'
+        'cppimport.cppimport = lambda name: 1 / 0;'
+        'cpp.prebuilt = {"tectosaur.util._geometry"};'
+        'os.environ["TECTOSAUR_DEV"] = "0";'
+        'print(cpp.imp_now("tectosaur.util._geometry").vec_angle([1,0,0],[1,0,0]));'
+        'os.environ["TECTOSAUR_DEV"] = "1";'
+        'pytest.raises(ZeroDivisionError, cpp.imp_now, "tectosaur.util._geometry");'
+        'print("ok")'
+    )
+    angle, ok = out.split()
+    assert(float(angle) == 0)
+    assert(ok == 'ok')
+
+def test_extension_sources_exist():
+    import os
+    import tectosaur.util.cpp as cpp
+    for name in cpp.extension_names:
+        assert(os.path.exists(cpp.source_filepath(name)))
+
+def benchmark_import():
+    for stmt in ['import tectosaur', 'import tectosaur; tectosaur.RegularizedSparseIntegralOp']:
+        start = time.time()
+        run_python(stmt)
+        print('"' + stmt + '" took ' + str(time.time() - start))
+
+if __name__ == "__main__":
+    benchmark_import()
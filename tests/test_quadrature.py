@@ -161,6 +161,145 @@ def test_edge_adj_nan_problem_09_24_18():
     print(mat)
 
 
+def test_pairs_quad_pipelined_chunks():
+    pts, tris = tct.make_rect(5, 5, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0], [1, -1, 0]])
+    pairs = np.array([
+        [i, j, 0, 0] for i in range(0, 32, 3) for j in range(32) if i != j
+    ])
+    args = ('elasticT3', [1.0, 0.25], np.float64, 2, 3, pts, tris)
+    serial = PairsIntegrator(*args, n_streams = 1).nearfield(pairs)
+    pipelined = PairsIntegrator(*args, n_streams = 3, chunk_size = 40).nearfield(pairs)
+    np.testing.assert_almost_equal(serial, pipelined)
+
+def congruence_test_pairs(pts, tris):
+    import tectosaur.mesh.find_near_adj as find_near_adj
+    from tectosaur.nearfield.nearfield_op import resolve_ea_rotation
+    close = find_near_adj.find_close_or_touching(pts, tris, pts, tris, 2.0)
+    _, va, ea = find_near_adj.split_adjacent_close(close, tris, tris)
+    co = np.array([np.arange(tris.shape[0])] * 2).T.copy()
+    ea = resolve_ea_rotation(tris, ea)
+    va = np.hstack((va, np.zeros((va.shape[0], 1), dtype = va.dtype)))
+    return co, ea, va
+
+def test_pairs_congruence():
+    from tectosaur.util.geometry import random_rotation
+    pts, tris = tct.make_rect(6, 6, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0], [1, -1, 0]])
+    pts2, tris2 = tct.make_rect(3, 3, [[-1, -1, 1], [-1, 1, 1], [1, 1, 1.5], [1, -1, 1.5]])
+    pts, tris = tct.concat((pts, tris), (pts2, tris2))
+    pts = 3.7 * pts.dot(random_rotation().T) + np.array([1.0, -2.0, 5.0])
+    co, ea, va = congruence_test_pairs(pts, tris)
+    for K in ['elasticRT3', 'elasticRH3', 'elasticU3']:
+        args = (K, [1.0, 0.25], np.float64, 2, 3, pts, tris)
+        outs = []
+        for congruence in [False, True]:
+            pairs_int = PairsIntegrator(*args, congruence = congruence)
+            outs.append([
+                pairs_int.coincident(5, co),
+                pairs_int.edge_adj(5, ea),
+                pairs_int.vert_adj(3, va)
+            ])
+        for name in ['coincident', 'edge_adj', 'vert_adj']:
+            assert(pairs_int.congruence_stats[name]['hit_rate'] > 0.8)
+        for direct, dedup in zip(*outs):
+            np.testing.assert_almost_equal(
+                dedup / np.max(np.abs(direct)), direct / np.max(np.abs(direct)), 12
+            )
+
+def near_pairs(pts, tris):
+    # The close pairs of the mesh that share no vertex.
+    import tectosaur.mesh.find_near_adj as find_near_adj
+    close = find_near_adj.find_close_or_touching(pts, tris, pts, tris, 2.5)
+    nearfield_pairs, _, _ = find_near_adj.split_adjacent_close(close, tris, tris)
+    return nearfield_pairs
+
+def nearfield_test_pairs():
+    pts, tris = tct.make_rect(8, 8, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0], [1, -1, 0]])
+    pts2, tris2 = tct.make_rect(5, 5, [[-1, -1, 0.2], [-1, 1, 0.3], [1, 1, 0.3], [1, -1, 0.2]])
+    pts, tris = tct.concat((pts, tris), (pts2, tris2))
+    return pts, tris, near_pairs(pts, tris)
+
+def test_nearfield_adaptive_nq():
+    pts, tris, pairs = nearfield_test_pairs()
+    for K in ['elasticRT3', 'elasticU3']:
+        pairs_int = PairsIntegrator(K, [1.0, 0.25], np.float64, 2, 12, pts, tris)
+        fixed = pairs_int.nearfield(pairs)
+        adaptive = pairs_int.nearfield(pairs, tol = 1e-8)
+        stats = pairs_int.nearfield_bin_stats
+        assert(len(stats) > 1)
+        assert(sum(b['n_pairs'] for b in stats) == pairs.shape[0])
+        assert(stats[0]['nq'] < 12)
+        scale = np.max(np.abs(fixed))
+        np.testing.assert_almost_equal(adaptive / scale, fixed / scale, 6)
+        pairs_int.nearfield(pairs)
+        assert(pairs_int.nearfield_bin_stats == [])
+
+def test_fused_correction():
+    pts, tris = tct.make_rect(4, 4, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0.5], [1, -1, 0]])
+    co, ea, va = congruence_test_pairs(pts, tris)
+    near = near_pairs(pts, tris)
+    assert(near.shape[0] > 0)
+    for i, j in near[:,:2]:
+        assert(len(set(tris[i]) & set(tris[j])) == 0)
+    args = ('elasticRH3', [1.0, 0.25], np.float64, 2, 4, pts, tris)
+    pairs_int = PairsIntegrator(*args)
+    fused_int = PairsIntegrator(*args, correction_kernel = 'elasticRH3')
+    for name, call, pairs, check0 in [
+            ('coincident', lambda p, **kw: p.coincident(4, co, **kw), co, True),
+            ('edge_adj', lambda p, **kw: p.edge_adj(4, ea, **kw), ea, False),
+            ('vert_adj', lambda p, **kw: p.vert_adj(3, va, **kw), va, False),
+            ('nearfield', lambda p, **kw: p.nearfield(near, **kw), near, False)]:
+        uncorrected = call(pairs_int)
+        correct = uncorrected - pairs_int.correction(pairs[:,:2].copy(), check0)
+        corrected, fused_uncorrected = call(fused_int, corrected = True)
+        scale = np.max(np.abs(uncorrected))
+        np.testing.assert_almost_equal(corrected / scale, correct / scale, 12)
+        np.testing.assert_almost_equal(fused_uncorrected / scale, uncorrected / scale, 12)
+        lean, nothing = call(fused_int, corrected = True, keep_uncorrected = False)
+        assert(nothing is None)
+        np.testing.assert_almost_equal(lean / scale, correct / scale, 12)
+
+def test_pairs_split_devices(monkeypatch):
+    import tectosaur.util.gpu as gpu
+    pts, tris = tct.make_rect(4, 4, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0.5], [1, -1, 0]])
+    co, ea, va = congruence_test_pairs(pts, tris)
+    near = near_pairs(pts, tris)
+    def run():
+        pairs_int = PairsIntegrator(
+            'elasticRH3', [1.0, 0.25], np.float64, 2, 4, pts, tris,
+            chunk_size = 5, congruence = False
+        )
+        return [
+            pairs_int.coincident(4, co), pairs_int.vert_adj(3, va),
+            pairs_int.nearfield(near)
+        ]
+    out1 = run()
+    get_streams = gpu.get_streams
+    devices = set()
+    def fake_get_streams(n, device = 0):
+        devices.add(device)
+        return get_streams(n, 0)
+    monkeypatch.setattr(gpu, 'n_devices', lambda: 2)
+    monkeypatch.setattr(gpu, 'get_streams', fake_get_streams)
+    out2 = run()
+    assert(devices == {0, 1})
+    for r1, r2 in zip(out1, out2):
+        np.testing.assert_almost_equal(r1, r2)
+
+def benchmark_pairs_congruence():
+    from tectosaur.util.timer import Timer
+    from tectosaur.nearfield.congruence import report
+    pts, tris = tct.make_rect(40, 40, [[-1, -1, 0], [-1, 1, 0], [1, 1, 0], [1, -1, 0]])
+    co, ea, va = congruence_test_pairs(pts, tris)
+    args = ('elasticRH3', [1.0, 0.25], np.float32, 2, 5, pts, tris)
+    for congruence in [False, True]:
+        t = Timer()
+        pairs_int = PairsIntegrator(*args, congruence = congruence)
+        pairs_int.coincident(10, co)
+        pairs_int.edge_adj(10, ea)
+        pairs_int.vert_adj(6, va)
+        t.report('congruence = ' + str(congruence))
+    print(report(pairs_int.congruence_stats))
+
 def get_ea(pts, tris):
     import tectosaur.mesh.find_near_adj as find_near_adj
     from tectosaur.nearfield.nearfield_op import (
@@ -250,5 +389,6 @@ def convergence_vertadj():
 
 if __name__ == "__main__":
     # convergence_coincident()
-    convergence_edgeadj()
+    # convergence_edgeadj()
     # convergence_vertadj()
+    benchmark_pairs_congruence()
@@ -1,3 +1,4 @@
+import threading
 import time
 import numpy as np
 import matplotlib.pyplot as plt
@@ -165,6 +166,14 @@ def regularized_tester(K, sep, continuity, mass_op_factor = 0.0, which = None):
             print(i,j,final_outs[i] / final_outs[j])
             np.testing.assert_almost_equal(final_outs[i], final_outs[j], 6)
 
+def small_sparse_op(m, K = 'elasticRH3', **kwargs):
+    # A cheap RegularizedSparseIntegralOp for the tests of individual
+    # nearfield options, which are passed through kwargs.
+    return RegularizedSparseIntegralOp(
+        5, 5, 5, 2, 3, 2.5, K, K, [1.0, 0.25],
+        m[0], m[1], np.float64, TriToTriDirectFarfieldOp, **kwargs
+    )
+
 def test_regularized_T_farfield():
     regularized_tester('T', 2.0, False, which = ['tri_farfield_regularized'])
 
@@ -214,6 +223,188 @@ def test_regularized_H_self():
         which = ['dense_regularized', 'sparse_regularized']
     )
 
+def test_nearfield_cache(tmpdir, monkeypatch):
+    import tectosaur.nearfield.nearfield_op as nearfield_op
+    import tectosaur.util.disk_cache as disk_cache
+    monkeypatch.setenv('TECTOSAUR_CACHE_DIR', str(tmpdir))
+    cache = disk_cache.DiskCache('nearfield')
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 4, sep = 0.5)
+    def build():
+        return small_sparse_op(
+            m, obs_subset = surf1_idxs, src_subset = surf2_idxs,
+            nearfield_cache = cache, nearfield_tol = 1e-4
+        )
+    op1 = build()
+    assert(len(op1.nearfield_bin_stats) > 0)
+    assert(len(cache.entries()) == 1)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('nearfield should be loaded from the cache')
+    monkeypatch.setattr(nearfield_op, 'PairsIntegrator', fail)
+    op2 = build()
+    assert(type(op2.nearfield.mat.data) is np.memmap)
+    assert(op2.nearfield_bin_stats == op1.nearfield_bin_stats)
+    assert(op2.nearfield.congruence_stats == op1.nearfield.congruence_stats)
+
+    x = np.random.rand(op1.shape[1])
+    np.testing.assert_almost_equal(op1.nearfield.dot(x), op2.nearfield.dot(x))
+    np.testing.assert_almost_equal(
+        op1.nearfield.nearfield_no_correction_dot(x),
+        op2.nearfield.nearfield_no_correction_dot(x)
+    )
+
+    cache.evict(max_bytes = 0)
+    assert(len(cache.entries()) == 0)
+
+def test_lean_nearfield():
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 4, sep = 0.5)
+    ops = [
+        small_sparse_op(m, 'elasticRT3', lean_nearfield = lean)
+        for lean in [False, True]
+    ]
+    full, lean = [op.nearfield for op in ops]
+    assert(lean.mat_no_correction is None)
+    assert(lean.saved_bytes > 0)
+    assert(lean.nbytes < full.nbytes)
+
+    x = np.random.rand(ops[0].shape[1])
+    np.testing.assert_almost_equal(full.dot(x), lean.dot(x))
+    np.testing.assert_almost_equal(
+        full.nearfield_no_correction_dot(x), lean.nearfield_no_correction_dot(x)
+    )
+    np.testing.assert_almost_equal(
+        full.full_scipy_mat_no_correction().dot(x),
+        lean.full_scipy_mat_no_correction().dot(x)
+    )
+
+def test_matrix_free_nearfield():
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 4, sep = 0.5)
+    for subset in [None, surf1_idxs]:
+        ops = [
+            small_sparse_op(
+                m, obs_subset = subset, src_subset = subset,
+                matrix_free_nearfield = matrix_free
+            ) for matrix_free in [False, True]
+        ]
+        stored, matrix_free = [op.nearfield for op in ops]
+        assert(matrix_free.nbytes < stored.nbytes)
+
+        x = np.random.rand(ops[0].shape[1])
+        np.testing.assert_almost_equal(stored.dot(x), matrix_free.dot(x))
+        np.testing.assert_almost_equal(
+            stored.nearfield_no_correction_dot(x),
+            matrix_free.nearfield_no_correction_dot(x)
+        )
+
+        # The async product must not move the kernel launches to the
+        # nearfield executor's thread.
+        threads = set()
+        pairs_matvec = matrix_free.pairs_int.pairs_matvec
+        def recording_pairs_matvec(*args, **kwargs):
+            threads.add(threading.get_ident())
+            return pairs_matvec(*args, **kwargs)
+        matrix_free.pairs_int.pairs_matvec = recording_pairs_matvec
+        np.testing.assert_almost_equal(ops[0].dot(x), ops[1].dot(x))
+        assert(threads == {threading.get_ident()})
+
+def test_streamed_nearfield(tmpdir):
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 8, sep = 0.5)
+    ops = [
+        small_sparse_op(
+            m, nearfield_memory_budget = budget, nearfield_storage_dir = storage_dir
+        ) for budget, storage_dir in [(None, None), (1e5, str(tmpdir))]
+    ]
+    in_memory, streamed = [op.nearfield for op in ops]
+    assert(type(streamed.mat.data) is np.memmap)
+    assert('Nearfield' in streamed.memory_report)
+
+    x = np.random.rand(ops[0].shape[1])
+    np.testing.assert_almost_equal(in_memory.dot(x), streamed.dot(x))
+    np.testing.assert_almost_equal(
+        in_memory.nearfield_no_correction_dot(x),
+        streamed.nearfield_no_correction_dot(x)
+    )
+
+    # A second operator in the same storage_dir gets its own files, and the
+    # files are removed with the operators.
+    other = small_sparse_op(
+        m, 'elasticRT3', nearfield_storage_dir = str(tmpdir)
+    ).nearfield
+    assert(len(tmpdir.listdir()) == 4)
+    np.testing.assert_almost_equal(in_memory.dot(x), streamed.dot(x))
+    import gc
+    del ops, in_memory, streamed, other
+    gc.collect()
+    assert(len(tmpdir.listdir()) == 0)
+
+def test_mesh_context():
+    from tectosaur.mesh.mesh_context import get_mesh_context, clear_mesh_contexts
+    clear_mesh_contexts()
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 4, sep = 0.5)
+    def build(K, mesh_context = None):
+        return small_sparse_op(
+            m, K, obs_subset = surf1_idxs, src_subset = surf2_idxs,
+            mesh_context = mesh_context
+        )
+    H = build('elasticRH3')
+    ctx = get_mesh_context(m[0], m[1])
+    misses = ctx.misses
+    T = build('elasticRT3')
+    assert(ctx.misses == misses)
+    assert(ctx.hits > 0)
+
+    T_unshared = build('elasticRT3', mesh_context = False)
+    x = np.random.rand(T.shape[1])
+    np.testing.assert_almost_equal(T.dot(x), T_unshared.dot(x))
+
+    # The context is released with the last operator that uses it.
+    import gc
+    import tectosaur.mesh.mesh_context as mesh_context
+    del H, T, ctx
+    gc.collect()
+    assert(len(mesh_context.contexts) == 0)
+    clear_mesh_contexts()
+
+def test_estimate():
+    from tectosaur.estimate import estimate, report
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 4, sep = 0.5)
+    est = estimate(
+        m[0], m[1], float_type = np.float64,
+        fmm = dict(mac = 2.5, pts_per_cell = 10, order = 2),
+        throughput = dict(coincident = 1.0, edge_adj = 1.0, vert_adj = 1.0, nearfield = 1.0)
+    )
+    op = small_sparse_op(m)
+    assert(sum(est['counts'].values()) == op.nearfield.mat.data.shape[0])
+    pairs_nbytes = sum(p.nbytes for p in op.nearfield.category_pairs)
+    assert(est['memory']['host_matrices'] + pairs_nbytes == op.nearfield.nbytes)
+    assert(est['fmm']['interactions']['p2p'] > 0)
+    report(est)
+
+def test_estimate_calibrate(monkeypatch):
+    import tectosaur.estimate as estimate
+    created = []
+    class RecordingPairsIntegrator(estimate.pairs_integrator.PairsIntegrator):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self)
+    monkeypatch.setattr(
+        estimate.pairs_integrator, 'PairsIntegrator', RecordingPairsIntegrator
+    )
+    m, surf1_idxs, surf2_idxs = make_meshes(n_m = 4, sep = 0.5)
+    est = estimate.estimate(
+        m[0], m[1], float_type = np.float64, K_name = 'elasticRH3',
+        K_far_name = 'elasticH3', calibrate_nq = (5, 5, 5, 2, 3),
+        nearfield_tol = 1e-4
+    )
+    pairs_int = created[0]
+    assert(pairs_int.kernel == 'elasticRH3')
+    assert(pairs_int.correction_kernel == 'elasticH3')
+    assert(pairs_int.congruence)
+    assert(len(pairs_int.nearfield_bin_stats) > 0)
+    for k in estimate.categories:
+        assert(est['throughput'][k] > 0)
+        assert(est['assembly_time'][k] > 0)
+
 def test_benchmark_far_tris():
     n = 100
     m, surf1_idxs, surf2_idxs = make_meshes(n_m = n, sep = 4.0)
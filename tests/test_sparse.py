@@ -72,6 +72,36 @@ def test_to_bsr():
     A_bsr = A_bcoo.to_bsr()
     np.testing.assert_almost_equal(A_bsr.dot(x), A.dot(x))
 
+def random_bcoo(shape, blocksize, n_blocks, dtype):
+    rows = np.random.randint(shape[0] // blocksize, size = n_blocks)
+    cols = np.random.randint(shape[1] // blocksize, size = n_blocks)
+    data = np.random.rand(n_blocks, blocksize, blocksize).astype(dtype)
+    return sparse.BCOOMatrix(rows, cols, data, shape)
+
+def bcoo_to_dense(mat):
+    bs = mat.blocksize
+    out = np.zeros(mat.shape)
+    for i in range(mat.rows.shape[0]):
+        r, c = mat.rows[i], mat.cols[i]
+        out[(bs * r):(bs * r + bs), (bs * c):(bs * c + bs)] += mat.data[i]
+    return out
+
+def test_sum_to_bsr_duplicates():
+    shape = (60, 90)
+    for dtype, decimal in [(np.float32, 4), (np.float64, 10)]:
+        mats = [random_bcoo(shape, 3, n, dtype) for n in [500, 0, 300]]
+        correct = sum([bcoo_to_dense(m) for m in mats])
+        A_bsr = sparse.sum_to_bsr(mats)
+        assert(A_bsr.dtype == dtype)
+        assert(A_bsr.indptr.shape[0] == shape[0] // 3 + 1)
+        for r in range(shape[0] // 3):
+            row_cols = A_bsr.indices[A_bsr.indptr[r]:A_bsr.indptr[r + 1]]
+            assert(np.all(np.diff(row_cols) > 0))
+        np.testing.assert_almost_equal(A_bsr.to_dense(), correct, decimal)
+
+        x = np.random.rand(shape[1])
+        np.testing.assert_almost_equal(A_bsr.dot(x), correct.dot(x), decimal - 1)
+
 def benchmark_bsrmv():
     from tectosaur.util.timer import Timer
 
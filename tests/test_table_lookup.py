@@ -0,0 +1,118 @@
+import numpy as np
+
+from tectosaur.nearfield.table_lookup import coincident_table, adjacent_table, \
+    sub_basis, unlabel
+from tectosaur.nearfield.standardize import standardize, internal_angles
+from tectosaur.nearfield.pairs_integrator import PairsIntegrator
+from tectosaur.nearfield.nearfield_op import resolve_ea_rotation
+import tectosaur.nearfield.edge_adj_setup as edge_adj_setup
+from tectosaur.nearfield.table_params import table_min_internal_angle
+from tectosaur.util.test_decorators import kernel
+
+params = [1.7, 0.31]
+
+def random_legal_tri(min_angle = np.deg2rad(25)):
+    while True:
+        tri = np.random.rand(3, 3) * 2
+        if np.min(internal_angles(tri)) > min_angle:
+            return tri
+
+def test_standardize_maps_back():
+    np.random.seed(11)
+    for i in range(10):
+        tri = random_legal_tri()
+        std_tri, labels, translation, R, scale = standardize(
+            tri.tolist(), table_min_internal_angle, True
+        )
+        mapped = translation + scale * np.array(std_tri).dot(R.T)
+        np.testing.assert_almost_equal(mapped, tri[labels])
+
+def test_sub_basis_identity():
+    I = np.random.rand(81)
+    ref_tri = [[0, 0], [1, 0], [0, 1]]
+    np.testing.assert_almost_equal(
+        sub_basis(I, ref_tri, ref_tri), I.reshape((3,3,3,3))
+    )
+
+def test_unlabel():
+    I = np.random.rand(1, 3, 3, 3, 3)
+    obs_labels = np.array([[2, 0, 1]])
+    src_labels = np.array([[1, 0, 2]])
+    out = unlabel(I, obs_labels, src_labels)
+    for k in range(3):
+        for l in range(3):
+            np.testing.assert_almost_equal(
+                out[0, obs_labels[0,k], :, src_labels[0,l]], I[0, k, :, l]
+            )
+
+def test_coincident_table(kernel):
+    if kernel == 'elasticH3':
+        return
+    np.random.seed(3)
+    tri_pts = np.array([random_legal_tri() for i in range(6)])
+    n = tri_pts.shape[0]
+    result = coincident_table(kernel, params, tri_pts, np.float64)
+
+    pairs_int = PairsIntegrator(
+        kernel, params, np.float64, 1, 1, tri_pts.reshape((-1, 3)),
+        np.arange(3 * n).reshape((-1, 3)), congruence = False
+    )
+    correct = pairs_int.coincident(14, np.array([np.arange(n), np.arange(n)]).T)
+    err = np.max(np.abs(result - correct)) / np.max(np.abs(correct))
+    assert(err < 1e-4)
+
+def random_edge_adj_pairs(n):
+    pts = []
+    tris = []
+    for i in range(n):
+        while True:
+            p = np.random.rand(4, 3) * 2
+            obs_ok = np.min(internal_angles(p[[0,1,2]])) > np.deg2rad(25)
+            src_ok = np.min(internal_angles(p[[1,0,3]])) > np.deg2rad(25)
+            if not (obs_ok and src_ok):
+                continue
+            phi = edge_adj_setup.calc_adjacent_phi(p[[0,1,2]], p[[1,0,3]])
+            if np.deg2rad(30) < phi < np.deg2rad(330):
+                break
+        pts.append(p)
+        # Random vertex orders so that every rotation and flip shows up.
+        tris.append(4 * i + np.array([0, 1, 2])[np.random.permutation(3)])
+        tris.append(4 * i + np.array([1, 0, 3])[np.random.permutation(3)])
+    pts = np.concatenate(pts)
+    tris = np.array(tris)
+    ea = []
+    for i in range(n):
+        obs, src = 2 * i, 2 * i + 1
+        touching = [
+            (a, b) for a in range(3) for b in range(3) if tris[obs,a] == tris[src,b]
+        ]
+        ea.append([obs, src] + list(touching[0]) + list(touching[1]))
+    return pts, tris, resolve_ea_rotation(tris, np.array(ea))
+
+def test_adjacent_table(kernel):
+    if kernel == 'elasticH3':
+        return
+    np.random.seed(5)
+    pts, tris, ea = random_edge_adj_pairs(8)
+    result = adjacent_table(8, kernel, params, pts, tris, ea, np.float64, nq_near = 10)
+
+    pairs_int = PairsIntegrator(
+        kernel, params, np.float64, 1, 1, pts, tris, congruence = False
+    )
+    correct = pairs_int.edge_adj(14, ea)
+    err = np.max(np.abs(result - correct)) / np.max(np.abs(correct))
+    assert(err < 1e-3)
+
+def benchmark_adjacent_table():
+    from tectosaur.util.timer import Timer
+    np.random.seed(5)
+    pts, tris, ea = random_edge_adj_pairs(2000)
+    t = Timer()
+    adjacent_table(8, 'elasticT3', params, pts, tris, ea, np.float32, nq_near = 5)
+    t.report('adjacent table')
+    pairs_int = PairsIntegrator('elasticT3', params, np.float32, 1, 1, pts, tris)
+    pairs_int.edge_adj(14, ea)
+    t.report('edge adjacent quadrature')
+
+if __name__ == '__main__':
+    benchmark_adjacent_table()